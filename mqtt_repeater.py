@@ -31,7 +31,31 @@ import logging
 import threading 
 import socket
 import datetime
+import re
+import string
 import sqlite3
+import atexit
+import signal
+import os
+import gzip
+import shutil
+import bisect
+import collections
+import heapq
+import json
+import math
+import multiprocessing
+import zlib
+try:
+  import queue  # Python 3
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+  from urllib.parse import parse_qs
+except ImportError:
+  import Queue as queue  # Python 2
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+  from urlparse import parse_qs
 
 # Import Adafruit IO MQTT client.
 from Adafruit_IO import MQTTClient
@@ -53,7 +77,84 @@ settings_dict=dict()
 settings_defaults_dict = { 
   'USERNAME': '', 'PASSWORD': '', 'SERVER': 'io.adafruit.com', 'PORT': 1883, 
   'KEEPALIVE': 3600, 'CLIENTID' : None, 'TOPIC_FMT': 'adafruit_fmt', 'QOS': 1, 
-  'RETRY_COUNTER': 1, 'MAX_RETRIES' : 3, 'TLS_SET' : 0, 'CACERT': None }
+  'RETRY_COUNTER': 1, 'MAX_RETRIES' : 3, 'TLS_SET' : 0, 'CACERT': None,
+  'ROUTE_CACHE_SIZE': 10000,   # Max incoming topics to remember routing results for (see RouteTable)
+  'BACKOFF_MIN': 1, 'BACKOFF_MAX': 120,   # Seconds.  Reconnect delay doubles from BACKOFF_MIN up to BACKOFF_MAX, with jitter
+  'BUFFER_SIZE': 10000,   # Messages to hold in memory while this destination is disconnected
+  'BUFFER_SPILL_DIR': '',   # If set, messages past BUFFER_SIZE go to a file here instead of dropping the oldest
+  'DRAIN_RATE': 0,   # Messages/sec to send buffered messages at after reconnecting (plus the rate of new ones).  0 is no limit
+  'DURABLE_DIR': '',   # If set, messages for this MQTT destination are logged here until the broker confirms them (see DurableQueue)
+  'DURABLE_SYNC': 0.1,   # Seconds between fsyncs of the durable log
+  'DURABLE_SEGMENT_SIZE': 16777216,   # Bytes per durable log file before starting the next one
+  'DURABLE_ACK_TIMEOUT': 60,   # Seconds to wait for the broker to confirm a durable message before sending it again
+  'ACK_TIMEOUT': 60,   # Seconds before MAX_QUEUED stops counting a publish the broker hasn't confirmed (see PublishTracker)
+  'INFLIGHT': 20,   # QOS 1/2 messages sent to the broker and not acknowledged yet, at most.  Raise for high latency links
+  'MAX_QUEUED': 0,   # Messages handed to the client and not confirmed yet (see PublishTracker).  0 is no limit
+  'BATCH_INTERVAL': 0,   # If set, messages for this destination are collected for this many seconds and sent as one
+  'BATCH_TOPIC': '',   #  JSON message to BATCH_TOPIC (see Batcher)
+  'BATCH_FORMAT': 'object',   #  object:  {"topic": "payload", ..}  (latest per topic)   list:  every message, in order
+  'BATCH_MAX': 1000 }   #  Send the batch early once it has this many messages
+batch_formats = ('object', 'list')
+
+#Default values for 'sqlite' destinations if not set in cfgfile
+# BATCH_SIZE: Commit once this many distinct feeds are waiting to be written
+# FLUSH_INTERVAL: Commit at least this often (seconds) if anything is waiting
+# HISTORY: 1 to also keep every value in a 'history' table, plus per minute/hour min/max/avg in 'history_rollup'
+#  (see util/mqtt_db_query.py).  HISTORY_*_DAYS: Days to keep raw values, minute and hour summaries.  0 is forever.
+# HISTORY_MAINTENANCE: Seconds between removing history older than that
+# HISTORY_BUFFER: History rows to hold while the DB can't be written (locked).  Past that the oldest are dropped
+sqlite_defaults_dict = { 'BATCH_SIZE': 500, 'FLUSH_INTERVAL': 1.0, 'HISTORY': 0, 'HISTORY_RAW_DAYS': 30,
+  'HISTORY_MINUTE_DAYS': 365, 'HISTORY_HOUR_DAYS': 0, 'HISTORY_MAINTENANCE': 3600, 'HISTORY_BUFFER': 100000 }
+history_periods = (60, 3600)  # Seconds per history_rollup bucket.  Minutes and hours
+
+#Default values for every destination's dispatch queue if not set in cfgfile
+# Received messages are queued per destination and published by that destination's own worker thread(s),
+#  so a slow destination can't hold up the others.
+# DISPATCH_QUEUE_SIZE: Max messages waiting for this destination
+# DISPATCH_WORKERS: Number of worker threads publishing to this destination
+# OVERFLOW: What to do when the queue is full.  'block' (wait for room), 'drop-oldest' or 'drop-newest'
+dispatch_defaults_dict = { 'DISPATCH_QUEUE_SIZE': 1000, 'DISPATCH_WORKERS': 1, 'OVERFLOW': 'block' }
+overflow_policies = ('block', 'drop-oldest', 'drop-newest')
+
+#Default values for 'file' destinations if not set in cfgfile
+# QUEUE_SIZE: Max records waiting to be written.  Receiving threads block when full.
+# FLUSH_SIZE / FLUSH_INTERVAL: Flush the write buffer when this many bytes are waiting, or after this many seconds
+# FSYNC: 'never' (leave it to the OS), 'flush' (fsync on every flush), or a number of seconds between fsyncs
+# ROTATE_SIZE / ROTATE_INTERVAL: Rotate once the file reaches this many bytes, or is this many seconds old.  0 is off.
+# COMPRESS: 1 to gzip rotated files
+file_defaults_dict = { 'QUEUE_SIZE': 10000, 'FLUSH_SIZE': 65536, 'FLUSH_INTERVAL': 1.0, 'FSYNC': 'never',
+  'ROTATE_SIZE': 0, 'ROTATE_INTERVAL': 0, 'COMPRESS': 0 }
+
+#Settings for the repeater process itself, rather than one instance.  Set in cfgfile with the reserved name REPEATER:
+#  set REPEATER HTTP_PORT 9108
+# HTTP_PORT: Serve /metrics (Prometheus text format), and /value and /values (last value of every routed topic,
+#  see ValueCache) on this port.  0 is off.
+# HTTP_ADDR: Address to listen on.  Default is local only.
+# ENGINE: 'threads' (a paho network thread per instance) or 'asyncio' (every instance on one event loop, Python 3.7+)
+# WORKERS: Number of worker processes to split the mapping rules over (see partition_rules()).  1 is a single process.
+# PARTITION: How to split them:  'source', 'hash' or 'shared'
+# SHARE_GROUP: Group name for MQTT shared subscriptions with PARTITION shared
+# RELOAD_WATCH: Seconds between checks of the cfgfile for changes, to reload it (see apply_settings()).  0 is off.
+#  A SIGHUP always reloads it.
+repeater_settings = dict()
+repeater_defaults_dict = { 'HTTP_PORT': 0, 'HTTP_ADDR': '127.0.0.1', 'ENGINE': 'threads', 'WORKERS': 1,
+  'PARTITION': 'source', 'SHARE_GROUP': 'mqtt_repeater', 'RELOAD_WATCH': 0 }
+partition_modes = ('source', 'hash', 'shared')
+STATS_INTERVAL = 1  # Seconds between workers sending their stats and new values to the supervisor
+
+timer = getattr(time, 'perf_counter', time.time)  # For measuring latency.  Python 2 doesn't have perf_counter
+
+#Options that can be added to the end of a mapping line as OPTION=VALUE
+# MATCH: Regex the incoming topic must match (re.search).  Its groups can be used in the destination feed.
+# ON_CHANGE: 1 to only send a payload that is different from the last one sent
+# DEADBAND: Only send a number that is at least this far from the last one sent.  Other payloads as with ON_CHANGE
+# MIN_INTERVAL: Drop messages that come less than this many seconds after the last one sent
+# MAX_RATE: Messages/sec at most.  Anything over is held, and the latest held payload is sent when the rate allows
+# These filters are per destination topic (per incoming topic for file and DB outputs).  See RouteFilter.
+#  With REPEATER PARTITION shared, each worker filters its own share of the messages, so MAX_RATE is divided and
+#  MIN_INTERVAL multiplied by WORKERS (see Route.share()).  ON_CHANGE/DEADBAND can let a repeat through now and then.
+route_options = ('MATCH', 'ON_CHANGE', 'DEADBAND', 'MIN_INTERVAL', 'MAX_RATE')
+route_option_re = re.compile('^[A-Z_]+=')
 
 logger = logging.getLogger('mqtt_repeater')  #label when logging
 
@@ -67,10 +168,11 @@ logger = logging.getLogger('mqtt_repeater')  #label when logging
 #INFO Shows every received message and way it is handled:
 #logging.basicConfig(filename=LOGFILE, format='%(asctime)s:%(name)s:%(process)s:%(levelname)s:%(message)s', level=logging.INFO)
 #WARNING only shows warnings and above 
-logging.basicConfig(filename=LOGFILE, format='%(asctime)s:%(name)s:%(process)s:%(levelname)s:%(message)s', level=logging.WARNING)
+# (Set up in main(), so the functions here can be imported by util/mqtt_bench.py without touching the log file)
 
 #Read configuration file and store values in nested dictionaries
-def read_cfgfile(filename):
+# Fills the global settings_dict and repeater_settings, unless other dicts are given (see read_new_cfgfile())
+def read_cfgfile(filename, settings_dict=settings_dict, repeater_settings=repeater_settings):
     logger.info("----")
     logger.info("Reading file: %s", filename)
     f = open(filename)
@@ -88,24 +190,47 @@ def read_cfgfile(filename):
           logger.info("Storing setting (%s): %s -> ********", name, setting)
          else:   # Print everything else read from file
           logger.info("Storing setting (%s): %s -> %s", name, setting, value)
+         if name == 'REPEATER':  # Process-wide setting, not an instance
+           repeater_settings[setting] = value
+           continue
          if name not in settings_dict:  #If first time hitting this name, initialize its nested dictionaries
            settings_dict[name] = dict()
            settings_dict[name]['topic_map_dict'] = dict()  # For mappings later in loop
          settings_dict[name][setting] = value  # Save value
         else:
          # Store input->output mappings
+         # Optional per-route OPTION=VALUE fields go on the end of the line
+         fields = line.split()
+         options = dict()
+         while len(fields) > 3 and route_option_re.match(fields[-1]):
+           option,value = fields.pop().split('=', 1)
+           if option not in route_options:
+             logger.critical("Unknown mapping option: %s.  Use one of: %s", option, ', '.join(route_options))
+             logger.critical("LINE: %s", line)
+             sys.exit(11)
+           options[option] = value
          # Test # of fields.
-         if len(line.split()) == 4:  # Assume MQTT/ADA broker destination
-           sname,source,dname,dest = line.split()
-           logger.info("Storing map pair (%s): %s -> (%s): %s", sname, source, dname, dest)
-         elif len(line.split()) == 3:  # Assume FILE destination
-           sname,source,dname = line.split()
+         if len(fields) == 4:  # Assume MQTT/ADA broker destination
+           sname,source,dname,dest = fields
+           logger.info("Storing map pair (%s): %s -> (%s): %s %s", sname, source, dname, dest, options)
+         elif len(fields) == 3:  # Assume FILE destination
+           sname,source,dname = fields
            dest = 'BLANK'  # Just a placeholder for files and db.  
-           logger.info("Storing map pair (%s): %s -> (%s)", sname, source, dname)
+           logger.info("Storing map pair (%s): %s -> (%s) %s", sname, source, dname, options)
          else:  # Syntax error
-             logger.critical("Line length error in config file.  Line length: %s", len(line.split()))
+             logger.critical("Line length error in config file.  Line length: %s", len(fields))
              logger.critical("LINE: %s", line)
              sys.exit(11)
+         if not valid_topic_filter(source):  # '+' and '#' wildcards must be a whole level, '#' only at the end
+          logger.critical("Invalid wildcard in source feed: %s", source)
+          logger.critical("LINE: %s", line)
+          sys.exit(11)
+         try:  # Compile destination template and MATCH regex now, so messages only need a substitution
+           route = Route(source, dname, dest, options)
+         except (re.error, ValueError):
+           logger.critical("Mapping error: %s", str(sys.exc_info()[1]))
+           logger.critical("LINE: %s", line)
+           sys.exit(11)
          # Actually Store mapping
          if sname not in settings_dict:   # All sources need 'set' lines in file to define source
           logger.critical("%s message source not defined in any 'set' lines.  Exiting.", sname)
@@ -113,34 +238,77 @@ def read_cfgfile(filename):
          else:
           if source in settings_dict[sname]['topic_map_dict']:  # Adding additional output for mapping
            logger.info(" source existed, adding new pair")
-           settings_dict[sname]['topic_map_dict'][source].append((dname,dest))
+           settings_dict[sname]['topic_map_dict'][source].append(route)
           else:  # New output mapping
-           settings_dict[sname]['topic_map_dict'][source] = [(dname, dest)]
+           settings_dict[sname]['topic_map_dict'][source] = [route]
+
+    # Destinations need 'set' lines too
+    for sname in settings_dict:
+     for source in settings_dict[sname]['topic_map_dict']:
+      for route in settings_dict[sname]['topic_map_dict'][source]:
+       if route.dname not in settings_dict:
+        logger.critical("%s message destination not defined in any 'set' lines.  Exiting.", route.dname)
+        sys.exit(11)
             
     # Fill in missing settings with defaults
+    for setting in repeater_defaults_dict:
+      if setting not in repeater_settings:
+       logger.info("Setting not found (REPEATER): %s -> Using default -> %s", setting, str(repeater_defaults_dict[setting]))
+       repeater_settings[setting] = repeater_defaults_dict[setting]
+    if repeater_settings['ENGINE'] not in ('threads', 'asyncio'):
+      logger.critical("Unknown ENGINE setting: %s.  Use threads or asyncio.  Exiting.", repeater_settings['ENGINE'])
+      sys.exit(13)
+    if repeater_settings['PARTITION'] not in partition_modes:
+      logger.critical("Unknown PARTITION setting: %s.  Use one of: %s.  Exiting.", repeater_settings['PARTITION'], ', '.join(partition_modes))
+      sys.exit(13)
     for name in settings_dict:
-     if settings_dict[name]['TOPIC_FMT'] == 'file':   #If a file type.  This isn't a source.  Only takes FILENAME and TOPIC_FMT
+     for setting in dispatch_defaults_dict:  # All types can be a destination
+       if setting not in settings_dict[name]:
+        logger.info("Setting not found (%s): %s -> Using default -> %s", name, setting, str(dispatch_defaults_dict[setting]))
+        settings_dict[name][setting] = dispatch_defaults_dict[setting]
+     if settings_dict[name]['OVERFLOW'] not in overflow_policies:
+       logger.critical("%s unknown OVERFLOW setting: %s.  Use one of: %s.  Exiting.", name, settings_dict[name]['OVERFLOW'], ', '.join(overflow_policies))
+       sys.exit(13)
+     if settings_dict[name]['TOPIC_FMT'] == 'file':   #If a file type.  This isn't a source.  Takes FILENAME, TOPIC_FMT and the file_defaults_dict settings
       if 'FILENAME' not in settings_dict[name]:
           logger.critical("%s missing filename for file output.  Exiting.", name)
           sys.exit(13)
-      #Files only need two settings TOPIC_SMT and FILENAME
       test_file(settings_dict[name]['FILENAME']) #test file for writability. If not, exit program
+      for setting in file_defaults_dict:
+        if setting not in settings_dict[name]:
+         logger.info("Setting not found (%s): %s -> Using default -> %s", name, setting, str(file_defaults_dict[setting]))
+         settings_dict[name][setting] = file_defaults_dict[setting]
       continue
-     elif settings_dict[name]['TOPIC_FMT'] == 'sqlite':   #If a sqlite type.  This isn't a source.  Only takes FILENAME and TOPIC_FMT
+     elif settings_dict[name]['TOPIC_FMT'] == 'sqlite':   #If a sqlite type.  This isn't a source.  Takes FILENAME, TOPIC_FMT and the sqlite_defaults_dict settings
       if 'FILENAME' not in settings_dict[name]:
           logger.critical("%s missing filename for DB output.  Exiting.", name)
           sys.exit(13)
-      #Files only need two settings TOPIC_SMT and FILENAME
       test_file(settings_dict[name]['FILENAME']) #test file for writability. If not, exit program
+      for setting in sqlite_defaults_dict:
+        if setting not in settings_dict[name]:
+         logger.info("Setting not found (%s): %s -> Using default -> %s", name, setting, str(sqlite_defaults_dict[setting]))
+         settings_dict[name][setting] = sqlite_defaults_dict[setting]
       continue
      else:  #Other types, lookup defaults
       for setting in settings_defaults_dict:
         if setting not in settings_dict[name]:   #Use default from above global variable settings_defaults_dict.
          logger.info("Setting not found (%s): %s -> Using default -> %s", name, setting, str(settings_defaults_dict[setting]))
          settings_dict[name][setting] = settings_defaults_dict[setting]
+      if settings_dict[name]['BATCH_FORMAT'] not in batch_formats:
+        logger.critical("%s unknown BATCH_FORMAT setting: %s.  Use one of: %s.  Exiting.", name, settings_dict[name]['BATCH_FORMAT'], ', '.join(batch_formats))
+        sys.exit(13)
+      if float(settings_dict[name]['BATCH_INTERVAL']) > 0:
+        if not settings_dict[name]['BATCH_TOPIC']:
+          logger.critical("%s has BATCH_INTERVAL but no BATCH_TOPIC.  Exiting.", name)
+          sys.exit(13)
+        if settings_dict[name]['DURABLE_DIR']:
+          logger.critical("%s can't use BATCH_INTERVAL and DURABLE_DIR together.  Exiting.", name)
+          sys.exit(13)
       if 'LABEL' not in settings_dict[name]:  # Autogenerate default LABEL from source name
         logger.info("Setting not found (%s): LABEL -> Using default -> %s",name, name)
         settings_dict[name]['LABEL'] = name
+      # Compile the mappings into a lookup structure for search_map()
+      settings_dict[name]['route_table'] = RouteTable(settings_dict[name]['topic_map_dict'], int(settings_dict[name]['ROUTE_CACHE_SIZE']))
     logger.info("----")
     logger.info("")
     f.close()
@@ -149,18 +317,366 @@ def read_cfgfile(filename):
 
 #Function to search dictionaries for a matching output rules.  Returns list of destinations for topic
 def search_map(name, incoming_topic):
-    outgoing_topics = ""
-    if incoming_topic in settings_dict[name]['topic_map_dict']:
+    outgoing_topics = settings_dict[name]['route_table'].lookup(incoming_topic)
+    if outgoing_topics:
        logger.debug("Found matching topic - %s - %s", name, incoming_topic)
-       outgoing_topics = settings_dict[name]['topic_map_dict'][incoming_topic]
        logger.debug(" Outgoing topics - %s ", outgoing_topics)
-
-    if outgoing_topics == "":
-#TODO:  Add Regex searching to match # as a wildcard for FILE/DB saves.  (eg. \#)
+    else:
        logger.info("No matching topic found.  Ignoring.  Topic: %s", incoming_topic)
 
     return(outgoing_topics)
 
+#Check a source feed from the config file follows the MQTT topic filter rules
+def valid_topic_filter(topic_filter):
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+      if level == '#':
+        if i != len(levels) - 1:
+          return(False)
+      elif level != '+' and ('#' in level or '+' in level):
+        return(False)
+    return(True)
+
+#Topics to subscribe to on a source.  Worked out once per RouteTable (see RouteTable.subscriptions)
+def subscription_topics(name):
+    feeds = settings_dict[name]['route_table'].subscriptions
+    if 'share_group' in settings_dict[name]:  # Worker process with PARTITION shared.  The broker splits messages between workers
+      feeds = ['$share/%s/%s' % (settings_dict[name]['share_group'], feed) for feed in feeds]
+    return(feeds)
+
+#Prefix tree of MQTT topic filters.  Each node is one topic level, with '+' and '#' as their own branches, so
+# matching a topic costs its depth instead of the number of rules.  Rules are stored in a node under the key None.
+class TopicTrie(object):
+    def __init__(self):
+        self.root = dict()
+
+    def insert(self, topic_filter, value):
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.setdefault(level, dict())
+        node.setdefault(None, []).append(value)
+
+    # Returns (value, captures) for every filter matching the topic.  captures holds the topic levels matched by
+    #  each wildcard.  '#' captures all remaining levels as one string.
+    def match(self, topic):
+        found = []
+        self.walk(self.root, topic.split('/'), 0, (), found)
+        return(found)
+
+    def walk(self, node, levels, i, captures, found):
+        wildcard_ok = i > 0 or not levels[0].startswith('$')
+        if '#' in node and wildcard_ok:   # 'a/#' matches 'a' as well as everything below it
+            rest = '/'.join(levels[i:])
+            found.extend([(value, captures + (rest,)) for value in node['#'][None]])
+        if i == len(levels):
+            if None in node:
+                found.extend([(value, captures) for value in node[None]])
+            return
+        if levels[i] in node:
+            self.walk(node[levels[i]], levels, i + 1, captures, found)
+        if '+' in node and wildcard_ok:
+            self.walk(node['+'], levels, i + 1, captures + (levels[i],), found)
+
+    # Values of the filters that match every topic topic_filter matches (including topic_filter itself, if stored).
+    #  Like match(), but a '+' in topic_filter is only matched by '+' or '#', and a '#' only by '#'.
+    def covering(self, topic_filter):
+        found = []
+        self.walk_filter(self.root, topic_filter.split('/'), 0, found)
+        return(found)
+
+    def walk_filter(self, node, levels, i, found):
+        wildcard_ok = i > 0 or not levels[0].startswith('$')
+        if '#' in node and wildcard_ok:
+            found.extend(node['#'][None])
+        if i == len(levels):
+            found.extend(node.get(None, ()))
+            return
+        if levels[i] == '#':
+            return
+        if levels[i] in node:
+            self.walk_filter(node[levels[i]], levels, i + 1, found)
+        if '+' in node and wildcard_ok and levels[i] != '+':
+            self.walk_filter(node['+'], levels, i + 1, found)
+
+#One mapping line from the config file.
+# The destination feed can be a template:  {1}, {2}.. are the topic levels matched by the source feed's wildcards
+#  (or the groups of the MATCH regex, if set), {name} is a named MATCH group and {topic} is the whole incoming topic.
+#  eg.  MQTT_1  /farm/sensors/+/+  ADAFRUIT_1  {1}-{2}   sends /farm/sensors/garage/temp to garage-temp
+# The template is turned into a %-format string and a list of field names here, once.
+# Filter state is kept for the filter_limit most recently used destination topics.  Past that, the least recently used
+#  half is forgotten, so a wildcard rule seeing ever new topics doesn't grow without end.  The RouteTable's lookup()
+#  cache holds filters too, so it is cleared then as well.
+class Route(object):
+    filter_limit = 10000
+
+    def __init__(self, source, dname, dest, options):
+        self.dname = dname
+        self.dest = dest
+        self.options = options
+        # Filters.  Checked for every message, so kept as plain attributes
+        self.on_change = options.get('ON_CHANGE', '0') == '1'
+        self.deadband = float(options['DEADBAND']) if 'DEADBAND' in options else None
+        self.min_interval = float(options.get('MIN_INTERVAL', 0))
+        self.max_rate = float(options.get('MAX_RATE', 0))
+        if self.deadband is not None and self.deadband < 0 or self.min_interval < 0 or self.max_rate < 0:
+            raise ValueError('DEADBAND, MIN_INTERVAL and MAX_RATE can not be negative')
+        self.filtered = self.on_change or self.deadband is not None or self.min_interval > 0 or self.max_rate > 0
+        self.filters = dict()   # Filter state for each destination topic.  Only used if self.filtered
+        self.lookup_cache = None   # The cache of the RouteTable this route is in.  Set by RouteTable
+        self.regex = None
+        if 'MATCH' in options:
+            self.regex = re.compile(options['MATCH'])
+            fields = ['topic'] + [str(i) for i in range(1, self.regex.groups + 1)] + list(self.regex.groupindex)
+        else:
+            wildcards = len([level for level in source.split('/') if level in ('+', '#')])
+            fields = ['topic'] + [str(i) for i in range(1, wildcards + 1)]
+        self.format = None   # None if the destination is a plain feed name
+        self.fields = []
+        if '{' in dest:
+            self.format = ''
+            for literal, field, spec, conversion in string.Formatter().parse(dest):
+                self.format += literal.replace('%', '%%')
+                if field is not None:
+                    if field not in fields:
+                        raise ValueError("Unknown field {%s} in destination %s.  Can use: %s" % (field, dest, ', '.join(fields)))
+                    self.format += '%s'
+                    self.fields.append(field)
+
+    # Destination feed for an incoming topic, or None if the topic doesn't pass MATCH
+    def destination(self, topic, captures):
+        if self.regex is not None:
+            m = self.regex.search(topic)
+            if m is None:
+                return(None)
+            captures = m.groups()
+            named = m.groupdict()
+        if self.format is None:
+            return(self.dest)
+        values = []
+        for field in self.fields:
+            if field == 'topic':
+                values.append(topic)
+            elif field.isdigit():
+                values.append(captures[int(field) - 1] or '')
+            else:
+                values.append(named[field] or '')
+        return(self.format % tuple(values))
+
+    # RouteFilter for a destination topic, or None if this route doesn't filter.  Files and DBs have no destination
+    #  topic (dest is BLANK), so they filter per incoming topic.
+    def filter(self, topic, dtopic):
+        if not self.filtered:
+            return(None)
+        key = topic if self.dest == 'BLANK' else dtopic
+        f = self.filters.get(key)
+        if f is None:
+            if len(self.filters) >= self.filter_limit:
+                self.forget()
+            f = self.filters.setdefault(key, RouteFilter(self))
+        return(f)
+
+    # Drop the state of the least recently used half of the destination topics.  Not those holding a MAX_RATE message
+    def forget(self):
+        idle = sorted(self.filters.items(), key=lambda entry: entry[1].used)
+        for key, f in idle[:len(idle) // 2]:
+            if f.pending is None:
+                del self.filters[key]
+        if self.lookup_cache is not None:  # Don't keep using (and holding on to) the ones just forgotten
+            self.lookup_cache.clear()
+
+    # PARTITION shared.  Each of count workers gets about 1/count of the messages and keeps its own filter state, so
+    #  give each 1/count of the rate, to keep to MAX_RATE and MIN_INTERVAL between them
+    def share(self, count):
+        self.max_rate /= count
+        self.min_interval *= count
+
+#Filter state for one destination topic of a Route with ON_CHANGE, DEADBAND, MIN_INTERVAL or MAX_RATE.
+# One of these per destination topic, so it is kept small (__slots__), and allow() only does the checks that are set.
+# MAX_RATE is a token bucket holding up to one second of messages (at least one).  A message with no token left is
+#  held in 'pending', replacing any message already held, and rate_scheduler sends it when the next token is due.
+#  Held messages are checked against ON_CHANGE/DEADBAND when they are sent, not when they arrive, so the latest
+#  value always gets through.
+# message() calls allow() from the source's network thread, and rate_scheduler calls flush() from its own thread.
+#  Only routes with MAX_RATE use flush(), so only they take rate_lock.
+class RouteFilter(object):
+    __slots__ = ('route', 'last', 'number', 'sent_at', 'tokens', 'refilled', 'pending', 'used')
+
+    def __init__(self, route):
+        self.route = route
+        self.last = None       # Last payload sent
+        self.number = None     # ...as a float, for DEADBAND.  None if it wasn't a number
+        self.sent_at = None    # time.time() of the last message sent
+        self.tokens = max(route.max_rate, 1.0)
+        self.refilled = 0.0
+        self.pending = None    # (source, feed_id, dtopic, payload) held by MAX_RATE
+        self.used = 0.0        # time.time() of the last message, for Route.forget()
+
+    # True to send the message now.  False if it was filtered, or held by MAX_RATE
+    def allow(self, item, now):
+        route = self.route
+        self.used = now
+        if not route.max_rate:
+            if not self.check(item[3], now):
+                return(False)
+            self.sent(item[3], now)
+            return(True)
+        with rate_lock:
+            if self.pending is not None:  # Already waiting for a token.  Newest payload wins, the one held is dropped
+                self.pending = item
+                metric_filtered.inc(route.dname, 'rate')
+                return(False)
+            if not self.check(item[3], now):
+                return(False)
+            self.refill(now)
+            if self.tokens < 1:
+                self.pending = item
+                rate_scheduler.schedule(self, now + (1 - self.tokens) / route.max_rate)
+                return(False)
+            self.tokens -= 1
+            self.sent(item[3], now)
+            return(True)
+
+    # MIN_INTERVAL, then ON_CHANGE or DEADBAND against the last payload sent.  Counts what it filters
+    def check(self, payload, now):
+        route = self.route
+        if route.min_interval and self.sent_at is not None and now - self.sent_at < route.min_interval:
+            metric_filtered.inc(route.dname, 'interval')
+            return(False)
+        if route.deadband is not None:
+            number = to_number(payload)
+            if number is not None and self.number is not None:
+                if abs(number - self.number) < route.deadband:
+                    metric_filtered.inc(route.dname, 'deadband')
+                    return(False)
+                return(True)
+        if (route.on_change or route.deadband is not None) and payload == self.last and self.sent_at is not None:
+            metric_filtered.inc(route.dname, 'unchanged')
+            return(False)
+        return(True)
+
+    def sent(self, payload, now):
+        self.last = payload
+        if self.route.deadband is not None:
+            self.number = to_number(payload)
+        self.sent_at = now
+
+    def refill(self, now):
+        route = self.route
+        self.tokens = min(max(route.max_rate, 1.0), self.tokens + (now - self.refilled) * route.max_rate)
+        self.refilled = now
+
+    # Called by rate_scheduler when the held message is due.  Sends it, if it still passes the filters.
+    #  force sends it now, whatever MAX_RATE and MIN_INTERVAL say (at exit)
+    def flush(self, now, force=False):
+        route = self.route
+        with rate_lock:
+            item = self.pending
+            if item is None:
+                return
+            self.refill(now)
+            wait = (1 - self.tokens) / route.max_rate if self.tokens < 1 else 0
+            if route.min_interval and self.sent_at is not None:
+                wait = max(wait, self.sent_at + route.min_interval - now)
+            if wait > 0 and not force:  # Early.  Try again later
+                rate_scheduler.schedule(self, now + wait)
+                return
+            self.pending = None
+            self.tokens = max(self.tokens - 1, 0)
+            if not force and not self.check(item[3], now):
+                return
+            self.sent(item[3], now)
+        c = settings_dict.get(route.dname)
+        if c is not None and 'dispatcher' in c:  # Unless a reload removed it meanwhile
+            c['dispatcher'].put(item)
+
+# Payload as a float, or None if it isn't a number
+def to_number(payload):
+    try:
+        return(float(payload))
+    except (TypeError, ValueError):
+        return(None)
+
+#Sends the messages held by MAX_RATE route filters when they are due.  One thread for all of them.
+# Started the first time a message is held.
+class RateScheduler(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name='rate-scheduler')
+        self.daemon = True
+        self.due = []   # heap of (time, sequence number, RouteFilter)
+        self.count = 0
+        self.running = False
+        self.cond = threading.Condition()
+
+    def schedule(self, route_filter, when):
+        with self.cond:
+            heapq.heappush(self.due, (when, self.count, route_filter))
+            self.count += 1
+            if not self.running:
+                self.running = True
+                self.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.due or self.due[0][0] > time.time():
+                    self.cond.wait(self.due[0][0] - time.time() if self.due else None)
+                route_filter = heapq.heappop(self.due)[2]
+            route_filter.flush(time.time())
+
+    # At exit.  Send everything still held, so the latest values aren't lost
+    def flush_all(self):
+        with self.cond:
+            due = self.due
+            self.due = []
+        for when, count, route_filter in due:
+            route_filter.flush(time.time(), True)
+
+rate_lock = threading.Lock()
+rate_scheduler = RateScheduler()
+
+#Routing rules for one source.  Built from topic_map_dict by read_cfgfile().
+# lookup() results are cached per incoming topic (including topics with no route), so repeated topics only cost a
+#  dict lookup.  The cache is cleared when it reaches cache_size.
+# subscriptions is the list of feeds to subscribe to.  It leaves out any rule already covered by a wildcard rule, so
+#  the broker doesn't send us the same message twice.  Worked out here, once, using the trie (each feed costs its depth,
+#  not the number of rules), since connected() needs it on every reconnect.
+class RouteTable(object):
+    def __init__(self, topic_map_dict, cache_size):
+        self.trie = TopicTrie()
+        self.order = dict()   # Filter -> position in config file, so results come out in config order
+        for source in topic_map_dict:
+            self.order[source] = len(self.order)
+            self.trie.insert(source, source)
+        self.topic_map_dict = topic_map_dict
+        self.subscriptions = [source for source in topic_map_dict
+                              if not any(other != source for other in self.trie.covering(source))]
+        self.cache = dict()
+        self.cache_size = cache_size
+        for routes in topic_map_dict.values():
+            for route in routes:
+                route.lookup_cache = self.cache
+
+    def lookup(self, topic):
+        try:
+            return(self.cache[topic])
+        except KeyError:
+            pass
+        outgoing_topics = []   # (dname, dtopic, RouteFilter or None)
+        found = set()
+        for source, captures in sorted(self.trie.match(topic), key=lambda found: self.order[found[0]]):
+            for route in self.topic_map_dict[source]:
+                dtopic = route.destination(topic, captures)
+                if dtopic is None:  # Didn't pass MATCH
+                    continue
+                if (route.dname, dtopic) not in found:  # Same destination from overlapping rules.  Only send once
+                    found.add((route.dname, dtopic))
+                    outgoing_topics.append((route.dname, dtopic, route.filter(topic, dtopic)))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[topic] = outgoing_topics
+        return(outgoing_topics)
+
 #Test output file for writability
 def test_file(filename):
   file = open(filename, 'a')  #Append-only
@@ -169,38 +685,353 @@ def test_file(filename):
 
 #Publish data to a file
 # Called using these parameters: (client._instance_name, feed_id, dest, settings_dict[dest]['FILENAME'], payload)
-#TODO: handle errors gracefully instead of exiting.
+# Only queues the record.  The destination's FileWriter thread formats and writes it.
 def publish_file(name, sourcefeed, dest, filename, payload):
-  file = open(filename, 'a')  #Append-only
-  timestring = datetime.datetime.now().isoformat()  # Current timestamp. This is evil in python and should be easier
-  #  Human readable if desired
-  #file.write("{0}\t{1}\t\t{2}\t\t{3}\n".format(timestring,name,sourcefeed,payload))
-  #  CSV format
-  file.write("{0},{1},{2},{3}\n".format(timestring,name,sourcefeed,payload))
-  file.close()
+  settings_dict[dest]['writer'].submit(name, sourcefeed, payload)
+
+#Background writer for a 'file' destination.
+# Keeps the file open with a large write buffer and is fed through a bounded queue, so receiving threads never
+#  wait on open/write/close.  Handles flushing, fsync and rotation of the file.
+class FileWriter(threading.Thread):
+    STOP = object()  # Queued by close()
+
+    def __init__(self, name, c):
+        threading.Thread.__init__(self, name='file-' + name)
+        self.daemon = True   # Don't hold up exit.  close() is called at exit to flush what is left
+        self.dest = name
+        self.filename = c['FILENAME']
+        self.queue = queue.Queue(int(c['QUEUE_SIZE']))
+        self.flush_size = int(c['FLUSH_SIZE'])
+        self.flush_interval = float(c['FLUSH_INTERVAL'])
+        self.fsync = str(c['FSYNC'])
+        if self.fsync not in ('never', 'flush'):
+            self.fsync = float(self.fsync)  # Seconds between fsyncs
+        self.rotate_size = int(c['ROTATE_SIZE'])
+        self.rotate_interval = float(c['ROTATE_INTERVAL'])
+        self.compress = str(c['COMPRESS']) == '1'
+        self.file = None
+
+    def pending_count(self):
+        return(self.queue.qsize())
 
+    # Called from the MQTT callback threads.  Timestamp is taken now, formatting is left to the writer thread.
+    def submit(self, name, sourcefeed, payload):
+        self.queue.put((time.time(), name, sourcefeed, payload))
+
+    def open(self):
+        self.file = open(self.filename, 'a', 1048576)  #Append-only.  Large buffer, we decide when to flush
+        self.size = os.path.getsize(self.filename)
+        self.opened = time.time()
+
+    def run(self):
+        self.open()
+        buffered = 0
+        last_flush = last_sync = time.time()
+        while True:
+            timeout = max(0, last_flush + self.flush_interval - time.time())
+            try:
+                record = self.queue.get(True, timeout)
+            except queue.Empty:
+                record = None
+            # Take everything else that is already waiting while we are awake
+            records = []
+            while record is not None:
+                records.append(record)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            stopping = False
+            for record in records:
+                if record is self.STOP:   # Sent by close()
+                    stopping = True
+                    continue
+                timestring = datetime.datetime.fromtimestamp(record[0]).isoformat()
+                #  Human readable if desired
+                #line = "{0}\t{1}\t\t{2}\t\t{3}\n".format(timestring,record[1],record[2],record[3])
+                #  CSV format
+                line = "{0},{1},{2},{3}\n".format(timestring,record[1],record[2],record[3])
+                buffered += len(line)
+                self.size += len(line)
+                try:
+                    self.file.write(line)
+                except (IOError, OSError):
+                    logger.error('%s write error for %s: %s', str(sys.exc_info()[0]), self.filename, str(sys.exc_info()[1]))
+            now = time.time()
+            if buffered and (stopping or buffered >= self.flush_size or now - last_flush >= self.flush_interval):
+                buffered = 0
+                last_flush = now
+                try:
+                    self.file.flush()
+                    if self.fsync == 'flush' or (self.fsync != 'never' and now - last_sync >= self.fsync):
+                        os.fsync(self.file.fileno())
+                        last_sync = now
+                except (IOError, OSError):
+                    logger.error('%s flush error for %s: %s', str(sys.exc_info()[0]), self.filename, str(sys.exc_info()[1]))
+            elif not buffered:
+                last_flush = now  # Nothing waiting.  Don't spin on a zero timeout
+            if stopping:
+                break
+            if self.size and ((self.rotate_size and self.size >= self.rotate_size) or
+                              (self.rotate_interval and now - self.opened >= self.rotate_interval)):
+                self.rotate()
+                buffered = 0  # Written out by the close in rotate()
+        self.file.close()
+
+    # Close the current file, move it aside with a timestamp suffix and start a new one.
+    #  Compression is done in its own thread so writing can continue right away.
+    def rotate(self):
+        self.file.close()
+        rotated = self.filename + '.' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        count = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):  # Already rotated this second
+            rotated = '%s.%s.%d' % (self.filename, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), count)
+            count += 1
+        try:
+            os.rename(self.filename, rotated)
+        except OSError:
+            logger.error('%s rotate error for %s: %s', str(sys.exc_info()[0]), self.filename, str(sys.exc_info()[1]))
+        else:
+            logger.info('%s rotated %s -> %s', self.dest, self.filename, rotated)
+            if self.compress:
+                t = threading.Thread(target=compress_file, args=(rotated,), name='gzip-' + self.dest)
+                t.daemon = True
+                t.start()
+        self.open()
+
+    # Flush anything waiting and stop the thread
+    def close(self):
+        self.queue.put(self.STOP)
+        self.join(10)
+
+#gzip a rotated file and remove the original
+def compress_file(filename):
+  try:
+    with open(filename, 'rb') as src:
+      with gzip.open(filename + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(filename)
+  except (IOError, OSError):
+    logger.error('%s compress error for %s: %s', str(sys.exc_info()[0]), filename, str(sys.exc_info()[1]))
+
+# Queue a state update for a sqlite destination.  The actual write is done by that destination's SqliteWriter thread.
 def publish_sqldb(name, sourcefeed, dest, filename, payload):
-  # Apparently you need to create SQL files within the same thread
-  #  Therefore need to open DB file for each publish
-  #Setup SQL DB
-  dbconn = sqlite3.connect(settings_dict[dest]['FILENAME'])
+  now = time.time()
+  timestring = datetime.datetime.fromtimestamp(now).isoformat()  # Current timestamp. This is evil in python and should be easier
+  settings_dict[dest]['writer'].submit(name, sourcefeed, payload, timestring, now)
+
+#Prepare a sqlite DB file for use by a SqliteWriter.  Safe to run against an existing DB.
+def setup_sqldb(dbconn, history=False):
   sqldb = dbconn.cursor()
-  timestring = datetime.datetime.now().isoformat()  # Current timestamp. This is evil in python and should be easier
-  # Check to see if this feed already exists
-  sqldb.execute('SELECT * FROM states WHERE source_label=? and source_feed=?', (name, sourcefeed))
-  if sqldb.fetchone() is None:  # Fetchone reads the previous .execute output
-     # New entry
-     sqldb.execute('INSERT INTO states VALUES (?,?,?,?)', (name, sourcefeed, payload, timestring))
-  else:  
-     # If this source/feed entry already exists, do an update
-     sqldb.execute('UPDATE states SET value=?, last_timestamp=? WHERE source_feed=? and source_label=?', (payload, timestring, sourcefeed, name))
-  #Save (commit) the changes
+  # WAL lets readers (util/ scripts) query while we write, and makes commits much cheaper
+  sqldb.execute('PRAGMA journal_mode=WAL')
+  # Create 'states' table if it doesn't exist
+  sqldb.execute('''CREATE TABLE IF NOT EXISTS states
+            (source_label text, source_feed text, value text, last_timestamp text)'''
+  )
+  # Older versions could leave duplicate rows for a feed.  Keep the newest one so the unique index below can be built.
+  sqldb.execute('''DELETE FROM states WHERE rowid NOT IN
+            (SELECT MAX(rowid) FROM states GROUP BY source_label, source_feed)'''
+  )
+  # One row per source/feed.  Lets us do an atomic upsert instead of SELECT then INSERT/UPDATE
+  sqldb.execute('CREATE UNIQUE INDEX IF NOT EXISTS states_source ON states (source_label, source_feed)')
+  if history:
+    # Every value.  ts is seconds since the epoch.  number is the value as a number, or NULL if it isn't one
+    sqldb.execute('''CREATE TABLE IF NOT EXISTS history
+            (source_label text, source_feed text, ts real, value text, number real)'''
+    )
+    sqldb.execute('CREATE INDEX IF NOT EXISTS history_feed_ts ON history (source_label, source_feed, ts)')
+    # Summary of the numeric values per 'period' seconds (see history_periods), from 'bucket' (epoch seconds) on
+    sqldb.execute('''CREATE TABLE IF NOT EXISTS history_rollup
+            (source_label text, source_feed text, period integer, bucket real, count integer, min real, max real, sum real,
+             PRIMARY KEY (source_label, source_feed, period, bucket))'''
+    )
   dbconn.commit()
-  dbconn.close()
+
+history_maintenance = True  # Off in worker processes.  The supervisor does it once for all of them (see maintain_history())
+
+#Background writer for a 'sqlite' destination.
+# sqlite connections can only be used by the thread that created them, so this thread owns a single connection
+#  for the life of the process.  Repeated updates to the same feed are collapsed (last value wins), and everything
+#  waiting is committed in one transaction when BATCH_SIZE feeds are waiting or FLUSH_INTERVAL seconds have passed.
+# With HISTORY on, every value is also kept (not collapsed) and written in the same transaction, along with the
+#  history_rollup rows it falls in.  Old history is removed every HISTORY_MAINTENANCE seconds.
+class SqliteWriter(threading.Thread):
+    def __init__(self, name, c):
+        threading.Thread.__init__(self, name='sqlite-' + name)
+        self.daemon = True   # Don't hold up exit.  close() is called at exit to flush what is left
+        self.dest = name
+        self.filename = c['FILENAME']
+        self.batch_size = int(c['BATCH_SIZE'])
+        self.flush_interval = float(c['FLUSH_INTERVAL'])
+        self.history_on = str(c['HISTORY']) == '1'
+        self.keep_days = [('history', None, float(c['HISTORY_RAW_DAYS'])),
+                          ('history_rollup', 60, float(c['HISTORY_MINUTE_DAYS'])),
+                          ('history_rollup', 3600, float(c['HISTORY_HOUR_DAYS']))]
+        self.maintenance_interval = float(c['HISTORY_MAINTENANCE'])
+        self.history_max = int(c['HISTORY_BUFFER'])
+        self.pending = dict()   # (source_label, source_feed) -> (value, timestamp)
+        self.history = []       # (source_label, source_feed, ts, value) for every value, if HISTORY is on
+        self.dropped = 0        # History rows dropped because the DB stayed locked
+        self.cond = threading.Condition()
+        self.running = True
+
+    def pending_count(self):
+        return(len(self.pending) + len(self.history))
+
+    # Called from the MQTT callback threads.  Only holds the lock long enough to store the value.
+    def submit(self, name, sourcefeed, payload, timestring, ts):
+        with self.cond:
+            self.pending[(name, sourcefeed)] = (payload, timestring)
+            if self.history_on:
+                self.history.append((name, sourcefeed, ts, payload))
+            if len(self.pending) + len(self.history) >= self.batch_size:
+                self.cond.notify()
+
+    def run(self):
+        dbconn = sqlite3.connect(self.filename)
+        next_maintenance = time.time()
+        while True:
+            with self.cond:
+                if self.running and len(self.pending) + len(self.history) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                batch = self.pending
+                history = self.history
+                self.pending = dict()
+                self.history = []
+                running = self.running
+            if batch or history:
+                self.write(dbconn, batch, history)
+            if self.history_on and running and history_maintenance and time.time() >= next_maintenance:
+                self.maintain(dbconn)
+                next_maintenance = time.time() + self.maintenance_interval
+            if not running:
+                break
+        dbconn.close()
+
+    def write(self, dbconn, batch, history):
+        rows = [(key[0], key[1], value[0], value[1]) for key, value in batch.items()]
+        try:
+            dbconn.executemany('INSERT OR REPLACE INTO states VALUES (?,?,?,?)', rows)
+            if history:
+                self.write_history(dbconn, history)
+            dbconn.commit()
+        except sqlite3.Error:
+            # Probably locked by an outside reader.  Put the batch back (without overwriting newer values) and retry next flush
+            logger.error('%s write error for %s: %s.  Will retry.', str(sys.exc_info()[0]), self.dest, str(sys.exc_info()[1]))
+            try:
+                dbconn.rollback()
+            except sqlite3.Error:
+                pass
+            with self.cond:
+                for key in batch:
+                    if key not in self.pending:
+                        self.pending[key] = batch[key]
+                self.history[:0] = history
+                drop = len(self.history) - self.history_max
+                if drop > 0:  # Locked for a while.  Don't grow without limit
+                    del self.history[:drop]
+                    self.dropped += drop
+            if drop > 0:
+                logger.warning('%s: %s history rows dropped (%s total).  DB still locked, HISTORY_BUFFER is full.',
+                               self.dest, drop, self.dropped)
+        else:
+            logger.debug('%s committed %s rows, %s history rows', self.dest, len(rows), len(history))
+
+    # Insert the raw values, and add the numeric ones to their minute/hour history_rollup rows.
+    #  The rollup rows are summed here first, so each one is only touched once per batch.
+    def write_history(self, dbconn, history):
+        rows = []
+        buckets = dict()  # (source_label, source_feed, period, bucket) -> [count, min, max, sum]
+        for name, sourcefeed, ts, value in history:
+            try:
+                number = float(value)
+                if math.isnan(number) or math.isinf(number):
+                    number = None
+            except (TypeError, ValueError):  # Not a number.  Only kept raw
+                number = None
+            rows.append((name, sourcefeed, ts, value, number))
+            if number is None:
+                continue
+            for period in history_periods:
+                key = (name, sourcefeed, period, ts - ts % period)
+                b = buckets.get(key)
+                if b is None:
+                    buckets[key] = [1, number, number, number]
+                else:
+                    b[0] += 1
+                    b[1] = min(b[1], number)
+                    b[2] = max(b[2], number)
+                    b[3] += number
+        dbconn.executemany('INSERT INTO history VALUES (?,?,?,?,?)', rows)
+        # Create the rollup rows that don't exist yet, then add this batch to all of them
+        dbconn.executemany('INSERT OR IGNORE INTO history_rollup VALUES (?,?,?,?,0,?,?,0)',
+                           [key + (b[1], b[2]) for key, b in buckets.items()])
+        dbconn.executemany('''UPDATE history_rollup SET count=count+?, min=min(min,?), max=max(max,?), sum=sum+?
+                              WHERE source_label=? AND source_feed=? AND period=? AND bucket=?''',
+                           [tuple(b) + key for key, b in buckets.items()])
+
+    # Remove history older than the HISTORY_*_DAYS settings.  Done one feed at a time (feeds are listed in 'states'),
+    #  so the deletes use the indexes instead of scanning the whole table.
+    def maintain(self, dbconn):
+        start = time.time()
+        deleted = 0
+        try:
+            feeds = dbconn.execute('SELECT source_label, source_feed FROM states').fetchall()
+            for table, period, days in self.keep_days:
+                if days <= 0:  # Keep forever
+                    continue
+                cutoff = start - days * 86400
+                for name, sourcefeed in feeds:
+                    if period is None:
+                        cursor = dbconn.execute('DELETE FROM history WHERE source_label=? AND source_feed=? AND ts<?',
+                                                (name, sourcefeed, cutoff))
+                    else:
+                        cursor = dbconn.execute('''DELETE FROM history_rollup
+                                                   WHERE source_label=? AND source_feed=? AND period=? AND bucket<?''',
+                                                (name, sourcefeed, period, cutoff))
+                    deleted += cursor.rowcount
+            dbconn.commit()
+        except sqlite3.Error:
+            logger.error('%s history cleanup error for %s: %s', str(sys.exc_info()[0]), self.dest, str(sys.exc_info()[1]))
+            try:
+                dbconn.rollback()
+            except sqlite3.Error:
+                pass
+        else:
+            if deleted:
+                logger.info('%s removed %s old history rows in %.2f seconds', self.dest, deleted, time.time() - start)
+
+    # Flush anything waiting and stop the thread
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join(10)
 
 
 # Start instance of MQTT input client
+# MAX_RETRIES only applies here, at startup, to catch bad settings.  Once running, a lost connection is retried forever
+#  (see schedule_reconnect())
 def instance_start(c, name):
+ instance_create(c, name)
+ # Connect to servers
+ while True:   #Loop until complete or retry limit hit
+   try:
+     c['instance'].connect()  # Try to connect.  Some errors might be fatal.
+   except:  # Have only seen 'socket.errors', but could be other kinds
+     if c['RETRY_COUNTER'] > c['MAX_RETRIES']:
+       terminate(c['instance'])
+     logger.error('%s connect error for %s. Retry # %s', str(sys.exc_info()[0]), c['instance']._instance_name, str(c['RETRY_COUNTER']))
+     time.sleep(backoff_delay(c))  # Delay before retry
+     c['RETRY_COUNTER'] += 1;  # Iterate try
+   else:
+     # Connection Worked.  Reset counter and break loop
+     c['RETRY_COUNTER'] = 1;
+     break
+
+# Create instance of MQTT client, without connecting
+def instance_create(c, name):
  # Using 'c' instead of 'client' for easier reading/writing
  #Last field 'name' of client will be used to set '_instance_name' so we can read a unique name inside callback functions
  logger.info('Setting up instance and connecting: %s', name)
@@ -210,162 +1041,1703 @@ def instance_start(c, name):
  c['instance'].on_connect    = connected
  c['instance'].on_disconnect = disconnected
  c['instance'].on_message    = message
+ c['instance']._client.max_inflight_messages_set(int(c['INFLIGHT']))  # Send window for QOS 1/2
+ watch_publishes(c)
  #Setup TLS for basic connection encryption (like a web browser using HTTPS)
  # - You can probably do other TLS connection types like pre-shared key authentication if you modify this code and add setting variables
  # For Adafruit, just use normal OS CA lookup bundle file in /etc/ssl/certs/:  (Probably OS-dependent location)
  if c['TLS_SET'] == "1":
    logger.debug("Set TLS: %s", c['CACERT'])
    c['instance'].tls_set(c['CACERT'])  # If you need more of the TLS settings, feel free to add to config file and here.
- # Connect to servers
  # Need to convert these from strings to integers to use for counting
  c['RETRY_COUNTER'] = int(c['RETRY_COUNTER'])
  c['MAX_RETRIES'] = int(c['MAX_RETRIES'])
- while True:   #Loop until complete or retry limit hit
-   try:
-     c['instance'].connect()  # Try to connect.  Some errors might be fatal.
-   except:  # Have only seen 'socket.errors', but could be other kinds
-     if c['RETRY_COUNTER'] > c['MAX_RETRIES']:
-       logger.critical('Giving up retries to %s (%s).  Terminating process.', c['instance']._service_host, c['instance']._instance_name)
-       for name in settings_dict:
-        if 'instance' in settings_dict[name]:  #For each existing instance besides this one
-         settings_dict[name]['instance'].disconnect()  # Terminate instance
-       sys.exit(1)
-     logger.error('%s connect error for %s. Retry # %s', str(sys.exc_info()[0]), c['instance']._instance_name, str(c['RETRY_COUNTER']))
-     c['RETRY_COUNTER'] += 1;  # Iterate try
-     time.sleep(5)  # Delay before retry
-   else:
-     # Connection Worked.  Reset counter and break loop
-     c['RETRY_COUNTER'] = 1;
-     break
+
+# Broker confirmations go to the destination's Dispatcher, for publish tracking and the durable log.  Called when the
+#  client is created, and when a reload makes an instance that is already running a destination
+def watch_publishes(c):
+ if 'dispatcher' in c and 'instance' in c:
+   c['instance']._client.on_publish = c['dispatcher'].published
+
+# Start the client's network thread, and remember which thread it is so the main loop can watch it
+def instance_loop(c):
+ c['instance'].loop_background() # Start thread in background
+ c['thread'] = getattr(c['instance']._client, '_thread', None)  # Kept by paho's loop_start()
+
+# Seconds to wait before the next connect attempt.  Doubles with each failed attempt, up to BACKOFF_MAX.
+#  Randomized down to half of that, so instances that dropped together don't all retry together.
+def backoff_delay(c):
+ delay = min(float(c['BACKOFF_MAX']), float(c['BACKOFF_MIN']) * 2 ** min(max(c['RETRY_COUNTER'] - 1, 0), 30))
+ return(random.uniform(delay / 2, delay))
+
+# backoff_delay() for the next reconnect, counting it as a retry.  The delay keeps growing while connects fail, or
+#  connections drop soon after (a broker that takes the TCP connection, then refuses or drops us).  It only starts
+#  over from BACKOFF_MIN once a connection lasted STABLE_CONNECTION seconds.
+STABLE_CONNECTION = 60
+def next_backoff(c):
+ connected_at = c.pop('connected_at', None)  # Set by connected()
+ if connected_at is not None and time.time() - connected_at >= STABLE_CONNECTION:
+   c['RETRY_COUNTER'] = 1
+ delay = backoff_delay(c)
+ c['RETRY_COUNTER'] += 1
+ return(delay)
+
+# Reconnect an instance from a timer thread after a backoff delay.  Never blocks the caller.
+reconnect_lock = threading.Lock()
+def schedule_reconnect(name):
+ c = settings_dict[name]
+ with reconnect_lock:
+   if c.get('reconnecting'):  # Already waiting for a retry
+     return
+   c['reconnecting'] = True
+ delay = next_backoff(c)
+ logger.info('Reconnecting %s in %.1f seconds', name, delay)
+ timer_thread = threading.Timer(delay, reconnect, (name, c))
+ timer_thread.daemon = True
+ timer_thread.start()
+ c['reconnect_timer'] = timer_thread
+
+# c is the instance's settings when the reconnect was scheduled.  If a reload replaced or removed it since, stop here.
+def reconnect(name, c):
+ if c.get('stopped'):
+   return
+ c['instance']._client.loop_stop()  # Make sure the old network thread is gone before starting a new one
+ try:
+   c['instance'].connect()
+ except:
+   logger.error('%s connect error for %s. Retry # %s', str(sys.exc_info()[0]), name, str(c['RETRY_COUNTER']))
+   c['reconnecting'] = False
+   if not c.get('stopped'):
+     schedule_reconnect(name)
+ else:
+   instance_loop(c)
+   c['reconnecting'] = False
+
+# Out of retries for a client.  Disconnect everything and exit.
+def terminate(client):
+ logger.critical('Giving up retries to %s (%s).  Terminating process.', client._service_host, client._instance_name)
+ for name in list(settings_dict):
+  if 'instance' in settings_dict[name]:  #For each existing instance besides this one
+   settings_dict[name]['instance'].disconnect()  # Terminate instance
+ sys.exit(1)
 
 
 # Define callback handler functions.  Called when events happen.
 def connected(client):
     # Connected function will be called when the client is connected to MQTT source
+    if retired(client):
+      return
     logger.info('Connected to %s (%s) - Subscribing...', client._service_host, client._instance_name)
-    settings_dict[client._instance_name]['RETRY_COUNTER'] = 0;
+    settings_dict[client._instance_name]['connected_at'] = time.time()  # The backoff starts over if this lasts (see next_backoff())
+    settings_dict[client._instance_name]['connected'] = True
+    metric_connects.inc(client._instance_name)
+    if 'dispatcher' in settings_dict[client._instance_name]:  # Send anything buffered while we were down
+      settings_dict[client._instance_name]['dispatcher'].resume()
     # Subscribe to changes on feeds defined in config file
     if settings_dict[client._instance_name]['topic_map_dict'] == {}:
       logger.info(" No Subscriptions on this server.")
-    for feed in settings_dict[client._instance_name]['topic_map_dict']:  # Loop through output feeds for this topic
+    for feed in subscription_topics(client._instance_name):  # One subscribe per rule.  Wildcards cover many topics
       logger.info(' Subscribe to: %s - QOS: %s', feed, settings_dict[client._instance_name]['QOS'])
       client.subscribe(feed, int(settings_dict[client._instance_name]['QOS']))
     logger.info('')
 
 def disconnected(client):
     # Disconnected function will be called when the client disconnects.
-    time.sleep(1)  # In case disconnect is on purpose during exit, wait a second before retry
+    # This runs in the client's network thread, so don't wait or reconnect here.  Stop the thread (this also stops
+    #  paho's own reconnect loop) and let schedule_reconnect() retry from a timer thread with backoff.
+    if retired(client):  # Disconnected by a reload on purpose
+      return
+    settings_dict[client._instance_name]['connected'] = False
     logger.error('Disconnected from %s (%s)! Retrying...', client._service_host, client._instance_name)
+    metric_disconnects.inc(client._instance_name)
+    if 'dispatcher' in settings_dict[client._instance_name]:
+      settings_dict[client._instance_name]['dispatcher'].disconnected()
     logger.error('')
-    if settings_dict[client._instance_name]['RETRY_COUNTER'] == settings_dict[client._instance_name]['MAX_RETRIES']:
-       logger.critical('Giving up retries to %s (%s).  Terminating process.', client._service_host, client._instance_name)
-       for name in settings_dict: 
-        if 'instance' in settings_dict[name]:  #For each exiting instance besides this one
-         settings_dict[name]['instance'].disconnect()  # Terminate instance
-       sys.exit(1)
-    settings_dict[client._instance_name]['RETRY_COUNTER'] += 1;
-    time.sleep(5)
-    client.connect()  # Try to reconnect.  Some things are always fatal
+    client._client.loop_stop()
+    schedule_reconnect(client._instance_name)
+
+# Client that a reload stopped, or replaced with a new one.  Its callbacks must leave settings_dict alone
+def retired(client):
+    c = settings_dict.get(client._instance_name)
+    return(c is None or c.get('instance') is not client or bool(c.get('stopped')))
 
 def message(client, feed_id, payload):
     # Message function will be called when a subscribed feed has a new value.
     # The feed_id parameter identifies the feed, and the payload parameter has the value
-    logger.info('%-12s <- Receive: (%s) - %s', client._instance_name, feed_id, payload)
+    # Logging every message is expensive.  Only build the log lines if INFO is turned on.
+    log_info = logger.isEnabledFor(logging.INFO)
+    if log_info:
+      logger.info('%-12s <- Receive: (%s) - %s', client._instance_name, feed_id, payload)
+    metric_received.inc(client._instance_name)
     # Search for output mapping rules:
+    start = timer()
     outgoing_topics = search_map(client._instance_name, feed_id)
-    if outgoing_topics != "":
-      for dest,dtopic in outgoing_topics:  # For each destination defined.  Can have multiple
-       if settings_dict[dest]['TOPIC_FMT'] == 'file':   # If FILE output
-         logger.info('%-12s -> Publish: (%s) - %s', dest, settings_dict[dest]['FILENAME'], payload)
-         publish_file(client._instance_name, feed_id, dest, settings_dict[dest]['FILENAME'], payload)
-       elif settings_dict[dest]['TOPIC_FMT'] == 'sqlite':   # If SQL DB output
-         logger.info('%-12s -> Publish: (%s) - %s', dest, settings_dict[dest]['FILENAME'], payload)
-         publish_sqldb(client._instance_name, feed_id, dest, settings_dict[dest]['FILENAME'], payload)
-       else:  #If MQTT/Adafruit output
-         logger.info('%-12s -> Publish: (%s) - %s', dest, dtopic, payload)
-         settings_dict[dest]['instance'].publish(dtopic, payload, int(settings_dict[dest]['QOS']))
-    logger.info('')
-    logger.info('')
+    metric_search_seconds.observe(timer() - start, client._instance_name)
+    if value_cache is not None and outgoing_topics:
+      value_cache.set(client._instance_name, feed_id, payload)
+    now = None
+    for dest,dtopic,route_filter in outgoing_topics:  # For each destination defined.  Can have multiple
+      item = (client._instance_name, feed_id, dtopic, payload)
+      if route_filter is not None:  # ON_CHANGE, DEADBAND, MIN_INTERVAL or MAX_RATE on this route
+        now = now or time.time()
+        if not route_filter.allow(item, now):
+          continue
+      # Hand off to the destination's dispatch queue.  Publishing happens in that destination's worker thread(s)
+      settings_dict[dest]['dispatcher'].put(item)
+    if log_info:
+      logger.info('')
+
+# Publish a message to a destination.  Called from the destination's Dispatcher worker threads.
+def deliver(dest, name, feed_id, dtopic, payload):
+    start = timer()
+    if settings_dict[dest]['TOPIC_FMT'] == 'file':   # If FILE output
+      logger.info('%-12s -> Publish: (%s) - %s', dest, settings_dict[dest]['FILENAME'], payload)
+      publish_file(name, feed_id, dest, settings_dict[dest]['FILENAME'], payload)
+      metric_publish_seconds.observe(timer() - start, dest, 'file')
+    elif settings_dict[dest]['TOPIC_FMT'] == 'sqlite':   # If SQL DB output
+      logger.info('%-12s -> Publish: (%s) - %s', dest, settings_dict[dest]['FILENAME'], payload)
+      publish_sqldb(name, feed_id, dest, settings_dict[dest]['FILENAME'], payload)
+      metric_publish_seconds.observe(timer() - start, dest, 'sqlite')
+    else:  #If MQTT/Adafruit output
+      logger.info('%-12s -> Publish: (%s) - %s', dest, dtopic, payload)
+      settings_dict[dest]['instance'].publish(dtopic, payload, int(settings_dict[dest]['QOS']))
+      metric_publish_seconds.observe(timer() - start, dest, 'mqtt')
+
+#Bounded queue and worker thread(s) for one destination.
+# message() only puts into the queue.  Workers call deliver().  When the queue is full the OVERFLOW setting decides
+#  whether the receiving thread waits, or the oldest/newest message is dropped (and counted).
+# With DURABLE_DIR set (MQTT destinations only), each message is also logged by a DurableQueue before it is queued,
+#  and carries its log sequence number as a 5th item until the broker confirms it.
+# MQTT destinations also have a PublishTracker, which counts broker confirmations and holds the workers back at
+#  MAX_QUEUED, and a Batcher if BATCH_INTERVAL is set.
+class Dispatcher(object):
+    STOP = object()  # Queued by close(), one per worker
+
+    def __init__(self, name, c):
+        self.dest = name
+        self.c = c
+        self.queue = queue.Queue(int(c['DISPATCH_QUEUE_SIZE']))
+        self.overflow = c['OVERFLOW']
+        self.lock = threading.Lock()
+        # Counters.  Read by dispatch_stats()
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.durable = None
+        self.outage = None
+        self.tracker = None
+        self.batcher = None
+        self.publish_lock = threading.Lock()
+        self.retired = False    # Set by retire(), once a reload replaced or removed this destination
+        self.successor = None   # The Dispatcher that replaced it.  put() passes messages on to it
+        if c['TOPIC_FMT'] not in ('file', 'sqlite'):  # Broker destinations can be disconnected
+            if c['DURABLE_DIR']:
+                self.durable = DurableQueue(name, c, self.requeue)
+            self.outage = OutageBuffer(self, c)
+            self.tracker = PublishTracker(name, c)
+            if float(c['BATCH_INTERVAL']) > 0:
+                self.batcher = Batcher(c)
+        self.threads = []
+        for i in range(int(c['DISPATCH_WORKERS'])):
+            t = threading.Thread(target=self.work, name='dispatch-%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    # Called from the MQTT callback threads
+    def put(self, item):
+        if self.retired:  # Looked up before a reload swapped in the new one
+            self.pass_on(item)
+            return
+        if self.durable is not None:
+            item = item + (self.durable.append(item),)
+        if self.overflow == 'block':
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                with self.lock:
+                    if self.overflow == 'drop-newest':
+                        self.dropped += 1
+                        self.discard(item)
+                        return
+                    while True:  # drop-oldest.  Make room, but another thread may beat us to it
+                        try:
+                            self.discard(self.queue.get_nowait())
+                            self.dropped += 1
+                        except queue.Empty:
+                            pass
+                        try:
+                            self.queue.put_nowait(item)
+                            break
+                        except queue.Full:
+                            continue
+        with self.lock:
+            self.enqueued += 1
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def work(self):
+        batcher = self.batcher
+        while True:
+            if batcher is None:
+                item = self.queue.get()
+            else:
+                try:
+                    item = self.queue.get(True, batcher.wait())
+                except queue.Empty:  # BATCH_INTERVAL is up
+                    self.send_batch(batcher.take())
+                    continue
+            if item is self.STOP:
+                if batcher is not None:
+                    self.send_batch(batcher.take())
+                break
+            if batcher is not None:  # An outage holds whole batches (see send_batch()), so everything goes to BATCH_TOPIC
+                self.send_batch(batcher.add(item))
+                continue
+            if self.outage is not None and self.outage.hold(item):  # Destination is down.  Buffered for later (and sent one by one)
+                continue
+            self.send(item)
+
+    # count is the number of messages in item, for batches
+    def send(self, item, count=1):
+        try:
+            if self.tracker is None:  # File or DB
+                deliver(self.dest, *item)
+            else:
+                self.tracker.wait_room(settings_dict[self.dest])
+                # One publish at a time, so the message id we read back is the one paho gave this message
+                with self.publish_lock:
+                    deliver(self.dest, *item[:4])
+                    mid = publish_mid(settings_dict[self.dest]['instance'])
+                    self.tracker.sent(mid)
+                    if self.durable is not None:
+                        self.durable.sent(mid, item)
+        except Exception:
+            with self.lock:
+                self.failed += count
+            self.discard(item)  # Counted and logged like any other failed publish.  Not retried.
+            logger.error('%s publish error for %s: %s', str(sys.exc_info()[0]), self.dest, str(sys.exc_info()[1]))
+        else:
+            with self.lock:
+                self.delivered += count
+
+    # (item, count) from the Batcher, or None if there is nothing to send yet.  While the destination is down (or
+    #  the outage buffer is still draining) the batch is held as one message, and sent as it is later
+    def send_batch(self, batch):
+        if batch is None:
+            return
+        if self.outage is not None and self.outage.hold(batch[0]):
+            return
+        self.send(*batch)
+
+    # paho's on_publish.  Runs in the network thread
+    def published(self, mqttc, userdata, mid):
+        self.tracker.published(mid)
+        if self.durable is not None:
+            self.durable.published(mqttc, userdata, mid)
+
+    # A message was dropped or failed.  Don't keep it in the durable log to be sent again next run.
+    def discard(self, item):
+        if self.durable is not None and item is not self.STOP:
+            self.durable.done(item[4])
+
+    # Logged messages the broker didn't confirm (see DurableQueue).  Sent again, ahead of anything buffered
+    def requeue(self, items):
+        self.outage.requeue(items)
+
+    # Destination disconnected
+    def disconnected(self):
+        if self.durable is not None:
+            self.durable.disconnected()
+
+    # Destination (re)connected.  Start sending what was buffered.
+    def resume(self):
+        if self.tracker is not None:
+            self.tracker.reconnected()
+        if self.outage is not None:
+            self.outage.resume()
+
+    # Publish whatever is still queued, then stop the workers.  With handover (a reload is replacing this destination
+    #  with one that doesn't replay the same durable log), what is still buffered for it is returned, oldest first,
+    #  for the new Dispatcher's adopt(), instead of being saved for the next run or lost
+    def close(self, handover=False):
+        for t in self.threads:
+            self.queue.put(self.STOP)
+        for t in self.threads:
+            t.join(10)
+        wait = 5 if self.c.get('connected') else 0
+        held = []
+        if handover and self.outage is not None:
+            if self.durable is not None:
+                self.durable.settle(wait)
+                held = sorted(self.durable.unconfirmed() + self.outage.take(), key=lambda item: item[4])
+                for item in held:  # The new one has them now.  Don't send them again from this log
+                    self.durable.done(item[4])
+            else:
+                held = self.outage.take()
+        if self.outage is not None:
+            self.outage.close()
+        if self.durable is not None:
+            self.durable.close(wait)
+        return(held)
+
+    # Messages held by the Dispatcher this one replaced (see close()).  Buffered until this destination connects
+    def adopt(self, items):
+        for item in items:
+            item = item[:4]
+            if self.durable is not None:
+                item = item + (self.durable.append(item),)
+            if self.outage is None or not self.outage.hold(item):
+                self.queue.put(item)
+        with self.lock:
+            self.enqueued += len(items)
+
+    # After close(), once a reload replaced this destination with successor (or removed it, successor None).
+    #  Messages that still reach it, from threads that looked it up before the swap or were waiting for room in the
+    #  queue (OVERFLOW block), are passed on until it has been quiet for a while
+    def retire(self, successor):
+        self.successor = successor
+        self.retired = True
+        in_background(self.pass_queued)
+
+    def pass_queued(self):
+        while True:
+            try:
+                item = self.queue.get(True, 10)
+            except queue.Empty:
+                return
+            if item is not self.STOP:
+                self.pass_on(item)
+
+    def pass_on(self, item):
+        if self.successor is not None:
+            self.successor.put(item[:4])
+            return
+        with self.lock:
+            self.dropped += 1
+        logger.warning('%s: message for %s dropped.  No rule sends to it any more.', self.dest, item[2])
+
+#Publishes to one MQTT destination that the broker hasn't confirmed yet.
+# paho sends up to INFLIGHT QOS 1/2 messages without waiting for their PUBACK/PUBCOMP, and queues the rest inside
+#  the client.  With MAX_QUEUED set, dispatch workers wait once that many messages are in the client, so the rest
+#  wait in the dispatch queue instead, where OVERFLOW and the outage buffer apply.
+# Also counts confirmations, and times them from publish() (mqtt_repeater_publish_complete_seconds).  on_publish can
+#  come before sent() for QOS 0 and fast brokers, like DurableQueue.
+# A confirmation that never comes (or whose message id paho hands out again) must not hold a MAX_QUEUED slot for
+#  good, so entries older than ACK_TIMEOUT are dropped, and all of them on a reconnect.
+class PublishTracker(object):
+    early_window = 1.0   # Seconds an on_publish that beat sent() is kept for it
+
+    def __init__(self, name, c):
+        self.dest = name
+        self.qos = int(c['QOS'])
+        self.max_queued = int(c['MAX_QUEUED'])
+        self.ack_timeout = float(c['ACK_TIMEOUT'])
+        self.cond = threading.Condition()
+        self.times = dict()   # mid -> timer() when published
+        self.early = dict()   # mid -> timer() when on_publish arrived before sent()
+        self.completed = 0
+        self.next_expire = timer() + 1
+
+    # Called by the dispatch workers before publishing.  Returns straight away while disconnected (paho queues
+    #  the message until it is back), or if MAX_QUEUED is 0
+    def wait_room(self, c):
+        if not self.max_queued:
+            return
+        with self.cond:
+            while len(self.times) >= self.max_queued and c.get('connected'):
+                self.cond.wait(1)
+                self.expire(timer())
+
+    # Called with the dispatcher's publish_lock held, straight after publish()
+    def sent(self, mid):
+        now = timer()
+        with self.cond:
+            early = self.early.pop(mid, None)
+            if early is not None and now - early < self.early_window:
+                self.completed += 1
+                metric_complete_seconds.observe(0.0, self.dest)
+            else:
+                self.times[mid] = now  # Replaces an entry for the same mid, if paho reused it before the confirmation came
+            if now >= self.next_expire:
+                self.expire(now)
+
+    def published(self, mid):
+        now = timer()
+        with self.cond:
+            start = self.times.pop(mid, None)
+            if start is None:
+                self.early[mid] = now
+                return
+            self.completed += 1
+            self.cond.notify()
+        metric_complete_seconds.observe(now - start, self.dest)
+
+    # Forget confirmations that aren't coming.  Called with self.cond held, at most once a second
+    def expire(self, now):
+        self.next_expire = now + 1
+        lost = [mid for mid, start in self.times.items() if now - start >= self.ack_timeout]
+        for mid in lost:
+            del self.times[mid]
+        for mid in [mid for mid, when in self.early.items() if now - when >= self.early_window]:
+            del self.early[mid]
+        if lost:
+            self.cond.notify_all()
+            logger.warning('%s: %s publishes not confirmed by the broker after %s seconds', self.dest, len(lost), self.ack_timeout)
+
+    # QOS 0 messages that were waiting are gone after a reconnect, and whether QOS 1/2 ones are confirmed depends on
+    #  the broker keeping the session.  Start counting over rather than wait on confirmations that may never come
+    def reconnected(self):
+        with self.cond:
+            self.times.clear()
+            self.early.clear()
+            self.cond.notify_all()
+
+    def __len__(self):
+        return(len(self.times))
+
+#Collects the messages for an MQTT destination with BATCH_INTERVAL set, and turns them into one JSON message to
+# BATCH_TOPIC every BATCH_INTERVAL seconds (or sooner, once there are BATCH_MAX).  BATCH_FORMAT:
+#  object:  {"<destination topic>": "<payload>", ...}  The latest payload of each topic
+#  list:    [{"topic": "<destination topic>", "value": "<payload>", "timestamp": "<ISO time>"}, ...]  Every message
+# Shared by the destination's dispatch workers.
+class Batcher(object):
+    def __init__(self, c):
+        self.interval = float(c['BATCH_INTERVAL'])
+        self.topic = c['BATCH_TOPIC']
+        self.format = c['BATCH_FORMAT']
+        self.max = int(c['BATCH_MAX'])
+        self.lock = threading.Lock()
+        self.items = None
+        self.count = 0
+        self.due = None   # timer() when the batch being collected is to be sent
+        self.encode = json.JSONEncoder(check_circular=False, separators=(',', ':')).encode
+
+    # Seconds a dispatch worker should wait for the next message, before sending the batch
+    def wait(self):
+        due = self.due
+        if due is None:
+            return(None)
+        return(max(due - timer(), 0.001))
+
+    # Returns (batch item, message count) if the batch is ready to send, else None
+    def add(self, item):
+        with self.lock:
+            if self.items is None:
+                self.items = collections.OrderedDict() if self.format == 'object' else []
+                self.due = timer() + self.interval
+            if self.format == 'object':
+                self.items.pop(item[2], None)  # Keep topics in the order of their latest message
+                self.items[item[2]] = item[3]
+            else:
+                self.items.append({'topic': item[2], 'value': item[3],
+                                   'timestamp': datetime.datetime.now().isoformat()})
+            self.count += 1
+            if self.count < self.max and timer() < self.due:
+                return(None)
+            return(self.take_locked())
+
+    # The batch so far, or None if it is empty
+    def take(self):
+        with self.lock:
+            return(self.take_locked())
+
+    def take_locked(self):
+        if self.items is None:
+            return(None)
+        batch = (('', '', self.topic, self.encode(self.items)), self.count)
+        self.items = None
+        self.count = 0
+        self.due = None
+        return(batch)
+
+#Holds messages for a broker destination while it is disconnected, and sends them once it is back.
+# Up to BUFFER_SIZE messages are kept in memory.  Past that they go to a spill file in BUFFER_SPILL_DIR if set,
+#  otherwise the oldest is dropped.  After reconnecting, a drain thread sends them in order.
+#  New messages are held behind them until the buffer is empty, so order is kept.  DRAIN_RATE (if set) only limits
+#  the backlog from the outage:  each new message held while connected lets one more go without waiting, so the
+#  buffer still empties when new messages come faster than DRAIN_RATE.
+# A spill file left over at startup (including whatever was still in memory at exit) is sent once connected.
+# With a DurableQueue, the spill file is only overflow space.  Anything not confirmed at exit is in the durable log,
+#  and is replayed from there (ahead of new messages) once connected.
+class OutageBuffer(object):
+    def __init__(self, dispatcher, c):
+        self.dispatcher = dispatcher
+        self.dest = dispatcher.dest
+        self.c = c
+        self.size = int(c['BUFFER_SIZE'])
+        self.rate = float(c['DRAIN_RATE'])
+        self.memory = collections.deque()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.draining = False
+        self.live = 0           # Messages held while connected, not yet made up for in drain()
+        self.spill_file = None
+        self.spill_out = None   # Open for appending while there are spilled messages
+        self.spilled = 0        # Messages in the spill file that haven't been read back
+        self.spill_pos = 0      # Where to read the next one from
+        self.replay = None      # Messages from the durable log left over from the last run
+        self.replay_left = 0
+        if dispatcher.durable is not None and dispatcher.durable.replay_count:
+            self.replay = dispatcher.durable.replay()
+            self.replay_left = dispatcher.durable.replay_count
+        spill_dir = c['BUFFER_SPILL_DIR']
+        if dispatcher.durable is not None:
+            spill_dir = spill_dir or dispatcher.durable.dir  # Never drop messages that are in the durable log
+        if spill_dir:
+            self.spill_file = os.path.join(spill_dir, self.dest + '.spill')
+            if dispatcher.durable is not None and os.path.exists(self.spill_file):
+                os.remove(self.spill_file)  # Already in the durable log
+            if os.path.exists(self.spill_file):
+                with open(self.spill_file, 'rb') as f:
+                    self.spilled = sum(1 for line in f)
+                if self.spilled:
+                    logger.warning('%s: %s buffered messages from last run.  Sending once connected.', self.dest, self.spilled)
+
+    def __len__(self):
+        return(len(self.memory) + self.spilled + self.replay_left)
+
+    # Called from the dispatch workers.  Returns True if the message was buffered instead of being sent now.
+    def hold(self, item):
+        with self.lock:
+            if self.c.get('connected') and not self.draining and not self.memory and not self.spilled and self.replay is None:
+                return(False)  # drain() may still be sending the last one it took.  Anything new goes behind it
+            if self.spill_file is not None and (self.spilled or len(self.memory) >= self.size):
+                self.spill(item)
+            else:
+                if len(self.memory) >= self.size:
+                    self.dispatcher.discard(self.memory.popleft())
+                    self.dropped += 1
+                self.memory.append(item)
+            if self.c.get('connected'):  # Still draining from the last outage
+                self.live += 1
+                self.start_drain()
+            return(True)
+
+    def resume(self):
+        with self.lock:
+            self.start_drain()
+
+    # Messages to send again, oldest first.  They go ahead of everything held
+    def requeue(self, items):
+        with self.lock:
+            self.memory.extendleft(reversed(items))
+            if self.c.get('connected'):
+                self.start_drain()
+
+    def start_drain(self):  # Called with self.lock held
+        if self.draining or not len(self):
+            return
+        self.draining = True
+        t = threading.Thread(target=self.drain, name='drain-' + self.dest)
+        t.daemon = True
+        t.start()
+
+    def drain(self):
+        logger.info('%s: sending %s buffered messages', self.dest, len(self))
+        interval = 1.0 / self.rate if self.rate else 0
+        while True:
+            with self.lock:
+                if not self.c.get('connected'):  # Down again.  Keep the rest for next time
+                    self.draining = False
+                    self.live = 0
+                    return
+                item = None
+                if self.replay is not None:  # Oldest first
+                    item = next(self.replay, None)
+                    if item is None:
+                        self.replay = None
+                        self.replay_left = 0
+                    else:
+                        self.replay_left = max(self.replay_left - 1, 0)
+                if item is None:
+                    if not self.memory and self.spilled:
+                        self.unspill()
+                    if not self.memory:
+                        self.draining = False
+                        self.live = 0
+                        return
+                    item = self.memory.popleft()
+                live = self.live
+                self.live = max(live - 1, 0)
+            self.dispatcher.send(item)
+            if interval and not live:
+                time.sleep(interval)
+
+    def spill(self, item):  # Called with self.lock held
+        if self.spill_out is None:
+            self.spill_out = open(self.spill_file, 'ab')
+        self.spill_out.write((json.dumps(list(item)) + '\n').encode('utf-8'))
+        self.spilled += 1
+
+    # Read the next block of spilled messages back into memory.  Called with self.lock held
+    def unspill(self):
+        if self.spill_out is not None:
+            self.spill_out.flush()
+        with open(self.spill_file, 'rb') as f:
+            f.seek(self.spill_pos)
+            while len(self.memory) < self.size and self.spilled:
+                line = f.readline()
+                if not line:  # Shouldn't happen, but don't spin if the file was changed under us
+                    self.spilled = 0
+                    break
+                self.memory.append(tuple(json.loads(line.decode('utf-8'))))
+                self.spilled -= 1
+            self.spill_pos = f.tell()
+        if not self.spilled:  # All read back.  Start over with an empty file next time
+            if self.spill_out is not None:
+                self.spill_out.close()
+                self.spill_out = None
+            os.remove(self.spill_file)
+            self.spill_pos = 0
+
+    # A reload is replacing this destination.  Returns everything held, oldest first, and keeps none of it
+    def take(self):
+        with self.lock:
+            items = []
+            if self.replay is not None:
+                items.extend(self.replay)
+                self.replay = None
+                self.replay_left = 0
+            while self.memory or self.spilled:
+                items.extend(self.memory)
+                self.memory.clear()
+                if self.spilled:
+                    self.unspill()
+            return(items)
+
+    # At exit.  Save anything still in memory to the spill file (ahead of what is already spilled), so it is sent next run
+    def close(self):
+        with self.lock:
+            if self.dispatcher.durable is not None:  # Still in the durable log.  Sent from there next run
+                if self.spill_out is not None:
+                    self.spill_out.close()
+                if self.spilled:
+                    os.remove(self.spill_file)
+                return
+            if self.spill_file is None:
+                if self.memory:
+                    logger.warning('%s: %s buffered messages lost at exit.  Set BUFFER_SPILL_DIR to keep them.', self.dest, len(self.memory))
+                return
+            if not self.memory:
+                if self.spill_out is not None:
+                    self.spill_out.close()
+                return
+            lines = [(json.dumps(list(item)) + '\n').encode('utf-8') for item in self.memory]
+            if self.spill_out is not None:
+                self.spill_out.close()
+            if self.spilled:
+                with open(self.spill_file, 'rb') as f:
+                    f.seek(self.spill_pos)
+                    lines.extend(f.readlines())
+            with open(self.spill_file + '.tmp', 'wb') as f:
+                f.writelines(lines)
+            os.rename(self.spill_file + '.tmp', self.spill_file)
+            logger.warning('%s: saved %s buffered messages to %s', self.dest, len(lines), self.spill_file)
+
+#Message id paho gave the last publish() on this client.  The Adafruit_IO client keeps it in _pub_mid.
+def publish_mid(client):
+    mid = getattr(client, '_pub_mid', None)
+    if mid is None:
+        mid = client._client._last_mid
+    return(mid)
+
+#Append-only log of the messages sent to one MQTT destination, so they survive a crash or restart.
+# Messages are appended (and flushed to the OS) in put(), before the source's QOS ack goes back.  A syncer thread
+#  fsyncs every DURABLE_SYNC seconds instead of on every message.
+# A message is done when paho's on_publish fires for it (the broker's PUBACK/PUBCOMP, or sent for QOS 0), or when it
+#  is dropped or fails to publish.  The syncer writes the lowest sequence number not done yet to a checkpoint file,
+#  and removes log files that are entirely below it.
+# A message still waiting for on_publish after DURABLE_ACK_TIMEOUT seconds, or when the connection drops, or whose
+#  message id paho hands out again, is given back to the dispatcher (requeue) and sent again.  So a lost confirmation
+#  can't hold the checkpoint back for good.  A late confirmation for the old message id is ignored.
+# At startup everything from the checkpoint on is replayed (see OutageBuffer).  Messages done out of order just
+#  before a crash can be sent twice.  Nothing that was logged is lost.
+# Files:  DURABLE_DIR/<name>/<first seq>.log  (one JSON list per line:  [seq, source, feed, topic, payload]) and checkpoint
+class DurableQueue(object):
+    early_window = 1.0   # Seconds an on_publish that beat sent() is kept for it.  Older ones are for messages sent again
+
+    def __init__(self, name, c, requeue):
+        self.dest = name
+        self.dir = os.path.join(c['DURABLE_DIR'], name)
+        self.sync_interval = float(c['DURABLE_SYNC'])
+        self.segment_size = int(c['DURABLE_SEGMENT_SIZE'])
+        self.ack_timeout = float(c['DURABLE_ACK_TIMEOUT'])
+        self.requeue = requeue
+        self.lock = threading.Lock()       # The log file and order
+        self.ack_lock = threading.Lock()   # acked, mids and early
+        self.sync_lock = threading.Lock()  # One sync() at a time.  close() calls it too
+        self.order = collections.deque()   # Sequence numbers not done yet, oldest first.  Some may be in acked
+        self.acked = set()
+        self.mids = dict()                 # paho message id -> (item, time.time() sent), waiting for on_publish
+        self.early = dict()                # paho message id -> time.time() on_publish arrived before sent() was called
+        self.retired = []                  # Full log files, fsynced and closed by the syncer
+        self.encode = json.JSONEncoder(check_circular=False, separators=(',', ':')).encode  # Quicker than json.dumps()
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self.low = self.read_checkpoint()
+        self.segments = sorted(int(f[:-4]) for f in os.listdir(self.dir) if f.endswith('.log'))
+        self.next_seq = self.low
+        for start in self.segments:
+            self.scan(start)
+        self.replay_end = self.next_seq
+        self.replay_count = len(self.order)
+        self.replay_from = self.low
+        self.replay_segments = list(self.segments)
+        self.trim()
+        self.open(self.next_seq)
+        if self.replay_count:
+            logger.warning('%s: %s messages in the durable log from last run.  Sending once connected.', self.dest, self.replay_count)
+        self.stopping = threading.Event()
+        self.syncer = threading.Thread(target=self.sync_loop, name='durable-' + name)
+        self.syncer.daemon = True
+        self.syncer.start()
+
+    def path(self, start):
+        return(os.path.join(self.dir, '%020d.log' % start))
+
+    def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.dir, 'checkpoint')) as f:
+                return(int(f.read().strip()))
+        except (IOError, OSError, ValueError):  # First run, or cut short by a crash.  Replay everything still logged
+            return(0)
+
+    def write_checkpoint(self, low):
+        filename = os.path.join(self.dir, 'checkpoint')
+        with open(filename + '.tmp', 'w') as f:
+            f.write('%d\n' % low)
+        os.rename(filename + '.tmp', filename)
+
+    # Read one log file at startup.  Remembers the messages at or after the checkpoint, and cuts off a partly written
+    #  last line.
+    def scan(self, start):
+        good = 0
+        with open(self.path(start), 'rb') as f:
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'):  # End of file, or a partly written line
+                    break
+                try:
+                    seq = json.loads(line.decode('utf-8'))[0]
+                except ValueError:
+                    break
+                good += len(line)
+                if seq >= self.low:
+                    self.order.append(seq)
+                self.next_seq = max(self.next_seq, seq + 1)
+        if os.path.getsize(self.path(start)) > good:
+            logger.warning('%s: discarding damaged end of %s', self.dest, self.path(start))
+            with open(self.path(start), 'r+b') as f:
+                f.truncate(good)
+
+    def open(self, start):
+        self.out = open(self.path(start), 'ab')
+        self.size = os.path.getsize(self.path(start))
+        self.dirty = False
+        if not self.segments or self.segments[-1] != start:
+            self.segments.append(start)
+
+    # Log a message.  Returns its sequence number (None once closed).  Called from the MQTT callback threads
+    def append(self, item):
+        body = self.encode(item)[1:]  # Encode outside the lock.  The sequence number goes in front once we have it
+        with self.lock:
+            if self.out.closed:  # Raced with a reload closing this destination.  Dispatcher.retire() passes it on
+                return(None)
+            seq = self.next_seq
+            self.next_seq += 1
+            line = ('[%d,%s\n' % (seq, body)).encode('utf-8')
+            self.out.write(line)
+            self.out.flush()  # Into the OS now, so a crash of this process doesn't lose it.  fsync comes later
+            self.size += len(line)
+            self.dirty = True
+            self.order.append(seq)
+            if self.size >= self.segment_size:
+                self.retired.append(self.out)
+                self.open(self.next_seq)
+            return(seq)
+
+    # Published.  Called with the dispatcher's publish_lock held, straight after publish() returned this message's mid
+    def sent(self, mid, item):
+        now = time.time()
+        with self.ack_lock:
+            early = self.early.pop(mid, None)
+            if early is not None and now - early < self.early_window:
+                self.acked.add(item[4])
+                return
+            lost = self.mids.get(mid)
+            self.mids[mid] = (item, now)
+        if lost is not None:  # paho is on to the same message id again.  The old one's confirmation never came
+            self.resend([lost[0]])
+
+    # paho's on_publish.  Runs in the network thread, and can beat sent() for fast brokers and QOS 0
+    def published(self, mqttc, userdata, mid):
+        with self.ack_lock:
+            entry = self.mids.pop(mid, None)
+            if entry is None:
+                self.early[mid] = time.time()
+            else:
+                self.acked.add(entry[0][4])
+
+    # The connection dropped.  Send everything waiting for on_publish again once it is back
+    def disconnected(self):
+        self.resend(self.unconfirmed())
+
+    # Everything still waiting for on_publish.  It won't come for these now
+    def unconfirmed(self):
+        with self.ack_lock:
+            items = [item for item, when in self.mids.values()]
+            self.mids.clear()
+            self.early.clear()
+        return(items)
+
+    # Waiting too long for on_publish.  Called by the syncer
+    def expire(self):
+        now = time.time()
+        with self.ack_lock:
+            lost = [mid for mid, (item, when) in self.mids.items() if now - when >= self.ack_timeout]
+            items = [self.mids.pop(mid)[0] for mid in lost]
+            for mid in [mid for mid, when in self.early.items() if now - when >= self.early_window]:
+                del self.early[mid]
+        self.resend(items)
+
+    def resend(self, items):
+        if items:
+            logger.warning('%s: %s messages not confirmed by the broker.  Sending them again.', self.dest, len(items))
+            self.requeue(sorted(items, key=lambda item: item[4]))
+
+    # Dropped or failed.  Nothing more to do with it
+    def done(self, seq):
+        with self.ack_lock:
+            self.acked.add(seq)
+
+    def unacked(self):
+        return(len(self.order) - len(self.acked))
+
+    # Lines of the log files from last run, from the checkpoint on.  Read by OutageBuffer.drain()
+    def replay(self):
+        for start in self.replay_segments:
+            try:
+                f = open(self.path(start), 'rb')
+            except (IOError, OSError):  # All done and removed already
+                continue
+            with f:
+                for line in f:
+                    record = json.loads(line.decode('utf-8'))
+                    if record[0] >= self.replay_end:
+                        return
+                    if record[0] >= self.replay_from:
+                        yield tuple(record[1:]) + (record[0],)
+
+    # Remove log files with nothing left to send.  Called with self.lock held, or before the syncer starts
+    def trim(self):
+        while len(self.segments) > 1 and self.segments[1] <= self.low:
+            os.remove(self.path(self.segments.pop(0)))
+
+    # fsync what was written, then move the checkpoint up past everything done.  Returns True if anything is left
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                retired = self.retired
+                current = self.out if self.dirty else None
+                self.retired = []
+                self.dirty = False
+            for f in retired:  # Don't hold up append() while the disk works
+                os.fsync(f.fileno())
+                f.close()
+            if current is not None:
+                os.fsync(current.fileno())
+            with self.lock, self.ack_lock:
+                while self.order and self.order[0] in self.acked:
+                    self.acked.discard(self.order.popleft())
+                low = self.order[0] if self.order else self.next_seq
+                if low != self.low:
+                    self.low = low
+                    self.write_checkpoint(low)
+                    self.trim()
+                return(bool(self.order))
+
+    def sync_loop(self):
+        while not self.stopping.wait(self.sync_interval):
+            try:
+                self.expire()
+                self.sync()
+            except Exception:
+                logger.error('%s durable log sync error: %s', self.dest, str(sys.exc_info()[1]))
+
+    # Give the broker up to wait seconds to confirm what was just sent
+    def settle(self, wait):
+        deadline = time.time() + wait
+        while self.sync() and self.mids and time.time() < deadline:
+            time.sleep(0.05)
+
+    # At exit.  Give the broker a few seconds (if connected) to confirm what was just sent, then save the checkpoint
+    def close(self, wait=5):
+        self.settle(wait)
+        self.stopping.set()
+        self.syncer.join(self.sync_interval + 5)
+        self.sync()
+        with self.lock:
+            self.out.close()
+        if self.order:
+            logger.warning('%s: %s unconfirmed messages kept in the durable log', self.dest, len(self.order) - len(self.acked))
+
+#Warn about destinations that are dropping messages.  dropped_dict keeps the last seen drop counters, so we only warn about new drops
+def check_dispatch(dropped_dict):
+    stats = dispatch_stats()
+    for name in stats:
+     logger.debug("Dispatch %s: %s", name, stats[name])
+     if stats[name]['dropped'] != dropped_dict.get(name, 0):
+       logger.warning("Dispatch queue for %s full. Dropped %s messages (%s total). Queue depth: %s", name,
+         stats[name]['dropped'] - dropped_dict.get(name, 0), stats[name]['dropped'], stats[name]['depth'])
+       dropped_dict[name] = stats[name]['dropped']
+
+#Queue depth and counters for every destination.  Returns {dest: {'depth': n, 'enqueued': n, ...}}
+def dispatch_stats():
+    stats = dict()
+    for name, c in list(settings_dict.items()):  # A copy.  A reload can add or remove instances meanwhile
+      if 'dispatcher' in c:
+        d = c['dispatcher']
+        stats[name] = {'depth': d.depth(), 'enqueued': d.enqueued, 'delivered': d.delivered,
+                       'failed': d.failed, 'dropped': d.dropped, 'buffered': 0, 'buffer_dropped': 0, 'unconfirmed': 0,
+                       'completed': 0, 'inflight': 0}
+        if d.outage is not None:
+          stats[name]['buffered'] = len(d.outage)
+          stats[name]['buffer_dropped'] = d.outage.dropped
+        if d.durable is not None:
+          stats[name]['unconfirmed'] = d.durable.unacked()
+        if d.tracker is not None:
+          stats[name]['completed'] = d.tracker.completed
+          stats[name]['inflight'] = len(d.tracker)
+    return(stats)
+
+
+#Metrics.  Kept as plain counters/histograms in memory and only formatted when /metrics is requested.
+# Each family holds one value per set of label values.  Updating one is a dict lookup under a lock.
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict()   # (label values) -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def samples(self):
+        with self.lock:
+            return([(self.name, labels, value) for labels, value in self.values.items()])
+
+class Histogram(Counter):
+    kind = 'histogram'
+    # Seconds.  Covers a dict lookup up to a slow network publish
+    buckets = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # Per bucket, +Inf, then sum
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        found = []
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in values:
+            total = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                found.append((self.name + '_bucket', labels + (str(bucket),), total))
+            found.append((self.name + '_sum', labels, counts[-1]))
+            found.append((self.name + '_count', labels, total))
+        return(found)
+
+metric_received = Counter('mqtt_repeater_received_total', 'Messages received from each source', ('source',))
+metric_connects = Counter('mqtt_repeater_connects_total', 'Successful connections to each broker', ('instance',))
+metric_disconnects = Counter('mqtt_repeater_disconnects_total', 'Disconnects from each broker', ('instance',))
+metric_search_seconds = Histogram('mqtt_repeater_search_map_seconds', 'Time to look up routes for a message', ('source',))
+metric_publish_seconds = Histogram('mqtt_repeater_publish_seconds', 'Time to publish to a destination (publish_file, publish_sqldb or MQTT publish)', ('dest', 'type'))
+metric_worker_restarts = Counter('mqtt_repeater_worker_restarts_total', 'Worker processes restarted by the supervisor', ('worker',))
+metric_complete_seconds = Histogram('mqtt_repeater_publish_complete_seconds', 'Time from publish() to the broker confirming it (PUBACK/PUBCOMP), or to being sent for QOS 0', ('dest',))
+metric_filtered = Counter('mqtt_repeater_filtered_total', 'Messages not sent because of ON_CHANGE, DEADBAND, MIN_INTERVAL or MAX_RATE on a route', ('dest', 'reason'))
+metric_families = [metric_received, metric_connects, metric_disconnects, metric_search_seconds, metric_publish_seconds,
+                   metric_worker_restarts, metric_filtered, metric_complete_seconds]
+
+#Everything /metrics shows, as plain data.  Worker processes send this to the supervisor, which adds them up.
+def stats_snapshot():
+    return({'families': [(f.name, f.kind, f.help, f.labels, f.samples()) for f in metric_families],
+            'dispatch': dispatch_stats(),
+            'writers': dict((name, c['writer'].pending_count()) for name, c in list(settings_dict.items())
+                            if 'writer' in c)})
+
+#Add up stats_snapshot()s from several processes.  Same labels are summed (histogram buckets are cumulative, so they sum too)
+def merge_stats(snapshots):
+    families = collections.OrderedDict()
+    dispatch = dict()
+    writers = dict()
+    for snapshot in snapshots:
+        for name, kind, help, labels, samples in snapshot['families']:
+            if name not in families:
+                families[name] = (kind, help, labels, collections.OrderedDict())
+            totals = families[name][3]
+            for sample, values, value in samples:
+                key = (sample, tuple(values))
+                totals[key] = totals.get(key, 0) + value
+        for dest, stats in snapshot['dispatch'].items():
+            total = dispatch.setdefault(dest, dict.fromkeys(stats, 0))
+            for key in stats:
+                total[key] += stats[key]
+        for name, pending in snapshot['writers'].items():
+            writers[name] = writers.get(name, 0) + pending
+    return({'families': [(name, kind, help, labels, [key + (value,) for key, value in totals.items()])
+                         for name, (kind, help, labels, totals) in families.items()],
+            'dispatch': dispatch, 'writers': writers})
+
+worker_stats = None  # Supervisor only.  Last stats_snapshot() from each worker process
+
+#Current values of everything in Prometheus text format.  For the supervisor, the total of all the workers
+def format_metrics():
+    if worker_stats is None:
+        snapshot = stats_snapshot()
+    else:
+        snapshot = merge_stats(list(worker_stats.values()) + [stats_snapshot()])
+    lines = []
+    def add(name, kind, help, labels, samples):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample, values, value in samples:
+            names = labels + ('le',) if sample.endswith('_bucket') else labels
+            label_str = ','.join(['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                  for n, v in zip(names, values)])
+            lines.append('%s{%s} %s' % (sample, label_str, repr(float(value)) if isinstance(value, float) else value))
+    for name, kind, help, labels, samples in snapshot['families']:
+        add(name, kind, help, labels, samples)
+    # Dispatch queues and writer threads keep their own counters
+    stats = snapshot['dispatch']
+    for key, kind, help in (('enqueued', 'counter', 'Messages queued for each destination'),
+                            ('delivered', 'counter', 'Messages published to each destination'),
+                            ('failed', 'counter', 'Publish errors for each destination'),
+                            ('dropped', 'counter', 'Messages dropped because the destination queue was full'),
+                            ('depth', 'gauge', 'Messages waiting in each destination queue'),
+                            ('buffered', 'gauge', 'Messages held while the destination is disconnected'),
+                            ('buffer_dropped', 'counter', 'Messages dropped because the outage buffer was full'),
+                            ('unconfirmed', 'gauge', 'Messages in the durable log not yet confirmed by the broker'),
+                            ('completed', 'counter', 'Publishes confirmed by the broker (PUBACK/PUBCOMP, or sent for QOS 0)'),
+                            ('inflight', 'gauge', 'Publishes handed to the MQTT client and not confirmed yet')):
+        name = 'mqtt_repeater_dispatch_%s%s' % (key, '_total' if kind == 'counter' else '')
+        add(name, kind, help, ('dest',), [(name, (dest,), stats[dest][key]) for dest in sorted(stats)])
+    add('mqtt_repeater_writer_pending', 'gauge', 'Records waiting in file/sqlite writer threads', ('dest',),
+        [('mqtt_repeater_writer_pending', (name, ), snapshot['writers'][name]) for name in sorted(snapshot['writers'])])
+    return('\n'.join(lines) + '\n')
+
+#Last value of every routed topic, for the /value and /values HTTP queries.  Only kept when HTTP_PORT is set.
+# set() is called for every message, so it only takes the lock to add a topic it hasn't seen before.  Keys are also
+#  kept sorted, so a prefix query is a bisect instead of a scan.
+class ValueCache(object):
+    def __init__(self):
+        self.values = dict()   # (source, topic) -> (payload, time.time())
+        self.keys = []         # Sorted (source, topic)
+        self.lock = threading.Lock()
+
+    def set(self, source, topic, payload, ts=None):
+        key = (source, topic)
+        if ts is None:
+            ts = time.time()
+        if key not in self.values:
+            with self.lock:
+                if key not in self.values:
+                    bisect.insort(self.keys, key)
+                self.values[key] = (payload, ts)
+        else:
+            self.values[key] = (payload, ts)
+
+    # [(source, topic, payload, time)] set at or after 'since'.  What a worker process sends to the supervisor
+    def changed_since(self, since):
+        with self.lock:  # No new keys while copying
+            items = list(self.values.items())
+        return([key + value for key, value in items if value[1] >= since])
+
+    # Values from changed_since() in a worker.  Keep the newest if two workers saw the same topic
+    def merge(self, items):
+        for source, topic, payload, ts in items:
+            old = self.values.get((source, topic))
+            if old is None or old[1] <= ts:
+                self.set(source, topic, payload, ts)
+
+    def get(self, source, topic):
+        return(self.values.get((source, topic)))
+
+    # [(source, topic, payload, time)] for the given source (or all), limited to topics in a list or starting with prefix
+    def query(self, source=None, topics=None, prefix=''):
+        if topics is not None:
+            keys = [(s, t) for s in ([source] if source is not None else self.sources()) for t in topics]
+        else:
+            with self.lock:
+                if source is None:
+                    keys = [key for key in self.keys if key[1].startswith(prefix)]
+                else:
+                    i = bisect.bisect_left(self.keys, (source, prefix))
+                    keys = []
+                    while i < len(self.keys) and self.keys[i][0] == source and self.keys[i][1].startswith(prefix):
+                        keys.append(self.keys[i])
+                        i += 1
+        found = []
+        for key in keys:
+            value = self.values.get(key)
+            if value is not None:
+                found.append(key + value)
+        return(found)
+
+    def sources(self):
+        with self.lock:
+            return(sorted(set(key[0] for key in self.keys)))
+
+value_cache = None  # Set up in main() when the HTTP server is on
+
+#Local HTTP server for /metrics and last value queries.  Runs in its own thread.
+#  /metrics                               Prometheus text format
+#  /value?source=MQTT_1&topic=/a/b        Just the value (text).  404 if nothing was seen on that topic
+#  /values                                JSON list of {source, topic, value, timestamp} for every topic.  Filter with
+#                                          source=, topic= (any number of them) or prefix=
+class RepeaterHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class RepeaterHTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        args = parse_qs(query)
+        if path == '/metrics':
+            self.reply(200, 'text/plain; version=0.0.4', format_metrics())
+        elif path == '/value' and value_cache is not None:
+            if 'source' not in args or 'topic' not in args:
+                self.reply(400, 'text/plain', 'Needs source= and topic=\n')
+                return
+            value = value_cache.get(args['source'][0], args['topic'][0])
+            if value is None:
+                self.reply(404, 'text/plain', 'No value\n')
+            else:
+                self.reply(200, 'text/plain; charset=utf-8', value[0])
+        elif path == '/values' and value_cache is not None:
+            found = value_cache.query(args.get('source', [None])[0], args.get('topic'), args.get('prefix', [''])[0])
+            self.reply(200, 'application/json', json.dumps([{'source': source, 'topic': topic, 'value': payload,
+              'timestamp': datetime.datetime.fromtimestamp(ts).isoformat()} for source, topic, payload, ts in found]))
+        else:
+            self.reply(404, 'text/plain', 'Not found\n')
+
+    def reply(self, code, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # Don't log every request
+        logger.debug('HTTP %s - %s', self.client_address[0], format % args)
+
+http_server = None
+
+def start_http_server(addr, port):
+    global http_server
+    server = http_server = RepeaterHTTPServer((addr, port), RepeaterHTTPHandler)
+    t = threading.Thread(target=server.serve_forever, name='http')
+    t.daemon = True
+    t.start()
+    logger.info('Serving metrics and values on http://%s:%s/', addr, port)
+    return(server)
+
+#Start writer threads for file and DB outputs, and dispatch queues for everything that is used as a destination
+def start_sinks():
+    #Start a writer thread for each file output
+    for name in settings_dict:
+     if settings_dict[name]['TOPIC_FMT'] == 'file':
+       settings_dict[name]['writer'] = FileWriter(name, settings_dict[name])
+       settings_dict[name]['writer'].start()
+
+    #Setup SQL DBs and start a writer thread for each
+    for name in settings_dict:
+     if settings_dict[name]['TOPIC_FMT'] == 'sqlite':  
+       dbconn = sqlite3.connect(settings_dict[name]['FILENAME']) 
+       setup_sqldb(dbconn, str(settings_dict[name]['HISTORY']) == '1')  # HISTORY 1 also logs all data historically
+       dbconn.close()
+       settings_dict[name]['writer'] = SqliteWriter(name, settings_dict[name])
+       settings_dict[name]['writer'].start()
+     else:
+      continue  #Skip non-DB
+
+    #Start dispatch queues
+    for name in settings_dict:
+      for source in settings_dict[name]['topic_map_dict']:
+        for route in settings_dict[name]['topic_map_dict'][source]:
+          dname = route.dname
+          if 'dispatcher' not in settings_dict[dname]:
+            settings_dict[dname]['dispatcher'] = Dispatcher(dname, settings_dict[dname])
+
+#Publish/write whatever is still queued and stop the threads from start_sinks().  Dispatchers first, since they feed the writers.
+def stop_sinks():
+    rate_scheduler.flush_all()  # Latest values held back by MAX_RATE
+    for name in settings_dict:
+      if 'dispatcher' in settings_dict[name]:
+        settings_dict[name].pop('dispatcher').close()
+    for name in settings_dict:
+      if 'writer' in settings_dict[name]:
+        settings_dict[name].pop('writer').close()
+
+
+#Hot reload.  On SIGHUP, or when the cfgfile changes with REPEATER RELOAD_WATCH set, the cfgfile is read again into
+# new dicts and compared with the running settings.  Only what changed is touched:
+#  - An instance or output with the same settings keeps running, with its connection, queue and writer.  Sources get
+#    their new RouteTable in one assignment, and only subscribe/unsubscribe the topics that were added/removed.
+#  - One that was added, removed, or had any setting changed is started, stopped or replaced.  Messages already queued
+#    for a replaced destination are sent through the old one first.  What it is still holding for an outage, and
+#    messages that reach it after that, go to the new one (see Dispatcher.close() and retire()).  If both use the same
+#    DURABLE_DIR, the new one replays the logged messages from there instead.
+#  - REPEATER settings only change on a restart.
+# A cfgfile with errors is logged and ignored, and everything keeps running as it was.
+reload_lock = threading.Lock()
+worker_partition = None  # (index, count) in a worker process, so a reload gets the same share of the rules
+instance_starter = None  # Set by the asyncio engine.  Connects an instance added by a reload on its event loop
+
+# Settings from the cfgfile (and defaults) for one instance, without what is added while running
+def cfg_settings(c):
+  return(dict((setting, str(value)) for setting, value in c.items() if setting.isupper() and setting != 'RETRY_COUNTER'))
+
+# Read the cfgfile into new dicts.  Returns the new settings_dict, or None if the file has errors
+def read_new_cfgfile():
+  new_settings = dict()
+  new_repeater = dict()
+  logger.error('Reloading %s', cfgfile)
+  try:
+    read_cfgfile(cfgfile, new_settings, new_repeater)
+  except SystemExit:  # read_cfgfile() logged what was wrong
+    logger.error('Reload of %s failed.  Keeping the running settings.', cfgfile)
+    return(None)
+  except (IOError, OSError):
+    logger.error('Reload of %s failed: %s.  Keeping the running settings.', cfgfile, sys.exc_info()[1])
+    return(None)
+  for setting in sorted(new_repeater):
+    if str(new_repeater[setting]) != str(repeater_settings.get(setting)):
+      logger.warning('REPEATER %s changed.  Restart to use it.', setting)
+  if worker_partition is not None:
+    partition_rules(worker_partition[0], worker_partition[1], repeater_settings['PARTITION'], new_settings)
+  return(new_settings)
+
+def reload_settings():
+  with reload_lock:
+    new_settings = read_new_cfgfile()
+    if new_settings is not None:
+      apply_settings(new_settings)
+
+# Make the running instances match new_settings (from read_new_cfgfile())
+def apply_settings(new_settings):
+  added = [name for name in new_settings if name not in settings_dict]
+  removed = [name for name in settings_dict if name not in new_settings]
+  changed = [name for name in new_settings if name in settings_dict and
+             cfg_settings(new_settings[name]) != cfg_settings(settings_dict[name])]
+  dests = set(route.dname for c in new_settings.values() for routes in c['topic_map_dict'].values() for route in routes)
+
+  # Destinations first, so every route swapped in below has somewhere to go
+  for name in dests:
+    if name not in added and name not in changed and 'dispatcher' not in settings_dict[name]:
+      settings_dict[name]['dispatcher'] = Dispatcher(name, settings_dict[name])  # Used as a destination for the first time
+      watch_publishes(settings_dict[name])
+  for name in changed:
+    logger.error('Reload: %s settings changed.  Restarting it.', name)
+    old = settings_dict[name]
+    new = new_settings[name]
+    held = []
+    if 'dispatcher' in old:  # Sends what is queued through the old connection/writer.  What it can't send yet is handed over
+      same_log = (old['dispatcher'].durable is not None and new['TOPIC_FMT'] not in ('file', 'sqlite') and
+                  new.get('DURABLE_DIR') == old['DURABLE_DIR'])  # The new one replays it from the log instead
+      held = old['dispatcher'].close(handover=not same_log)
+    stop_instance(old)
+    start_instance(name, new, name in dests)
+    if held and 'dispatcher' in new:
+      new['dispatcher'].adopt(held)
+    elif held:
+      logger.warning('%s: %s buffered messages dropped.  No rule sends to it any more.', name, len(held))
+    settings_dict[name] = new
+    if 'dispatcher' in old:
+      old['dispatcher'].retire(new.get('dispatcher'))
+    connect_instance(name)
+  for name in added:
+    logger.error('Reload: starting %s', name)
+    start_instance(name, new_settings[name], name in dests)
+    settings_dict[name] = new_settings[name]
+    connect_instance(name)
+
+  # Swap in the new routes of everything else.  Messages being routed meanwhile use either the old or the new table
+  for name in new_settings:
+    if name in added or name in changed or 'route_table' not in new_settings[name]:
+      continue
+    c = settings_dict[name]
+    old_topics = subscription_topics(name)
+    c['topic_map_dict'] = new_settings[name]['topic_map_dict']
+    c['route_table'] = new_settings[name]['route_table']
+    new_topics = subscription_topics(name)
+    if not c.get('connected'):  # connected() subscribes to the new topics once it is back
+      continue
+    old_set = set(old_topics)
+    new_set = set(new_topics)
+    for feed in new_topics:
+      if feed not in old_set:
+        logger.info(' Subscribe to: %s - QOS: %s', feed, c['QOS'])
+        c['instance'].subscribe(feed, int(c['QOS']))
+    for feed in old_topics:
+      if feed not in new_set:
+        logger.info(' Unsubscribe from: %s', feed)
+        c['instance'].unsubscribe(feed)
+
+  # No rule points at these any more
+  for name in removed:
+    logger.error('Reload: stopping %s', name)
+    old = settings_dict[name]
+    if 'dispatcher' in old:
+      old['dispatcher'].close()
+      old['dispatcher'].retire(None)
+    stop_instance(old)
+    del settings_dict[name]
+  logger.error('Reload done.  %s added, %s changed, %s removed', len(added), len(changed), len(removed))
+
+# Set up the outputs, dispatch queue and client of an instance from a reload, before it goes into settings_dict
+def start_instance(name, c, is_dest):
+  if c['TOPIC_FMT'] == 'file':
+    c['writer'] = FileWriter(name, c)
+    c['writer'].start()
+  elif c['TOPIC_FMT'] == 'sqlite':
+    dbconn = sqlite3.connect(c['FILENAME'])
+    setup_sqldb(dbconn, str(c['HISTORY']) == '1')
+    dbconn.close()
+    c['writer'] = SqliteWriter(name, c)
+    c['writer'].start()
+  if is_dest:
+    c['dispatcher'] = Dispatcher(name, c)
+  if c['TOPIC_FMT'] not in ('file', 'sqlite') and instance_starter is None:  # The asyncio engine creates its own
+    instance_create(c, name)
+
+# Connect an instance from start_instance() in the background.  It retries with backoff, without MAX_RETRIES
+def connect_instance(name):
+  c = settings_dict[name]
+  if c['TOPIC_FMT'] in ('file', 'sqlite'):
+    return
+  if instance_starter is not None:
+    instance_starter(name)
+    return
+  c['reconnecting'] = True  # Keep the monitor loop away until the first connect is done
+  in_background(reconnect, name, c)
+
+# Disconnect and stop an instance that a reload replaced or removed
+def stop_instance(c):
+  c['stopped'] = True  # Its callbacks and reconnect timer leave settings_dict alone from now on
+  if 'reconnect_timer' in c:
+    c['reconnect_timer'].cancel()
+  if 'instance' in c:
+    try:
+      c['instance'].disconnect()
+    except Exception:
+      logger.error('%s disconnect error: %s', str(sys.exc_info()[0]), str(sys.exc_info()[1]))
+    c['instance']._client.loop_stop()
+  if 'writer' in c:
+    c.pop('writer').close()
+
+# Run function(*args) in a new daemon thread.  For signal handlers, which shouldn't block the main thread
+def in_background(function, *args):
+  t = threading.Thread(target=function, args=args, name=function.__name__)
+  t.daemon = True
+  t.start()
+
+# SIGHUP runs reload(), and so does a change to the cfgfile if REPEATER RELOAD_WATCH is set
+def watch_cfgfile(reload):
+  if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, lambda signum, frame: in_background(reload))
+  interval = float(repeater_settings['RELOAD_WATCH'])
+  if interval > 0:
+    in_background(watch_loop, reload, interval)
+
+def watch_loop(reload, interval):
+  mtime = os.path.getmtime(cfgfile)
+  while True:
+    time.sleep(interval)
+    try:
+      new_mtime = os.path.getmtime(cfgfile)
+    except OSError:  # Being replaced by an editor.  Look again next time
+      continue
+    if new_mtime != mtime:
+      mtime = new_mtime
+      reload()
+
+
+#Multi-process mode (REPEATER WORKERS > 1).  A supervisor process starts WORKERS worker processes.  Each gets a share
+# of the mapping rules and runs its own broker connections, dispatch queues and outputs, so they use separate cores.
+#  partition_rules() cuts settings_dict down to worker 'index' of 'count', using the PARTITION setting:
+#  source: Each source instance (and all its rules) goes to one worker, round robin
+#  hash:   Each rule goes to a worker by a hash of its source feed, so one busy source is spread over the workers
+#  shared: Every worker has every rule, subscribed as an MQTT shared subscription ($share/SHARE_GROUP/...), and the
+#          broker hands each message to one of them.  Needs a broker that supports it (mosquitto 1.6+, EMQX, HiveMQ..)
+#          Adafruit IO sources can't do this, so they are split as with 'source'.
+# A worker only connects to the sources it has rules for and the destinations they use.  Client ids get '-<index>'
+#  added, and file outputs and spill/durable directories get per-worker names, since two processes can't share them.
+#  SQLite outputs are shared (WAL mode lets several processes write).  Their history cleanup runs once, in the
+#  supervisor (maintain_history()).
+def partition_rules(index, count, mode, settings_dict=settings_dict):
+  sources = sorted(name for name in settings_dict if settings_dict[name]['topic_map_dict'])
+  for i, name in enumerate(sources):
+    c = settings_dict[name]
+    if mode == 'hash':  # crc32, because hash() of a string is different in every process
+      c['topic_map_dict'] = dict((feed, routes) for feed, routes in c['topic_map_dict'].items()
+                                 if (zlib.crc32((name + ' ' + feed).encode('utf-8')) & 0xffffffff) % count == index)
+    elif mode == 'shared' and c['TOPIC_FMT'] != 'adafruit_fmt':
+      c['share_group'] = repeater_settings['SHARE_GROUP']
+      for routes in c['topic_map_dict'].values():
+        for route in routes:
+          route.share(count)
+    elif i % count != index:
+      c['topic_map_dict'] = dict()
+    c['route_table'] = RouteTable(c['topic_map_dict'], int(c['ROUTE_CACHE_SIZE']))
+  needed = set()
+  for name in settings_dict:
+    for routes in settings_dict[name]['topic_map_dict'].values():
+      needed.add(name)
+      needed.update(route.dname for route in routes)
+  for name in list(settings_dict):
+    if name not in needed:
+      del settings_dict[name]
+  for name in settings_dict:
+    c = settings_dict[name]
+    if c['TOPIC_FMT'] == 'file':
+      base, ext = os.path.splitext(c['FILENAME'])
+      c['FILENAME'] = '%s.%d%s' % (base, index, ext)  # logs/mqtt_logfile.csv -> logs/mqtt_logfile.0.csv
+    elif c['TOPIC_FMT'] != 'sqlite':
+      if c['CLIENTID'] not in (None, '', 'None'):
+        c['CLIENTID'] = '%s-%d' % (c['CLIENTID'], index)
+      for setting in ('BUFFER_SPILL_DIR', 'DURABLE_DIR'):
+        if c[setting]:
+          c[setting] = os.path.join(c[setting], 'worker%d' % index)
+          if not os.path.isdir(c[setting]):
+            os.makedirs(c[setting])
+
+# Runs in each worker process.  stats_queue takes (index, stats_snapshot(), new values) every STATS_INTERVAL seconds
+def worker_main(index, count, stats_queue):
+  global value_cache, worker_partition, history_maintenance
+  if not settings_dict:  # Started without fork() (spawn/forkserver), so nothing was inherited.  Read the cfgfile again
+    setup_logging()
+    read_cfgfile(cfgfile)
+  if http_server is not None:  # Forked (Python 2) after the supervisor started listening
+    http_server.server_close()
+  history_maintenance = False
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  metric_worker_restarts.values.clear()  # Counted by the supervisor.  A restarted worker is forked with its counts
+  worker_partition = (index, count)
+  if hasattr(signal, 'SIGHUP'):  # Sent on by the supervisor when it reloads the cfgfile
+    signal.signal(signal.SIGHUP, lambda signum, frame: in_background(reload_settings))
+  partition_rules(index, count, repeater_settings['PARTITION'])
+  logger.error('Worker %s of %s started: %s', index, count, ' '.join(sorted(settings_dict)) or 'no rules for this worker')
+  if int(repeater_settings['HTTP_PORT']):  # The supervisor serves these
+    value_cache = ValueCache()
+  start_sinks()
+  try:
+    t = threading.Thread(target=report_stats, args=(index, stats_queue), name='stats')
+    t.daemon = True
+    t.start()
+    run_instances()
+  finally:  # multiprocessing doesn't run atexit in worker processes
+    stop_sinks()
+
+# Supervisor only.  Removes old history from the sqlite outputs every HISTORY_MAINTENANCE seconds, once, instead of
+#  every worker doing it to the same DB
+def maintain_history():
+  due = dict()  # name -> time of the next cleanup
+  while True:
+    now = time.time()
+    for name, c in list(settings_dict.items()):  # A reload can replace settings_dict's contents meanwhile
+      if c['TOPIC_FMT'] != 'sqlite' or str(c['HISTORY']) != '1' or due.get(name, 0) > now:
+        continue
+      writer = SqliteWriter(name, c)  # Not started.  Just for its maintain()
+      dbconn = sqlite3.connect(c['FILENAME'])
+      try:
+        setup_sqldb(dbconn, True)
+        writer.maintain(dbconn)
+      except sqlite3.Error:
+        logger.error('%s history cleanup error for %s: %s', str(sys.exc_info()[0]), name, str(sys.exc_info()[1]))
+      finally:
+        dbconn.close()
+      due[name] = time.time() + writer.maintenance_interval
+    time.sleep(1)
+
+def report_stats(index, stats_queue):
+  since = 0
+  while True:
+    time.sleep(STATS_INTERVAL)
+    now = time.time()
+    values = value_cache.changed_since(since) if value_cache is not None else []
+    since = now - STATS_INTERVAL  # Overlap a little, in case a value was being set while we copied
+    stats_queue.put((index, stats_snapshot(), values))
+
+# Workers are started fresh ('spawn'), not forked.  A fork copies the supervisor's locks as they are at that moment,
+#  and its HTTP, history cleanup and cfgfile watch threads may be holding one (a metric's lock, a SQLite connection),
+#  which the worker would then wait on for good.  worker_main() reads the cfgfile again.  Python 2 can only fork.
+worker_context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+# Start the worker processes, restart any that die, and collect their stats for /metrics and /values
+def supervise(count):
+  global worker_stats, value_cache
+  worker_stats = dict()
+  stats_queue = worker_context.Queue()
+  workers = dict()     # index -> Process
+  started = dict()     # index -> time started
+  delays = dict()      # index -> seconds to wait before the next restart.  Grows while a worker keeps dying quickly
+  restart_at = dict()  # index -> time to restart a dead worker
+  def start(index):
+    p = worker_context.Process(target=worker_main, args=(index, count, stats_queue), name='worker-%d' % index)
+    p.start()
+    workers[index] = p
+    started[index] = time.time()
+  def stop():
+    for p in workers.values():
+      if p.is_alive():
+        p.terminate()  # SIGTERM.  Workers flush their outputs and exit
+    for p in workers.values():
+      p.join(15)
+  atexit.register(stop)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  # Reloads are done by the workers.  The supervisor only keeps the new settings for workers it starts later
+  def reload():
+    with reload_lock:
+      new_settings = read_new_cfgfile()
+      if new_settings is None:
+        return
+      settings_dict.clear()
+      settings_dict.update(new_settings)
+      for p in list(workers.values()):
+        if p.is_alive():
+          os.kill(p.pid, signal.SIGHUP)
+  watch_cfgfile(reload)
+
+  for index in range(count):
+    start(index)
+  if int(repeater_settings['HTTP_PORT']):
+    value_cache = ValueCache()
+    start_http_server(repeater_settings['HTTP_ADDR'], int(repeater_settings['HTTP_PORT']))
+  in_background(maintain_history)
+  logger.info('Started %s worker processes.  PARTITION %s', count, repeater_settings['PARTITION'])
+
+  while True:
+    try:
+      index, stats, values = stats_queue.get(timeout=1)
+      worker_stats[index] = stats
+      if value_cache is not None:
+        value_cache.merge(values)
+    except queue.Empty:
+      pass
+    now = time.time()
+    for index in sorted(workers):
+      if workers[index].is_alive():
+        continue
+      if index not in restart_at:
+        if now - started[index] < 60:
+          delays[index] = min(delays.get(index, 0.5) * 2, 60)
+        else:
+          delays[index] = 1
+        restart_at[index] = now + delays[index]
+        metric_worker_restarts.inc(str(index))
+        logger.error('Worker %s (pid %s) exited with code %s.  Restarting in %s seconds', index, workers[index].pid,
+                     workers[index].exitcode, delays[index])
+      elif now >= restart_at.pop(index):
+        start(index)
+
+def setup_logging():
+  logging.basicConfig(filename=LOGFILE, format='%(asctime)s:%(name)s:%(process)s:%(levelname)s:%(message)s', level=logging.WARNING)
 
 
 #Begin Main Code
-print("Started.  Logging to: " + LOGFILE)
-#Print something so we know log is working
-logger.error('MQTT Repeater Service Started')
-
-# Read the configuration file
-read_cfgfile(cfgfile)
-
-#Setup SQL DBs
-for name in settings_dict:
- if settings_dict[name]['TOPIC_FMT'] == 'sqlite':  
-   dbconn = sqlite3.connect(settings_dict[name]['FILENAME']) 
-   sqldb = dbconn.cursor()
-   # Create 'states' table if it doesn't exist
-   sqldb.execute('''CREATE TABLE IF NOT EXISTS states
-             (source_label text, source_feed text, value text, last_timestamp text)'''
-   )
-   # Should we create another table to log all data historically?
-   # Since writes occur in different threads, might as well close this here.
-   # Each thread needs it's own connection setup apparently.
-   dbconn.close()
- else:
-  continue  #Skip non-DB
-
-
-#Do some threading magic to watch for clients dying.  Keep a dictionary of running thread descriptors
-thread_dict = {}
-#Store the 'main' thread
-thread_dict['main'] = threading.currentThread()
-
-# Create client instances
-for name in settings_dict:
- if settings_dict[name]['TOPIC_FMT'] == 'file' or settings_dict[name]['TOPIC_FMT'] == 'sqlite':  #Don't run instance_start() if rule is output-only file or db
-  continue  #Skip files
- instance_start(settings_dict[name],name)  #Create instance definition and start in background
-
-logger.info('----')
-# Start background threads for clients
-for name in settings_dict:
- if settings_dict[name]['TOPIC_FMT'] == 'file' or settings_dict[name]['TOPIC_FMT'] == 'sqlite':  # Skip file and db definitions
-  continue  #Skip output files
- settings_dict[name]['instance'].loop_background() # Start thread in background
- time.sleep(0.1)  #slight delay
-  # Store thread associations in dictionary for monitoring
- for thread in threading.enumerate():  # Get all current threads
-  if thread in thread_dict:
-   continue   # If found already, skip.  Anything left is new thread
-  thread_dict[name] = thread  #Store thread association
-
-
-time.sleep(0.5)  #slight delay
-logger.info('----')
-logger.info('')
-logger.info('...(Ctrl-C a few times will quit)...')
-logger.info('')
-logger.info('')
-
-#Run until someone kills me
-while True:
-  
-  #Monitor for dead instances/threads.  
-  for name in thread_dict:  # Get threads from dictionary
-   if not thread_dict[name].is_alive():  # If thread died
-      logger.info('----')
-      logger.debug(threading.enumerate())  #Print remaining threads for debugging purposes
-      logger.error("Thread dead: %s  Restarting...", name)
-      #Try to restart dead thread 
-      settings_dict[name]['instance'].disconnect()   # Disconnect dead thread (might not be necessary)
-      thread_dict[name] = None  #remove dead association from dictionary
-      instance_start(settings_dict[name],name)  #Create new instance definition and connect (will retry # of times inside this function)
-      settings_dict[name]['instance'].loop_background() # Start thread in background
-      time.sleep(0.5)  #slight delay
-      for thread in threading.enumerate():  # Get all current threads
-       if thread in thread_dict:
-        continue   # If found already, skip.  Anything left is new thread
-       thread_dict[name] = thread  #Store new thread identifier
-      logger.info('----')
-
-  time.sleep(10)  # Sleep between monitor probes
+def main():
+  setup_logging()
+  print("Started.  Logging to: " + LOGFILE)
+  #Print something so we know log is working
+  logger.error('MQTT Repeater Service Started')
+
+  # Read the configuration file
+  read_cfgfile(cfgfile)
+
+  if int(repeater_settings['WORKERS']) > 1:  # Run the rules in worker processes instead
+    supervise(int(repeater_settings['WORKERS']))
+    return
+
+  start_sinks()
+  atexit.register(stop_sinks)  # Flush buffered lines and last DB values on exit
+  if int(repeater_settings['HTTP_PORT']):
+    global value_cache
+    value_cache = ValueCache()
+    start_http_server(repeater_settings['HTTP_ADDR'], int(repeater_settings['HTTP_PORT']))
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Let atexit flush the sinks when systemd/podman stops us
+  watch_cfgfile(reload_settings)
+  run_instances()
+
+# Connect every instance and run until killed
+def run_instances():
+  if repeater_settings['ENGINE'] == 'asyncio':  # All connections on one event loop instead of a thread each
+    if sys.version_info < (3, 7):
+      logger.critical("ENGINE asyncio needs Python 3.7 or newer.  Exiting.")
+      sys.exit(13)
+    import mqtt_repeater_async
+    mqtt_repeater_async.run(sys.modules[__name__])
+    return
+
+  dropped_dict = {}  # Last seen drop counters, so we only warn about new drops
+
+  # Create client instances
+  for name in settings_dict:
+   if settings_dict[name]['TOPIC_FMT'] == 'file' or settings_dict[name]['TOPIC_FMT'] == 'sqlite':  #Don't run instance_start() if rule is output-only file or db
+    continue  #Skip files
+   instance_start(settings_dict[name],name)  #Create instance definition and start in background
+
+  logger.info('----')
+  # Start background threads for clients
+  for name in settings_dict:
+   if settings_dict[name]['TOPIC_FMT'] == 'file' or settings_dict[name]['TOPIC_FMT'] == 'sqlite':  # Skip file and db definitions
+    continue  #Skip output files
+   instance_loop(settings_dict[name])  # Start thread in background, and store it for monitoring
+
+
+  time.sleep(0.5)  #slight delay
+  logger.info('----')
+  logger.info('')
+  logger.info('...(Ctrl-C a few times will quit)...')
+  logger.info('')
+  logger.info('')
+
+  #Run until someone kills me
+  while True:
+    
+    #Monitor for dead instances/threads.  
+    for name, c in list(settings_dict.items()):
+     if c.get('thread') is None or c.get('reconnecting'):  # Not a client, or already being reconnected
+       continue
+     if not c['thread'].is_alive():  # If thread died
+        logger.info('----')
+        logger.debug(threading.enumerate())  #Print remaining threads for debugging purposes
+        logger.error("Thread dead: %s  Restarting...", name)
+        c['thread'] = None
+        schedule_reconnect(name)  #Restart the thread (and reconnect if needed) in the background
+        logger.info('----')
+
+    #Warn about destinations that are dropping messages
+    check_dispatch(dropped_dict)
+
+    time.sleep(10)  # Sleep between monitor probes
+
+if __name__ == '__main__':
+  main()
 
 #End
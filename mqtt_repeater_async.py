@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# asyncio engine for mqtt_repeater.py.  Used when the cfgfile has:  set REPEATER ENGINE asyncio
+# Copyright (c) 2016 - mgroseman - Mike Roseman
+# MIT License
+#
+#  Every broker instance runs on one event loop, instead of a paho network thread each.
+#  paho's socket callbacks tell us when its socket opens or closes and when it has data waiting to be written.
+#  The loop calls paho's loop_read()/loop_write() when the socket is ready, and loop_misc() once a second for keepalives.
+#  A dropped connection is seen as soon as the socket closes, and reconnect delays (next_backoff(), same as the threads
+#  engine) use asyncio.sleep() instead of blocking a thread, so one slow broker doesn't hold up the others.
+#
+#  Needs Python 3.7+ and paho-mqtt 1.5+ (socket callbacks).  mqtt_repeater.py only imports this when ENGINE is asyncio.
+#  Everything else (routing, dispatch queues, file/DB writers, metrics) is shared with the threads engine.
+
+import asyncio
+import logging
+import sys
+import threading
+
+logger = logging.getLogger('mqtt_repeater')  #label when logging
+
+MISC_INTERVAL = 1   # Seconds between loop_misc() calls (keepalive pings and timeouts)
+MONITOR_INTERVAL = 10  # Seconds between dispatch queue checks
+
+
+# One broker connection driven by the event loop
+class AsyncInstance(object):
+    def __init__(self, repeater, loop, name):
+        self.repeater = repeater
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.name = name
+        self.c = repeater.settings_dict[name]
+        self.sock = None
+        self.lost = asyncio.Event()   # Set when the socket closes
+        self.started = False          # MAX_RETRIES only applies until the first connection, like instance_start()
+        repeater.instance_create(self.c, name)
+        self.client = self.c['instance']
+        # repeater.disconnected() stops the paho network thread and reconnects from a timer.  Here run() does that instead.
+        self.client.on_disconnect = self.disconnected
+        self.mqttc = self.client._client   # paho client inside the Adafruit_IO wrapper
+        if not hasattr(type(self.mqttc), 'on_socket_open'):
+            logger.critical("ENGINE asyncio needs paho-mqtt 1.5 or newer (socket callbacks).  Exiting.")
+            sys.exit(13)
+        self.mqttc.on_socket_open = self.socket_open
+        self.mqttc.on_socket_close = self.socket_close
+        self.mqttc.on_socket_register_write = self.register_write
+        self.mqttc.on_socket_unregister_write = self.unregister_write
+
+    # paho calls the socket callbacks from whichever thread it is in:  the loop, the connect executor, or a dispatch
+    #  worker that just queued a publish.  Only touch the loop from its own thread.
+    def call(self, function, *args):
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def socket_open(self, mqttc, userdata, sock):
+        self.call(self.add_reader, sock)
+
+    def socket_close(self, mqttc, userdata, sock):
+        self.call(self.remove_socket, sock)
+
+    def register_write(self, mqttc, userdata, sock):
+        self.call(self.add_writer, sock)
+
+    def unregister_write(self, mqttc, userdata, sock):
+        self.call(self.remove_writer, sock)
+
+    def add_reader(self, sock):
+        self.sock = sock
+        self.loop.add_reader(sock, self.mqttc.loop_read)
+
+    # A callback queued from another thread can arrive after the socket was closed.  Ignore anything for an old socket.
+    def add_writer(self, sock):
+        if sock is self.sock:
+            self.loop.add_writer(sock, self.mqttc.loop_write)
+
+    def remove_writer(self, sock):
+        if sock is self.sock:
+            self.loop.remove_writer(sock)
+
+    def remove_socket(self, sock):
+        if sock is self.sock:
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
+            self.sock = None
+            self.lost.set()
+
+    def disconnected(self, client):
+        if self.c.get('stopped'):  # Stopped by a reload
+            return
+        self.c['connected'] = False  # Dispatch workers buffer messages for this destination until it is back
+        self.repeater.metric_disconnects.inc(self.name)
+        if 'dispatcher' in self.c:
+            self.c['dispatcher'].disconnected()
+
+    # Connect, retrying with backoff.  The blocking part (DNS, TCP, TLS) runs in the default executor.
+    async def connect(self):
+        c = self.c
+        while not c.get('stopped'):
+            self.lost.clear()
+            try:
+                await self.loop.run_in_executor(None, self.client.connect)
+            except Exception:
+                if not self.started and c['RETRY_COUNTER'] > c['MAX_RETRIES']:
+                    self.repeater.terminate(self.client)
+                logger.error('%s connect error for %s. Retry # %s', str(sys.exc_info()[0]), self.name, str(c['RETRY_COUNTER']))
+                await asyncio.sleep(self.repeater.next_backoff(c))
+            else:
+                self.started = True
+                return
+
+    # Until a reload stops this instance (see mqtt_repeater.stop_instance())
+    async def run(self):
+        await self.connect()
+        while not self.c.get('stopped'):
+            await self.lost.wait()
+            if self.c.get('stopped'):
+                return
+            logger.error('Disconnected from %s (%s)! Retrying...', self.client._service_host, self.name)
+            await asyncio.sleep(self.repeater.next_backoff(self.c))
+            await self.connect()
+
+    async def misc(self):
+        while not self.c.get('stopped'):
+            await asyncio.sleep(MISC_INTERVAL)
+            if self.sock is not None:
+                self.mqttc.loop_misc()
+
+
+def start(instance):
+    instance.loop.create_task(instance.run())
+    instance.loop.create_task(instance.misc())
+
+async def main(repeater):
+    loop = asyncio.get_running_loop()
+    instances = []
+    for name in repeater.settings_dict:
+        if repeater.settings_dict[name]['TOPIC_FMT'] in ('file', 'sqlite'):  # Skip file and db definitions
+            continue
+        instances.append(AsyncInstance(repeater, loop, name))
+    for instance in instances:
+        start(instance)
+    # Instances added or replaced by a reload.  Called from the reload thread
+    repeater.instance_starter = lambda name: loop.call_soon_threadsafe(lambda: start(AsyncInstance(repeater, loop, name)))
+    logger.info('----')
+    logger.info('%s instances running on asyncio engine', len(instances))
+    logger.info('')
+
+    dropped_dict = {}  # Last seen drop counters, so we only warn about new drops
+    while True:
+        await asyncio.sleep(MONITOR_INTERVAL)
+        repeater.check_dispatch(dropped_dict)
+
+# Run forever.  repeater is the mqtt_repeater module, already configured and with its sinks started.
+def run(repeater):
+    asyncio.run(main(repeater))
@@ -0,0 +1,67 @@
+# Shared setup for the tests.  Run with:  python -m pytest tests
+#
+# mqtt_repeater.py is loaded the way util/mqtt_bench.py does it, with the bench's fake broker client in place of
+#  Adafruit_IO's MQTTClient, so nothing connects to the network.  Files and DBs go in pytest's tmpdir.
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import mqtt_bench
+
+mr = mqtt_bench.load_repeater()
+
+
+# The mqtt_repeater module, with empty settings.  Anything started by the test is stopped afterwards.
+@pytest.fixture
+def repeater():
+    mr.settings_dict.clear()
+    mr.repeater_settings.clear()
+    yield mr
+    mr.stop_sinks()
+    for c in mr.settings_dict.values():
+        c['stopped'] = True   # Keep reconnect timers and callbacks away from the next test
+    mr.settings_dict.clear()
+    mr.repeater_settings.clear()
+
+
+# Write a cfgfile from a list of lines.  Returns its name
+def write_cfg(tmpdir, lines, name='test.cfg'):
+    filename = os.path.join(str(tmpdir), name)
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return(filename)
+
+
+# Read a cfgfile into the running settings, start the sinks and connect the (fake) clients
+def start(repeater, filename):
+    repeater.read_cfgfile(filename)
+    repeater.start_sinks()
+    for name in repeater.settings_dict:
+        if repeater.settings_dict[name]['TOPIC_FMT'] not in ('file', 'sqlite'):
+            repeater.instance_start(repeater.settings_dict[name], name)
+
+
+# Record what is published to a (fake) MQTT client, and confirm it straight away like the bench's publish() does.
+#  Set confirm[0] to False to leave messages unconfirmed, like a lost PUBACK.
+def record_publishes(client, confirm=None):
+    published = []
+    confirm = confirm if confirm is not None else [True]
+    def publish(topic, payload, qos=0):
+        client._pub_mid += 1
+        published.append((topic, payload))
+        if client.on_publish is not None and confirm[0]:
+            client.on_publish(client, None, client._pub_mid)
+    client.publish = publish
+    return(published)
+
+
+# Wait up to timeout seconds for condition() to be true.  Returns its last result
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return(condition())
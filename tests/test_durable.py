@@ -0,0 +1,96 @@
+# DurableQueue:  replay after a restart, trimming the log, and messages the broker never confirmed
+
+import os
+
+from conftest import mr, record_publishes, start, wait_for, write_cfg
+
+
+def durable_cfg(tmpdir, *extra):
+    return(write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                              'set DEST DURABLE_DIR %s' % os.path.join(str(tmpdir), 'durable'),
+                              'set DEST DURABLE_SEGMENT_SIZE 300', 'set DEST BACKOFF_MIN 0.1',
+                              'SRC /a DEST out'] + list(extra)))
+
+
+def log_files(tmpdir):
+    return(sorted(f for f in os.listdir(os.path.join(str(tmpdir), 'durable', 'DEST')) if f.endswith('.log')))
+
+
+def checkpoint(tmpdir):
+    filename = os.path.join(str(tmpdir), 'durable', 'DEST', 'checkpoint')
+    if not os.path.exists(filename):
+        return(None)
+    with open(filename) as f:
+        return(int(f.read()))
+
+
+def unconfirmed(repeater):
+    return(repeater.dispatch_stats()['DEST']['unconfirmed'])
+
+
+def test_replay_after_restart_then_trim(repeater, tmpdir):
+    start(repeater, durable_cfg(tmpdir))
+    repeater.settings_dict['DEST']['connected'] = False
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(30):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: repeater.dispatch_stats()['DEST']['buffered'] == 30)
+    repeater.stop_sinks()
+    assert len(log_files(tmpdir)) > 1   # DURABLE_SEGMENT_SIZE is small
+
+    repeater.settings_dict.clear()
+    start(repeater, durable_cfg(tmpdir))
+    dest = repeater.settings_dict['DEST']['instance']
+    published = record_publishes(dest)
+    assert repeater.settings_dict['DEST']['dispatcher'].durable.replay_count == 30
+    repeater.connected(dest)
+    assert wait_for(lambda: len(published) == 30)
+    assert [int(payload) for topic, payload in published] == list(range(30))
+    assert wait_for(lambda: unconfirmed(repeater) == 0 and checkpoint(tmpdir) == 30)
+    assert len(log_files(tmpdir)) == 1
+
+
+def test_unconfirmed_messages_sent_again(repeater, tmpdir):
+    start(repeater, durable_cfg(tmpdir, 'set DEST DURABLE_ACK_TIMEOUT 0.3'))
+    confirm = [False]
+    published = record_publishes(repeater.settings_dict['DEST']['instance'], confirm)
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(5):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: len(published) >= 10)   # Sent again after DURABLE_ACK_TIMEOUT
+    assert unconfirmed(repeater) == 5
+    confirm[0] = True
+    assert wait_for(lambda: unconfirmed(repeater) == 0 and checkpoint(tmpdir) == 5)
+    assert [payload for topic, payload in published[5:10]] == ['0', '1', '2', '3', '4']
+
+
+def test_disconnect_sends_unconfirmed_again(repeater, tmpdir):
+    start(repeater, durable_cfg(tmpdir))
+    confirm = [False]
+    dest = repeater.settings_dict['DEST']['instance']
+    published = record_publishes(dest, confirm)
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(5):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: len(published) == 5)
+    confirm[0] = True
+    repeater.disconnected(dest)   # Reconnects after BACKOFF_MIN
+    assert wait_for(lambda: len(published) == 10)
+    assert wait_for(lambda: unconfirmed(repeater) == 0)
+    assert repeater.settings_dict['DEST']['dispatcher'].durable.mids == {}
+
+
+def test_mid_reuse_and_early_confirmation(tmpdir):
+    c = {'DURABLE_DIR': str(tmpdir), 'DURABLE_SYNC': 60, 'DURABLE_SEGMENT_SIZE': 1000000, 'DURABLE_ACK_TIMEOUT': 60}
+    requeued = []
+    durable = mr.DurableQueue('DEST', c, requeued.extend)
+    items = [('SRC', '/a', 'out', str(i), durable.append(('SRC', '/a', 'out', str(i)))) for i in range(3)]
+    durable.sent(7, items[0])
+    durable.sent(7, items[1])   # paho gave out 7 again, so the first one's confirmation was lost
+    assert requeued == [items[0]]
+    durable.published(None, None, 7)
+    durable.published(None, None, 8)   # Before sent(), as can happen with QOS 0
+    durable.sent(8, items[2])
+    assert durable.acked == set([items[1][4], items[2][4]])
+    assert durable.mids == {} and durable.early == {}
+    durable.close(0)
@@ -0,0 +1,62 @@
+# FileWriter:  CSV lines, flushing and rotation of 'file' outputs
+
+import glob
+import gzip
+import os
+
+from conftest import start, wait_for, write_cfg
+
+
+def file_cfg(tmpdir, *extra):
+    return(write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt',
+                              'set FILE1 TOPIC_FMT file',
+                              'set FILE1 FILENAME %s' % os.path.join(str(tmpdir), 'out.csv'),
+                              'SRC /a/+ FILE1'] + list(extra)))
+
+
+# Payloads written to out.csv and its rotated (and maybe gzipped) files
+def payloads(tmpdir):
+    lines = []
+    for filename in glob.glob(os.path.join(str(tmpdir), 'out.csv*')):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as f:
+            lines.extend(line.decode('utf-8') for line in f)
+    return([line.rstrip('\n').split(',', 3)[3] for line in lines])
+
+
+# 500 messages, in bursts of 100.  The writer checks the file size after each lot it takes from its queue
+def send_in_bursts(repeater):
+    source = repeater.settings_dict['SRC']['instance']
+    writer = repeater.settings_dict['FILE1']['writer']
+    for i in range(500):
+        repeater.message(source, '/a/x', str(i))
+        if i % 100 == 99:
+            wait_for(lambda: repeater.dispatch_stats()['FILE1']['delivered'] == i + 1 and writer.pending_count() == 0)
+
+
+def test_csv_lines(repeater, tmpdir):
+    start(repeater, file_cfg(tmpdir))
+    source = repeater.settings_dict['SRC']['instance']
+    repeater.message(source, '/a/x', 'hello')
+    repeater.message(source, '/a/y', '1.5')
+    repeater.stop_sinks()
+    with open(os.path.join(str(tmpdir), 'out.csv')) as f:
+        lines = [line.rstrip('\n').split(',') for line in f]
+    assert [line[1:] for line in lines] == [['SRC', '/a/x', 'hello'], ['SRC', '/a/y', '1.5']]
+
+
+def test_rotation_keeps_every_line(repeater, tmpdir):
+    start(repeater, file_cfg(tmpdir, 'set FILE1 ROTATE_SIZE 2000', 'set FILE1 FLUSH_SIZE 100'))
+    send_in_bursts(repeater)
+    repeater.stop_sinks()
+    assert len(glob.glob(os.path.join(str(tmpdir), 'out.csv.*'))) >= 2
+    assert sorted(int(payload) for payload in payloads(tmpdir)) == list(range(500))
+
+
+def test_rotated_files_are_gzipped(repeater, tmpdir):
+    start(repeater, file_cfg(tmpdir, 'set FILE1 ROTATE_SIZE 2000', 'set FILE1 FLUSH_SIZE 100', 'set FILE1 COMPRESS 1'))
+    send_in_bursts(repeater)
+    repeater.stop_sinks()
+    rotated = lambda: glob.glob(os.path.join(str(tmpdir), 'out.csv.*'))
+    assert wait_for(lambda: rotated() and all(filename.endswith('.gz') for filename in rotated()))  # gzip runs in the background
+    assert sorted(int(payload) for payload in payloads(tmpdir)) == list(range(500))
@@ -0,0 +1,74 @@
+# RouteFilter:  ON_CHANGE, DEADBAND, MIN_INTERVAL and MAX_RATE on mapping lines
+
+from conftest import mr, record_publishes, start, wait_for, write_cfg
+
+
+# Payloads a filter lets through, for (payload, time) pairs
+def passed(options, messages, dtopic='out'):
+    route = mr.Route('/a', 'DEST', 'out', options)
+    f = route.filter('/a', dtopic)
+    return([payload for payload, now in messages if f.allow(('SRC', '/a', dtopic, payload), now)])
+
+
+def test_on_change():
+    assert passed({'ON_CHANGE': '1'}, [('1', 0), ('1', 1), ('2', 2), ('2', 3), ('1', 4)]) == ['1', '2', '1']
+
+
+def test_deadband():
+    messages = [('20.0', 0), ('20.3', 1), ('20.6', 2), ('20.6', 3), ('off', 4), ('off', 5), ('19.0', 6)]
+    assert passed({'DEADBAND': '0.5'}, messages) == ['20.0', '20.6', 'off', '19.0']
+
+
+def test_min_interval():
+    messages = [(str(i), i * 0.4) for i in range(10)]   # Every 0.4 seconds
+    assert passed({'MIN_INTERVAL': '1'}, messages) == ['0', '3', '6', '9']
+
+
+def test_filters_are_per_destination_topic():
+    route = mr.Route('/a/+', 'DEST', 'out/{1}', {'ON_CHANGE': '1'})
+    assert route.filter('/a/x', 'out/x').allow(('SRC', '/a/x', 'out/x', '1'), 0)
+    assert route.filter('/a/y', 'out/y').allow(('SRC', '/a/y', 'out/y', '1'), 0)
+    assert not route.filter('/a/x', 'out/x').allow(('SRC', '/a/x', 'out/x', '1'), 1)
+
+
+def test_max_rate_sends_latest_held_value(repeater, tmpdir):
+    start(repeater, write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                       'SRC /a DEST out MAX_RATE=5']))
+    published = record_publishes(repeater.settings_dict['DEST']['instance'])
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(10):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: len(published) == 6)
+    assert [payload for topic, payload in published] == ['0', '1', '2', '3', '4', '9']   # A second's worth, then the latest
+
+
+def test_least_recently_used_filters_are_forgotten(monkeypatch):
+    monkeypatch.setattr(mr.Route, 'filter_limit', 10)
+    route = mr.Route('/a/+', 'DEST', 'out/{1}', {'ON_CHANGE': '1'})
+    for i in range(10):
+        route.filter('/a/%d' % i, 'out/%d' % i).allow(('SRC', '/a/%d' % i, 'out/%d' % i, '1'), i)
+    route.filter('/a/0', 'out/0').allow(('SRC', '/a/0', 'out/0', '1'), 10)   # Used again, so it is kept
+    route.filter('/a/new', 'out/new')
+    assert len(route.filters) <= 10
+    assert 'out/0' in route.filters and 'out/new' in route.filters and 'out/1' not in route.filters
+
+
+def test_shared_partition_splits_rate_between_workers(repeater, tmpdir):
+    repeater.read_cfgfile(write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                             'SRC /a DEST out MAX_RATE=4 MIN_INTERVAL=0.5']))
+    repeater.partition_rules(0, 4, 'shared')
+    route = repeater.settings_dict['SRC']['topic_map_dict']['/a'][0]
+    assert (route.max_rate, route.min_interval) == (1, 2)
+
+
+# The RouteTable caches filters per incoming topic.  A forgotten filter must not stay in use from there
+def test_forgotten_filters_leave_the_lookup_cache(monkeypatch):
+    monkeypatch.setattr(mr.Route, 'filter_limit', 10)
+    route = mr.Route('/a/+', 'DEST', 'out/{1}', {'ON_CHANGE': '1'})
+    table = mr.RouteTable({'/a/+': [route]}, 100)
+    first = table.lookup('/a/0')[0][2]
+    for i in range(11):  # The 11th forgets the least recently used half, /a/0 first
+        table.lookup('/a/%d' % i)[0][2].allow(('SRC', '/a/%d' % i, 'out/%d' % i, '1'), i)
+    assert 'out/0' not in route.filters
+    again = table.lookup('/a/0')[0][2]
+    assert again is not first and again is route.filters['out/0']
@@ -0,0 +1,127 @@
+# ValueCache, the /value and /values HTTP queries, and the util/ query tools that use them
+
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from conftest import mr
+
+try:
+    from urllib.request import urlopen  # Python 3
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError  # Python 2
+
+UTIL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util')
+
+
+def filled_cache():
+    cache = mr.ValueCache()
+    for source, topic, payload in [('MQTT_1', '/home/temp', '21'), ('MQTT_1', '/home/hum', '40'),
+                                   ('MQTT_1', '/garage/temp', '5'), ('MQTT_2', '/home/temp', '22')]:
+        cache.set(source, topic, payload, 1000)
+    return(cache)
+
+
+def test_query_prefix_and_source():
+    cache = filled_cache()
+    assert [r[:3] for r in cache.query(prefix='/home/')] == [('MQTT_1', '/home/hum', '40'), ('MQTT_1', '/home/temp', '21'),
+                                                          ('MQTT_2', '/home/temp', '22')]
+    assert [r[:3] for r in cache.query('MQTT_1', prefix='/home/')] == [('MQTT_1', '/home/hum', '40'), ('MQTT_1', '/home/temp', '21')]
+    assert [r[:3] for r in cache.query('MQTT_2')] == [('MQTT_2', '/home/temp', '22')]
+    assert [r[:3] for r in cache.query(topics=['/home/temp', '/nothing'])] == [('MQTT_1', '/home/temp', '21'), ('MQTT_2', '/home/temp', '22')]
+
+
+def test_merge_keeps_newest():
+    cache = filled_cache()
+    cache.merge([('MQTT_1', '/home/temp', 'old', 999), ('MQTT_1', '/home/hum', 'new', 1001), ('MQTT_3', '/x', '1', 5)])
+    assert cache.get('MQTT_1', '/home/temp')[0] == '21'
+    assert cache.get('MQTT_1', '/home/hum')[0] == 'new'
+    assert cache.sources() == ['MQTT_1', 'MQTT_2', 'MQTT_3']
+
+
+# The HTTP server on a free port, serving filled_cache().  Yields its URL
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(mr, 'value_cache', filled_cache())
+    http_server = mr.start_http_server('127.0.0.1', 0)
+    yield 'http://127.0.0.1:%d' % http_server.server_address[1]
+    http_server.shutdown()
+    http_server.server_close()
+    mr.http_server = None
+
+
+def get(url):
+    reply = urlopen(url, timeout=5)
+    try:
+        return(reply.read().decode('utf-8'))
+    finally:
+        reply.close()
+
+
+def test_http_value(server):
+    assert get(server + '/value?source=MQTT_1&topic=/home/temp') == '21'
+    with pytest.raises(HTTPError) as error:
+        get(server + '/value?source=MQTT_1&topic=/nothing')
+    assert error.value.code == 404
+    with pytest.raises(HTTPError) as error:
+        get(server + '/value?source=MQTT_1')
+    assert error.value.code == 400
+
+
+def test_http_values(server):
+    found = json.loads(get(server + '/values?prefix=/home/'))
+    assert [(v['source'], v['topic'], v['value']) for v in found] == [('MQTT_1', '/home/hum', '40'), ('MQTT_1', '/home/temp', '21'),
+                                                                      ('MQTT_2', '/home/temp', '22')]
+    found = json.loads(get(server + '/values?source=MQTT_1&topic=/home/temp&topic=/garage/temp'))
+    assert sorted(v['value'] for v in found) == ['21', '5']
+    assert len(json.loads(get(server + '/values'))) == 4
+
+
+# Runs a util/ script in tmpdir, where db/mqtt_repeater.db has MQTT_1 /home/temp = 'from db'.  Returns (exit code, output)
+def run_tool(tmpdir, script, *args):
+    os.mkdir(os.path.join(str(tmpdir), 'db'))
+    dbconn = sqlite3.connect(os.path.join(str(tmpdir), 'db', 'mqtt_repeater.db'))
+    mr.setup_sqldb(dbconn)
+    dbconn.execute("INSERT INTO states VALUES ('MQTT_1', '/home/temp', 'from db', '2016-05-01T12:00:00')")
+    dbconn.commit()
+    dbconn.close()
+    p = subprocess.Popen([sys.executable, os.path.join(UTIL, script)] + list(args), cwd=str(tmpdir),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return(p.returncode, out.decode('utf-8').strip())
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return('http://127.0.0.1:%d' % port)
+
+
+def test_query_tool_asks_repeater_first(server, tmpdir):
+    assert run_tool(tmpdir, 'mqtt_db_query.py', '--url', server, 'MQTT_1', '/home/temp') == (0, '21')
+
+
+def test_query_tool_falls_back_to_db(tmpdir):
+    assert run_tool(tmpdir, 'mqtt_db_query.py', '--url', closed_port(), 'MQTT_1', '/home/temp') == (0, 'from db')
+
+
+def test_query_tool_db_and_url_conflict(tmpdir):
+    assert run_tool(tmpdir, 'mqtt_db_query.py', '--db', 'db/mqtt_repeater.db', '--url', closed_port(), 'MQTT_1', '/x')[0] == 2
+
+
+def test_dump_tool(server, tmpdir):
+    code, out = run_tool(tmpdir, 'mqtt_db_dump.py', '--url', server, '--prefix', '/home/')
+    assert code == 0 and sorted(line.split('\t')[2] for line in out.splitlines()) == ['21', '22', '40']
+
+
+def test_dump_tool_falls_back_to_db(tmpdir):
+    code, out = run_tool(tmpdir, 'mqtt_db_dump.py', '--url', closed_port())
+    assert (code, out.split('\t')[:3]) == (0, ['MQTT_1', '/home/temp', 'from db'])
@@ -0,0 +1,106 @@
+# OutageBuffer and reconnect backoff for broker destinations
+
+import threading
+import time
+
+from conftest import record_publishes, start, wait_for, write_cfg
+
+
+def start_outage(repeater, tmpdir, *extra):
+    start(repeater, write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                       'SRC /a DEST out'] + list(extra)))
+    published = record_publishes(repeater.settings_dict['DEST']['instance'])
+    repeater.settings_dict['DEST']['connected'] = False   # Down, as disconnected() leaves it
+    return(repeater.settings_dict['SRC']['instance'], published)
+
+
+def stats(repeater):
+    return(repeater.dispatch_stats()['DEST'])
+
+
+def test_buffered_while_down_then_sent_in_order(repeater, tmpdir):
+    source, published = start_outage(repeater, tmpdir)
+    for i in range(50):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: stats(repeater)['buffered'] == 50)
+    assert published == []
+    repeater.connected(repeater.settings_dict['DEST']['instance'])
+    for i in range(50, 60):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: len(published) == 60)
+    assert [int(payload) for topic, payload in published] == list(range(60))
+
+
+def test_full_buffer_drops_oldest(repeater, tmpdir):
+    source, published = start_outage(repeater, tmpdir, 'set DEST BUFFER_SIZE 10')
+    for i in range(25):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: stats(repeater)['buffer_dropped'] == 15)
+    repeater.connected(repeater.settings_dict['DEST']['instance'])
+    assert wait_for(lambda: len(published) == 10)
+    assert [int(payload) for topic, payload in published] == list(range(15, 25))
+
+
+def test_spill_file_kept_for_next_run(repeater, tmpdir):
+    source, published = start_outage(repeater, tmpdir, 'set DEST BUFFER_SIZE 10', 'set DEST BUFFER_SPILL_DIR %s' % tmpdir)
+    for i in range(25):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: stats(repeater)['buffered'] == 25)
+    assert stats(repeater)['buffer_dropped'] == 0
+    repeater.stop_sinks()
+    repeater.settings_dict.clear()
+    source, published = start_outage(repeater, tmpdir, 'set DEST BUFFER_SIZE 10', 'set DEST BUFFER_SPILL_DIR %s' % tmpdir)
+    assert stats(repeater)['buffered'] == 25
+    repeater.connected(repeater.settings_dict['DEST']['instance'])
+    assert wait_for(lambda: len(published) == 25)
+    assert [int(payload) for topic, payload in published] == list(range(25))
+
+
+# New messages are held behind the backlog, but DRAIN_RATE must not hold them to that rate too
+def test_drain_rate_keeps_up_with_new_messages(repeater, tmpdir):
+    source, published = start_outage(repeater, tmpdir, 'set DEST DRAIN_RATE 20', 'set DEST BUFFER_SIZE 100')
+    for i in range(10):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: stats(repeater)['buffered'] == 10)
+    repeater.connected(repeater.settings_dict['DEST']['instance'])
+    for i in range(10, 310):  # 300 at ~500/sec.  Far more than DRAIN_RATE
+        repeater.message(source, '/a', str(i))
+        time.sleep(0.002)
+    assert wait_for(lambda: len(published) == 310, 3)
+    assert [int(payload) for topic, payload in published] == list(range(310))
+    assert stats(repeater)['buffer_dropped'] == 0
+
+
+def test_backoff_grows_until_a_connection_lasts(repeater, tmpdir):
+    c = {'RETRY_COUNTER': 1, 'BACKOFF_MIN': 1, 'BACKOFF_MAX': 1000}
+    delays = []
+    for i in range(6):  # Connects, then dropped straight away
+        c['connected_at'] = time.time()
+        delays.append(repeater.next_backoff(c))
+    assert delays[-1] >= 16
+    c['connected_at'] = time.time() - repeater.STABLE_CONNECTION
+    assert repeater.next_backoff(c) <= 1
+
+
+# The drain thread sends the last backlog message outside the buffer's lock.  A new message must still wait for it
+def test_new_message_waits_for_last_backlog_message(repeater, tmpdir):
+    source, published = start_outage(repeater, tmpdir)
+    repeater.message(source, '/a', '0')
+    assert wait_for(lambda: stats(repeater)['buffered'] == 1)
+    tracker = repeater.settings_dict['DEST']['dispatcher'].tracker
+    wait_room = tracker.wait_room
+    draining = threading.Event()
+    go = threading.Event()
+    def slow_wait_room(c):  # The drain's send() of message 0 is held up here, before it publishes
+        if threading.current_thread().name.startswith('drain-'):
+            draining.set()
+            go.wait(5)
+        wait_room(c)
+    tracker.wait_room = slow_wait_room
+    repeater.connected(repeater.settings_dict['DEST']['instance'])
+    assert draining.wait(5)
+    repeater.message(source, '/a', '1')
+    wait_for(lambda: len(published) == 1, 0.3)
+    go.set()
+    assert wait_for(lambda: len(published) == 2)
+    assert [int(payload) for topic, payload in published] == [0, 1]
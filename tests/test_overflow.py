@@ -0,0 +1,60 @@
+# Dispatcher OVERFLOW policies, with the destination's worker held up and its queue full
+
+import threading
+
+import pytest
+
+from conftest import start, wait_for, write_cfg
+
+
+# Start SRC -> DEST with a 5 message queue, and a publish() that waits for 'release'.  Message 0 is taken by the
+#  worker and held there, 1..5 fill the queue
+def stalled(repeater, tmpdir, overflow):
+    start(repeater, write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                       'set DEST DISPATCH_QUEUE_SIZE 5', 'set DEST OVERFLOW %s' % overflow,
+                                       'SRC /a DEST out']))
+    client = repeater.settings_dict['DEST']['instance']
+    published = []
+    release = threading.Event()
+    def publish(topic, payload, qos=0):
+        release.wait(10)
+        client._pub_mid += 1
+        published.append(int(payload))
+    client.publish = publish
+    source = repeater.settings_dict['SRC']['instance']
+    repeater.message(source, '/a', '0')
+    assert wait_for(lambda: repeater.dispatch_stats()['DEST']['depth'] == 0)
+    for i in range(1, 6):
+        repeater.message(source, '/a', str(i))
+    return(source, published, release)
+
+
+@pytest.mark.parametrize('overflow, expected', [
+    ('drop-newest', [0, 1, 2, 3, 4, 5]),
+    ('drop-oldest', [0, 5, 6, 7, 8, 9]),
+])
+def test_drop_policies(repeater, tmpdir, overflow, expected):
+    source, published, release = stalled(repeater, tmpdir, overflow)
+    for i in range(6, 10):
+        repeater.message(source, '/a', str(i))   # Doesn't wait
+    assert repeater.dispatch_stats()['DEST']['dropped'] == 4
+    release.set()
+    assert wait_for(lambda: len(published) == 6)
+    assert published == expected
+
+
+def test_block_waits_for_room(repeater, tmpdir):
+    source, published, release = stalled(repeater, tmpdir, 'block')
+    def more():
+        for i in range(6, 10):
+            repeater.message(source, '/a', str(i))
+    sender = threading.Thread(target=more)
+    sender.daemon = True
+    sender.start()
+    sender.join(0.3)
+    assert sender.is_alive()   # Waiting for room in the queue
+    release.set()
+    sender.join(5)
+    assert wait_for(lambda: len(published) == 10)
+    assert published == list(range(10))
+    assert repeater.dispatch_stats()['DEST']['dropped'] == 0
@@ -0,0 +1,93 @@
+# PublishTracker (MAX_QUEUED) and Batcher (BATCH_INTERVAL) for MQTT destinations
+
+import json
+import threading
+import time
+
+from conftest import mr, record_publishes, start, wait_for, write_cfg
+
+
+def tracker(**settings):
+    return(mr.PublishTracker('DEST', dict(mr.settings_defaults_dict, MAX_QUEUED=2, **settings)))
+
+
+def test_lost_confirmations_expire():
+    t = tracker(ACK_TIMEOUT=0.2)
+    t.sent(1)
+    t.sent(2)   # Neither is ever confirmed
+    done = threading.Event()
+    def publish():
+        t.wait_room({'connected': True})
+        done.set()
+    waiter = threading.Thread(target=publish)
+    waiter.daemon = True
+    waiter.start()
+    assert done.wait(3)
+    assert len(t) == 0
+
+
+def test_reconnect_clears_waiting_confirmations():
+    for qos in (0, 1):
+        t = mr.PublishTracker('DEST', dict(mr.settings_defaults_dict, QOS=qos, MAX_QUEUED=2))
+        t.sent(1)
+        t.sent(2)
+        t.reconnected()
+        assert len(t) == 0
+
+
+def test_stale_early_confirmation_is_not_used_for_a_reused_mid(monkeypatch):
+    monkeypatch.setattr(mr.PublishTracker, 'early_window', 0.05)
+    t = tracker()
+    t.published(7)   # on_publish before sent().  Matched up straight after
+    t.sent(7)
+    assert (t.completed, len(t)) == (1, 0)
+    t.published(8)   # ...but not when it is old.  That was for an earlier message with the same mid
+    time.sleep(0.1)
+    t.sent(8)
+    assert (t.completed, len(t)) == (1, 1)
+    t.published(8)
+    assert (t.completed, len(t)) == (2, 0)
+
+
+def test_batch_due_while_down_is_held(repeater, tmpdir):
+    start(repeater, write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                       'set DEST BATCH_INTERVAL 0.3', 'set DEST BATCH_TOPIC batch',
+                                       'SRC /a/+ DEST {1}']))
+    client = repeater.settings_dict['DEST']['instance']
+    published = record_publishes(client)
+    source = repeater.settings_dict['SRC']['instance']
+    repeater.message(source, '/a/x', '1')
+    repeater.message(source, '/a/y', '2')
+    assert wait_for(lambda: repeater.settings_dict['DEST']['dispatcher'].batcher.count == 2)
+    repeater.settings_dict['DEST']['connected'] = False   # Goes down before BATCH_INTERVAL is up
+    assert wait_for(lambda: repeater.dispatch_stats()['DEST']['buffered'] == 1)
+    assert published == []
+    repeater.connected(client)
+    assert wait_for(lambda: len(published) == 1)
+    assert published == [('batch', '{"x":"1","y":"2"}')]
+
+
+# Everything from an outage, and what comes while it drains, still goes out as batches on BATCH_TOPIC
+def test_outage_with_batching_only_sends_batches(repeater, tmpdir):
+    start(repeater, write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                       'set DEST BATCH_INTERVAL 0.1', 'set DEST BATCH_TOPIC batch',
+                                       'SRC /+ DEST {1}']))
+    client = repeater.settings_dict['DEST']['instance']
+    published = record_publishes(client)
+    source = repeater.settings_dict['SRC']['instance']
+    repeater.settings_dict['DEST']['connected'] = False
+    for i in range(5):
+        repeater.message(source, '/t%d' % i, str(i))
+    assert wait_for(lambda: repeater.dispatch_stats()['DEST']['buffered'] >= 1)
+    repeater.connected(client)
+    for i in range(5, 10):
+        repeater.message(source, '/t%d' % i, str(i))
+    values = dict()
+    def collected():
+        values.clear()
+        for topic, payload in published:
+            values.update(json.loads(payload))
+        return(len(values) == 10)
+    assert wait_for(collected)
+    assert set(topic for topic, payload in published) == set(['batch'])
+    assert values == dict(('t%d' % i, str(i)) for i in range(10))
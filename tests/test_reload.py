@@ -0,0 +1,69 @@
+# Hot reload (apply_settings) of a destination while it is down
+
+import threading
+
+import pytest
+
+from conftest import record_publishes, start, wait_for, write_cfg
+
+
+def dest_cfg(tmpdir, *extra):
+    return(write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                              'SRC /a DEST out'] + list(extra)))
+
+
+# Buffered in memory, spilled to a file, or in a durable log that the new DEST replays or doesn't
+@pytest.mark.parametrize('old, new', [
+    ([], ['set DEST BUFFER_SIZE 5000']),
+    (['set DEST BUFFER_SIZE 20', 'set DEST BUFFER_SPILL_DIR {tmp}'], ['set DEST BUFFER_SIZE 30', 'set DEST BUFFER_SPILL_DIR {tmp}']),
+    (['set DEST DURABLE_DIR {tmp}/durable'], ['set DEST DURABLE_DIR {tmp}/durable', 'set DEST BACKOFF_MIN 2']),
+    (['set DEST DURABLE_DIR {tmp}/durable'], ['set DEST DURABLE_DIR {tmp}/durable2']),
+])
+def test_reload_while_down_keeps_messages(repeater, tmpdir, monkeypatch, old, new):
+    old = [line.format(tmp=tmpdir) for line in old]
+    new = [line.format(tmp=tmpdir) for line in new]
+    start(repeater, dest_cfg(tmpdir, *old))
+    repeater.settings_dict['DEST']['connected'] = False   # Down, as disconnected() leaves it
+    old_client = repeater.settings_dict['DEST']['instance']
+    published = record_publishes(old_client)
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(100):
+        repeater.message(source, '/a', str(i))
+    assert wait_for(lambda: repeater.dispatch_stats()['DEST']['buffered'] == 100)
+
+    monkeypatch.setattr(repeater, 'cfgfile', dest_cfg(tmpdir, *new))
+    monkeypatch.setattr(repeater, 'connect_instance', lambda name: None)  # Still down after the reload
+    def send_more():  # Keeps coming while the reload swaps DEST
+        for i in range(100, 3000):
+            repeater.message(source, '/a', str(i))
+    t = threading.Thread(target=send_more)
+    t.start()
+    repeater.reload_settings()
+    t.join()
+
+    client = repeater.settings_dict['DEST']['instance']
+    assert client is not old_client and published == []
+    published = record_publishes(client)
+    repeater.connected(client)
+    assert wait_for(lambda: len(set(published)) == 3000), len(published)
+    assert sorted(int(payload) for topic, payload in set(published)) == list(range(3000))
+    assert [int(payload) for topic, payload in published[:100]] == list(range(100))
+
+
+# An instance that is already running, with the same settings, becomes a destination.  Its client must report the
+#  broker's confirmations to the new Dispatcher
+def test_running_instance_becomes_destination(repeater, tmpdir, monkeypatch):
+    lines = ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt', 'set OTHER TOPIC_FMT rawmqtt_fmt',
+             'set OTHER DURABLE_DIR %s' % tmpdir.join('durable'), 'SRC /a DEST out', 'OTHER /z DEST z']
+    start(repeater, write_cfg(tmpdir, lines))
+    client = repeater.settings_dict['OTHER']['instance']
+    published = record_publishes(client)
+    monkeypatch.setattr(repeater, 'cfgfile', write_cfg(tmpdir, lines + ['SRC /b OTHER out'], 'new.cfg'))
+    repeater.reload_settings()
+    assert repeater.settings_dict['OTHER']['instance'] is client   # Not restarted
+    for i in range(5):
+        repeater.message(repeater.settings_dict['SRC']['instance'], '/b', str(i))
+    assert wait_for(lambda: repeater.dispatch_stats()['OTHER']['completed'] == 5)
+    assert [payload for topic, payload in published] == [str(i) for i in range(5)]
+    stats = repeater.dispatch_stats()['OTHER']
+    assert (stats['inflight'], stats['unconfirmed']) == (0, 0)
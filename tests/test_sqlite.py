@@ -0,0 +1,66 @@
+# SqliteWriter:  batched writes of the last value per feed, and the optional history table
+
+import os
+import sqlite3
+
+from conftest import mr, start, write_cfg
+
+
+def db_cfg(tmpdir, *extra):
+    return(write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt',
+                              'set DB1 TOPIC_FMT sqlite',
+                              'set DB1 FILENAME %s' % os.path.join(str(tmpdir), 'test.db'),
+                              'SRC /a/+ DB1'] + list(extra)))
+
+
+def test_last_value_per_feed(repeater, tmpdir):
+    start(repeater, db_cfg(tmpdir))
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(100):
+        repeater.message(source, '/a/%d' % (i % 3), str(i))
+    repeater.stop_sinks()
+    rows = sqlite3.connect(os.path.join(str(tmpdir), 'test.db')).execute(
+        'SELECT source_feed, value FROM states ORDER BY source_feed').fetchall()
+    assert rows == [('/a/0', '99'), ('/a/1', '97'), ('/a/2', '98')]
+
+
+def test_history_keeps_every_value(repeater, tmpdir):
+    start(repeater, db_cfg(tmpdir, 'set DB1 HISTORY 1'))
+    source = repeater.settings_dict['SRC']['instance']
+    for i in range(10):
+        repeater.message(source, '/a/x', str(i))
+    repeater.stop_sinks()
+    dbconn = sqlite3.connect(os.path.join(str(tmpdir), 'test.db'))
+    assert [row[0] for row in dbconn.execute('SELECT value FROM history ORDER BY rowid')] == [str(i) for i in range(10)]
+    assert dbconn.execute('SELECT sum(count), min(min), max(max) FROM history_rollup WHERE period=60').fetchone() == (10, 0, 9)
+
+
+def test_existing_duplicates_are_collapsed(tmpdir):
+    filename = os.path.join(str(tmpdir), 'old.db')
+    dbconn = sqlite3.connect(filename)
+    dbconn.execute('CREATE TABLE states (source_label text, source_feed text, value text, last_timestamp text)')
+    dbconn.executemany('INSERT INTO states VALUES (?,?,?,?)', [('SRC', '/a', '1', ''), ('SRC', '/a', '2', '')])
+    dbconn.commit()
+    mr.setup_sqldb(dbconn)
+    assert dbconn.execute('SELECT value FROM states').fetchall() == [('2',)]
+
+
+class LockedDB(object):
+    def executemany(self, sql, rows):
+        raise sqlite3.OperationalError('database is locked')
+
+    def rollback(self):
+        pass
+
+
+def test_locked_db_keeps_newest_history_up_to_history_buffer(tmpdir):
+    c = dict(mr.sqlite_defaults_dict, FILENAME=os.path.join(str(tmpdir), 'test.db'), HISTORY=1, HISTORY_BUFFER=50)
+    writer = mr.SqliteWriter('DB1', c)
+    for i in range(3):  # Three failed flushes while new rows keep coming
+        writer.submit('SRC', '/a', str(i * 40), '', i * 40)
+        batch, history = writer.pending, writer.history
+        writer.pending, writer.history = dict(), [('SRC', '/a', ts, str(ts)) for ts in range(i * 40 + 1, i * 40 + 40)]
+        writer.write(LockedDB(), batch, history)
+    assert [row[2] for row in writer.history] == list(range(70, 120))
+    assert writer.dropped == 70
+    assert writer.pending == {('SRC', '/a'): ('80', '')}
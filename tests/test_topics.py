@@ -0,0 +1,89 @@
+# TopicTrie matching, subscription lists and RouteTable lookups
+
+import itertools
+
+from conftest import mr, start, write_cfg
+
+
+# Reference version of TopicTrie.covering():  does filter a match every topic filter b matches?
+def covers(a, b):
+    alevels = a.split('/')
+    blevels = b.split('/')
+    for i, level in enumerate(alevels):
+        if i == 0 and level in ('#', '+') and blevels[0].startswith('$'):
+            return(False)
+        if level == '#':
+            return(True)
+        if i >= len(blevels) or blevels[i] == '#':
+            return(False)
+        if level != '+' and level != blevels[i]:
+            return(False)
+    return(len(alevels) == len(blevels))
+
+
+def test_valid_topic_filter():
+    for good in ('a', 'a/b', '+', '#', 'a/+/c', 'a/#', '/a/+', '+/+/#'):
+        assert mr.valid_topic_filter(good)
+    for bad in ('a/#/c', 'a+', 'a/b#', '#/a', 'a/+b'):
+        assert not mr.valid_topic_filter(bad)
+
+
+def test_match_captures():
+    trie = mr.TopicTrie()
+    for f in ('/farm/+/temp', '/farm/#', '/farm/barn/temp', '+/x', '#'):
+        trie.insert(f, f)
+    found = dict(trie.match('/farm/barn/temp'))
+    assert found == {'/farm/+/temp': ('barn',), '/farm/#': ('barn/temp',), '/farm/barn/temp': (), '#': ('/farm/barn/temp',)}
+    assert dict(trie.match('/farm')) == {'/farm/#': ('',), '#': ('/farm',)}   # 'a/#' matches 'a' too
+    assert dict(trie.match('a/x')) == {'+/x': ('a',), '#': ('a/x',)}
+
+
+def test_wildcards_skip_dollar_topics():
+    trie = mr.TopicTrie()
+    for f in ('#', '+/broker', '$SYS/#'):
+        trie.insert(f, f)
+    assert [value for value, captures in trie.match('$SYS/broker')] == ['$SYS/#']
+
+
+def test_covering_matches_reference():
+    levels = ['a', 'b', '+', '#', '$x']
+    filters = set()
+    for depth in (1, 2, 3):
+        for combo in itertools.product(levels, repeat=depth):
+            f = '/'.join(combo)
+            if mr.valid_topic_filter(f) and ('$x' not in combo or combo[0] == '$x'):
+                filters.add(f)
+    filters = sorted(filters)
+    trie = mr.TopicTrie()
+    for f in filters:
+        trie.insert(f, f)
+    for b in filters:
+        assert sorted(trie.covering(b)) == sorted(a for a in filters if covers(a, b)), b
+
+
+def test_subscriptions_leave_out_covered_rules():
+    routes = dict((feed, []) for feed in ('/a/b', '/a/+', '/a/+/c', '/a/#', '/x/y', '/x/+/z', '$SYS/a', '+/a'))
+    table = mr.RouteTable(routes, 100)
+    assert sorted(table.subscriptions) == ['$SYS/a', '+/a', '/a/#', '/x/+/z', '/x/y']
+
+
+def test_subscriptions_many_rules():
+    feeds = ['/site/%d/+/%d' % (i % 50, i) for i in range(3000)] + ['/site/%d/#' % i for i in range(0, 50, 7)]
+    table = mr.RouteTable(dict((feed, []) for feed in feeds), 100)
+    expected = [a for a in feeds if not any(b != a and covers(b, a) for b in feeds[3000:])]
+    assert sorted(table.subscriptions) == sorted(expected)
+
+
+def test_lookup_sends_once_per_destination(repeater, tmpdir):
+    start(repeater, write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                       'SRC /a/# DEST out/{1}', 'SRC /a/+ DEST out/{1}', 'SRC /a/b DEST other']))
+    assert sorted(r[:2] for r in repeater.search_map('SRC', '/a/b')) == [('DEST', 'other'), ('DEST', 'out/b')]
+    assert sorted(repeater.settings_dict['SRC']['instance'].subscriptions) == ['/a/#']
+
+
+def test_shared_subscriptions(repeater, tmpdir):
+    repeater.read_cfgfile(write_cfg(tmpdir, ['set SRC TOPIC_FMT rawmqtt_fmt', 'set DEST TOPIC_FMT rawmqtt_fmt',
+                                             'SRC /a/+ DEST out', 'SRC /a/b DEST out']))
+    repeater.repeater_settings['SHARE_GROUP'] = 'grp'
+    repeater.partition_rules(0, 2, 'shared')
+    assert repeater.subscription_topics('SRC') == ['$share/grp//a/+']
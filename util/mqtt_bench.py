@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Offline throughput/latency benchmark for mqtt_repeater.py
+#
+# Runs the real message() -> search_map() -> dispatch -> publish path in-process.  Brokers are replaced with a fake
+#  MQTTClient, so nothing connects to the network.  File and sqlite destinations write to a temp directory.
+#
+# Usage:   util/mqtt_bench.py [options]
+#   eg.    util/mqtt_bench.py --messages 100000 --rules 1000 --fanout 2 --sinks mqtt,file,sqlite
+#          util/mqtt_bench.py --durable --qos 2     (MQTT destinations with an on-disk durable queue)
+#          util/mqtt_bench.py --route-options 'MAX_RATE=10 ON_CHANGE=1'   (route filters on every rule)
+#          util/mqtt_bench.py --rate 5000 --payload-size 256 --output before.json
+#          util/mqtt_bench.py --compare before.json     (exit code 1 if slower than --threshold)
+#
+# Reports messages/sec, end-to-end latency (message() called -> destination publish/write call) and memory.
+#
+# Copyright (c) 2016 - mgroseman - Mike Roseman
+# MIT License
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+timer = getattr(time, 'perf_counter', time.time)  # Python 2 doesn't have perf_counter
+
+# Fake broker connection.  Same constructor as the Adafruit_IO MQTTClient used by mqtt_repeater.py.
+#  publish() records the latency of the message, using the sequence number at the start of the payload.
+#  It stands in for the paho client (_client) too, and confirms every publish straight away through on_publish.
+class FakeMQTTClient(object):
+    def __init__(self, username, key, service_host='io.adafruit.com', service_port=1883, client_id=None,
+                 topic_fmt='adafruit_fmt', instance_name=None):
+        self._service_host = service_host
+        self._service_port = service_port
+        self._instance_name = instance_name
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self._client = self
+        self._pub_mid = 0
+        self.subscriptions = []
+
+    def connect(self, **kwargs):
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def disconnect(self):
+        pass
+
+    def loop_background(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def tls_set(self, ca_certs):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def subscribe(self, feed, qos=0):
+        self.subscriptions.append(feed)
+
+    def unsubscribe(self, feed):
+        self.subscriptions.remove(feed)
+
+    def publish(self, topic, payload, qos=0):
+        self._pub_mid += 1
+        record(payload)
+        if self.on_publish is not None:
+            self.on_publish(self, None, self._pub_mid)
+
+
+# Latency bookkeeping.  sent[seq] is filled in before message() is called, latencies are appended by the sinks.
+sent = []
+latencies = []
+latency_lock = threading.Lock()
+
+def record(payload):
+    now = timer()
+    seq = int(payload.split('|', 1)[0])
+    with latency_lock:
+        latencies.append(now - sent[seq])
+
+# Import mqtt_repeater with the fake client in place of Adafruit_IO's
+def load_repeater():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    if 'Adafruit_IO' not in sys.modules:
+        try:
+            import Adafruit_IO
+        except ImportError:  # Not installed.  mqtt_repeater.py only needs the name to exist.
+            sys.modules['Adafruit_IO'] = types.ModuleType('Adafruit_IO')
+            sys.modules['Adafruit_IO'].MQTTClient = FakeMQTTClient
+    import mqtt_repeater
+    mqtt_repeater.MQTTClient = FakeMQTTClient
+    return(mqtt_repeater)
+
+# Write a config file for the requested shape.  One source (SRC), --fanout MQTT destinations, plus FILE1 and/or DB1.
+#  Each rule covers one topic, or a '+' subtree with --wildcard.  Every rule goes to every destination.
+def write_cfg(args, workdir):
+    sinks = args.sinks.split(',')
+    lines = ['set SRC TOPIC_FMT rawmqtt_fmt', 'set SRC SERVER localhost']
+    dests = []
+    if 'mqtt' in sinks:
+        for i in range(args.fanout):
+            lines.append('set DEST%d TOPIC_FMT rawmqtt_fmt' % i)
+            lines.append('set DEST%d SERVER localhost' % i)
+            lines.append('set DEST%d QOS %d' % (i, args.qos))
+            lines.append('set DEST%d DISPATCH_QUEUE_SIZE %d' % (i, args.queue_size))
+            if args.durable:
+                lines.append('set DEST%d DURABLE_DIR %s' % (i, os.path.join(workdir, 'durable')))
+            dests.append(('DEST%d' % i, 'bench/out/{topic}'))
+    if 'file' in sinks:
+        lines.append('set FILE1 TOPIC_FMT file')
+        lines.append('set FILE1 FILENAME %s' % os.path.join(workdir, 'bench.csv'))
+        lines.append('set FILE1 DISPATCH_QUEUE_SIZE %d' % args.queue_size)
+        dests.append(('FILE1', ''))
+    if 'sqlite' in sinks:
+        lines.append('set DB1 TOPIC_FMT sqlite')
+        lines.append('set DB1 FILENAME %s' % os.path.join(workdir, 'bench.db'))
+        lines.append('set DB1 DISPATCH_QUEUE_SIZE %d' % args.queue_size)
+        dests.append(('DB1', ''))
+    for rule in range(args.rules):
+        source = '/bench/%d/+' % rule if args.wildcard else '/bench/%d' % rule
+        for dname, dest in dests:
+            lines.append('SRC %s %s %s %s' % (source, dname, dest, args.route_options))
+    filename = os.path.join(workdir, 'bench.cfg')
+    f = open(filename, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    return(filename)
+
+def percentile(values, pct):
+    if not values:
+        return(0.0)
+    return(values[min(len(values) - 1, int(len(values) * pct / 100.0))])
+
+def run(args):
+    mr = load_repeater()
+    workdir = tempfile.mkdtemp(prefix='mqtt_bench_')
+    try:
+        mr.read_cfgfile(write_cfg(args, workdir))
+        # Time file/DB writes at the point they are handed to the writer threads
+        publish_file, publish_sqldb = mr.publish_file, mr.publish_sqldb
+        def timed_file(name, sourcefeed, dest, filename, payload):
+            publish_file(name, sourcefeed, dest, filename, payload)
+            record(payload)
+        def timed_sqldb(name, sourcefeed, dest, filename, payload):
+            publish_sqldb(name, sourcefeed, dest, filename, payload)
+            record(payload)
+        mr.publish_file, mr.publish_sqldb = timed_file, timed_sqldb
+        mr.start_sinks()
+        for name in mr.settings_dict:
+            if mr.settings_dict[name]['TOPIC_FMT'] not in ('file', 'sqlite'):
+                mr.instance_start(mr.settings_dict[name], name)
+        source = mr.settings_dict['SRC']['instance']
+
+        topics = ['/bench/%d/t%d' % (i % args.rules, i) if args.wildcard else '/bench/%d' % (i % args.rules)
+                  for i in range(args.topics)]
+        padding = 'x' * max(0, args.payload_size - 12)
+        del sent[:]
+        del latencies[:]
+        if args.tracemalloc:
+            import tracemalloc
+            tracemalloc.start()
+
+        interval = 1.0 / args.rate if args.rate else 0
+        start = timer()
+        for seq in range(args.messages):
+            if interval:  # Pace to the requested rate
+                delay = start + seq * interval - timer()
+                if delay > 0:
+                    time.sleep(delay)
+            sent.append(timer())
+            mr.message(source, topics[seq % len(topics)], '%d|%s' % (seq, padding))
+        ingest = timer() - start
+        mr.stop_sinks()  # Waits for every queue to drain and the writers to flush
+        total = timer() - start
+
+        peak = None
+        if args.tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        # Don't leave client instances around for another run in the same process
+        for name in mr.settings_dict:
+            mr.settings_dict[name].pop('instance', None)
+        mr.settings_dict.clear()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    lat = sorted(latencies)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss = maxrss // 1024  # Bytes on OSX, KB elsewhere
+    return({
+        'params': vars(args).copy(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'messages': args.messages,
+        'deliveries': len(lat),
+        'ingest_msgs_per_sec': args.messages / ingest if ingest else 0,
+        'msgs_per_sec': args.messages / total if total else 0,
+        'deliveries_per_sec': len(lat) / total if total else 0,
+        'latency_p50_ms': percentile(lat, 50) * 1000,
+        'latency_p99_ms': percentile(lat, 99) * 1000,
+        'latency_max_ms': (lat[-1] * 1000) if lat else 0,
+        'max_rss_kb': maxrss,
+        'tracemalloc_peak_bytes': peak,
+    })
+
+def report(result):
+    print('Messages:        %d  (%d deliveries)' % (result['messages'], result['deliveries']))
+    print('Ingest:          %.0f msgs/sec  (message() calls only)' % result['ingest_msgs_per_sec'])
+    print('Throughput:      %.0f msgs/sec  %.0f deliveries/sec' % (result['msgs_per_sec'], result['deliveries_per_sec']))
+    print('Latency:         p50 %.3f ms  p99 %.3f ms  max %.3f ms' % (result['latency_p50_ms'], result['latency_p99_ms'],
+                                                                  result['latency_max_ms']))
+    print('Max RSS:         %d KB' % result['max_rss_kb'])
+    if result['tracemalloc_peak_bytes'] is not None:
+        print('Traced peak:     %d bytes' % result['tracemalloc_peak_bytes'])
+
+# Compare against a saved result.  Returns False if throughput dropped or p99 latency grew by more than threshold %.
+def compare(result, filename, threshold):
+    old = json.load(open(filename))
+    ok = True
+    for key, higher_is_better in (('msgs_per_sec', True), ('ingest_msgs_per_sec', True), ('latency_p99_ms', False)):
+        if not old.get(key):
+            continue
+        change = (result[key] - old[key]) * 100.0 / old[key]
+        regressed = change < -threshold if higher_is_better else change > threshold
+        print('%-20s %12.3f -> %12.3f  %+7.1f%%%s' % (key, old[key], result[key], change, '  REGRESSION' if regressed else ''))
+        ok = ok and not regressed
+    return(ok)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the mqtt_repeater.py message path.')
+    parser.add_argument('--messages', type=int, default=50000, help='Messages to send (default: 50000)')
+    parser.add_argument('--rate', type=float, default=0, help='Messages/sec to send at.  0 is as fast as possible')
+    parser.add_argument('--payload-size', type=int, default=32, help='Payload bytes (default: 32)')
+    parser.add_argument('--fanout', type=int, default=1, help='MQTT destinations per rule (default: 1)')
+    parser.add_argument('--rules', type=int, default=100, help='Mapping rules for the source (default: 100)')
+    parser.add_argument('--topics', type=int, default=1000, help='Distinct incoming topics (default: 1000)')
+    parser.add_argument('--wildcard', action='store_true', help="Use '+' wildcard rules instead of exact topics")
+    parser.add_argument('--sinks', default='mqtt', help='Comma separated destination types: mqtt,file,sqlite (default: mqtt)')
+    parser.add_argument('--qos', type=int, default=1, help='QOS for MQTT destinations (default: 1)')
+    parser.add_argument('--durable', action='store_true', help='Log MQTT destination messages to disk (DURABLE_DIR)')
+    parser.add_argument('--route-options', default='', help="Options for every mapping rule, eg. 'ON_CHANGE=1 MAX_RATE=10'")
+    parser.add_argument('--queue-size', type=int, default=1000, help='DISPATCH_QUEUE_SIZE for every destination')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also measure peak traced Python memory (slower)')
+    parser.add_argument('--output', help='Save results as JSON to this file')
+    parser.add_argument('--compare', help='Compare with results saved by --output')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent change counted as a regression (default: 10)')
+    args = parser.parse_args()
+    if args.topics < args.rules:
+        args.topics = args.rules  # Every rule gets traffic
+
+    result = run(args)
+    report(result)
+    if args.output:
+        f = open(args.output, 'w')
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.close()
+        print('Saved:           %s' % args.output)
+    if args.compare:
+        if not compare(result, args.compare, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
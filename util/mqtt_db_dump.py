@@ -1,17 +1,69 @@
 #!/usr/bin/env python
-#This needs to be fully commented and have a Usage message
+# Print the last value of every topic:  source, topic, value, timestamp (tab separated, oldest first)
+#
+# Usage:   util/mqtt_db_dump.py [--prefix /home/] [--db db/mqtt_repeater.db | --url http://127.0.0.1:9108]
+#
+# Asks the running repeater (/values on its HTTP_PORT, at --url).  That is every topic it routed since it started,
+#  to any destination.  If it can't be reached (not running, HTTP_PORT off), reads the 'states' table of the DB
+#  instead.  --db reads only the DB, so it can't be used with --url.
+#
 # Copyright (c) 2016 - mgroseman - Mike Roseman
 # MIT License
 
-
+import argparse
+import json
+import os
 import sqlite3
+import sys
+try:
+    from urllib.request import urlopen  # Python 3
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import urlopen  # Python 2
+    from urllib import urlencode
+
 SQLDB='db/mqtt_repeater.db'
-conn = sqlite3.connect(SQLDB)
+URL='http://127.0.0.1:9108'  # REPEATER HTTP_ADDR/HTTP_PORT
+TIMEOUT = 2  # Seconds to wait for the repeater
 
-db = conn.cursor()
+# [(source, topic, value, timestamp)] from the repeater.  Raises an exception if it can't be reached
+def http_values(url, prefix):
+    reply = urlopen('%s/values?%s' % (url.rstrip('/'), urlencode({'prefix': prefix})), timeout=TIMEOUT)
+    try:
+        found = json.loads(reply.read().decode('utf-8'))
+    finally:
+        reply.close()
+    return([(v['source'], v['topic'], v['value'], v['timestamp']) for v in found])
 
-for row in db.execute('SELECT * FROM states ORDER BY last_timestamp'):
-        print('%s\t%s\t%s\t%s' % row)
+def db_values(filename, prefix):
+    if not os.path.exists(filename):  # Don't let sqlite3 create an empty one
+        sys.stderr.write('No DB at %s\n' % filename)
+        sys.exit(1)
+    conn = sqlite3.connect(filename)
+    rows = [row for row in conn.execute('SELECT * FROM states ORDER BY last_timestamp') if row[1].startswith(prefix)]
+    conn.close()
+    return(rows)
 
-conn.close()
+def main():
+    parser = argparse.ArgumentParser(description='Print the last value of every topic seen by mqtt_repeater.py')
+    parser.add_argument('--prefix', default='', help='Only topics starting with this')
+    parser.add_argument('--db', help='Only read this DB file.  (The DB read when the repeater can\'t answer is %s)' % SQLDB)
+    parser.add_argument('--url', help='HTTP address of the running repeater, asked first (default: %s)' % URL)
+    args = parser.parse_args()
+
+    if args.db and args.url:
+        parser.error("--db and --url can't be used together")
+    rows = None
+    if not args.db:  # The repeater first
+        try:
+            rows = http_values(args.url or URL, args.prefix)
+        except Exception:  # Connection refused, timeout...  Read the DB
+            if args.url:
+                sys.stderr.write('No answer from %s: %s.  Reading %s\n' % (args.url, sys.exc_info()[1], SQLDB))
+    if rows is None:
+        rows = db_values(args.db or SQLDB, args.prefix)
+    for row in sorted(rows, key=lambda row: row[3]):
+        print('%s\t%s\t%s\t%s' % row)
 
+if __name__ == '__main__':
+    main()
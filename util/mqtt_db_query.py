@@ -1,22 +1,161 @@
 #!/usr/bin/env python
-#This needs to be fully commented and have a Usage message
-#Takes two args:   1) SOURCE label  2) topic
-# eg.   mqtt_db_query.py MQTT_1 /home/sensor/temp
+# Query values saved by a 'sqlite' destination of mqtt_repeater.py
+#
+# Usage:   util/mqtt_db_query.py [options] SOURCE TOPIC
+#   eg.    util/mqtt_db_query.py MQTT_1 /home/sensor/temp                          (last value)
+#          util/mqtt_db_query.py --db db/other.db MQTT_1 /home/sensor/temp         (last value in that DB)
+#          util/mqtt_db_query.py --since 6h MQTT_1 /home/sensor/temp               (every value in the last 6 hours)
+#          util/mqtt_db_query.py --since 90d --bucket 1d MQTT_1 /home/sensor/temp  (min/max/avg/count per day)
+#          util/mqtt_db_query.py --since 2016-05-01 --until 2016-06-01 --bucket 1h MQTT_1 /home/sensor/temp
+#
+# --since/--until take a time ago (30s, 15m, 6h, 7d, 2w) or a local date/time (2016-05-01 or 2016-05-01T12:00:00).
+# --bucket takes a size in the same units, or plain seconds.  Buckets start on whole multiples of their size (UTC).
+#
+# The last value comes from the running repeater's memory (/value on its HTTP_PORT, at --url), which is the last
+#  value it routed from the topic since it started, to any destination.  If the repeater can't be reached (not
+#  running, HTTP_PORT off) or hasn't seen the topic, it is read from the DB instead.  --db reads only the DB, so it
+#  can't be used with --url.  Time ranges always come from the DB.
+#  Scripts polling often can skip this script and ask the repeater directly:
+#    curl 'http://127.0.0.1:9108/value?source=MQTT_1&topic=/home/sensor/temp'
+#    curl 'http://127.0.0.1:9108/values?prefix=/home/'       (JSON.  Also takes source= and any number of topic=)
+#
+# Time ranges need 'set <DB> HISTORY 1' in the cfgfile.  Buckets of whole minutes or hours are read from the
+#  history_rollup summaries kept by mqtt_repeater.py, so they stay fast over months of data.  Other bucket sizes are
+#  worked out from the raw values (kept for HISTORY_RAW_DAYS).  Values that aren't numbers are left out of buckets.
 #
 # Copyright (c) 2016 - mgroseman - Mike Roseman
 # MIT License
 
+import argparse
+import os
+import re
 import sqlite3
 import sys
+import time
+try:
+    from urllib.request import urlopen  # Python 3
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import urlopen  # Python 2
+    from urllib import urlencode
+
 SQLDB='db/mqtt_repeater.db'
-conn = sqlite3.connect(SQLDB)
+URL='http://127.0.0.1:9108'  # REPEATER HTTP_ADDR/HTTP_PORT
+TIMEOUT = 2  # Seconds to wait for the repeater
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+ROLLUP_PERIODS = (3600, 60)  # history_periods in mqtt_repeater.py, largest first
+
+# '90' or '15m' -> seconds
+def parse_duration(text):
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhdw]?)$', text)
+    if not match:
+        raise argparse.ArgumentTypeError('not a duration: %s  (eg. 300, 15m, 6h, 7d)' % text)
+    return(float(match.group(1)) * UNITS.get(match.group(2) or 's'))
+
+# '6h' (ago) or a local date/time -> seconds since the epoch
+def parse_time(text):
+    try:
+        return(time.time() - parse_duration(text))
+    except argparse.ArgumentTypeError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return(time.mktime(time.strptime(text, fmt)))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError('not a time: %s  (eg. 6h, 2016-05-01, 2016-05-01T12:00:00)' % text)
+
+def timestamp(ts):
+    return(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)))
+
+# Ask the repeater.  Raises an exception if it can't be reached, or has no value for the topic (404)
+def http_value(url, source, topic):
+    reply = urlopen('%s/value?%s' % (url.rstrip('/'), urlencode({'source': source, 'topic': topic})), timeout=TIMEOUT)
+    try:
+        return(reply.read().decode('utf-8'))
+    finally:
+        reply.close()
+
+def last_value(db, source, topic):
+    db.execute('SELECT value FROM states WHERE source_label=? and source_feed=?', (source, topic))
+    row = db.fetchone()
+    if row is None:
+        sys.stderr.write('No value for %s %s\n' % (source, topic))
+        sys.exit(1)
+    print(row[0])
+
+# Every value in the range
+def values(db, source, topic, since, until):
+    db.execute('''SELECT ts, value FROM history WHERE source_label=? AND source_feed=? AND ts>=? AND ts<?
+                  ORDER BY ts''', (source, topic, since, until))
+    for ts, value in db:
+        print('%s\t%s' % (timestamp(ts), value))
 
-db = conn.cursor()
+# min/max/avg/count per bucket.  From the largest history_rollup period the bucket size is a multiple of, or raw values
+def buckets(db, source, topic, since, until, size):
+    period = None
+    for p in ROLLUP_PERIODS:
+        if size >= p and size % p == 0:
+            period = p
+            break
+    if period is not None:
+        db.execute('''SELECT CAST(bucket / ? AS INTEGER) * ? AS b, MIN(min), MAX(max), SUM(sum) / SUM(count), SUM(count)
+                      FROM history_rollup WHERE source_label=? AND source_feed=? AND period=? AND bucket>=? AND bucket<?
+                      GROUP BY b ORDER BY b''', (size, size, source, topic, period, since - since % period, until))
+    else:
+        db.execute('''SELECT CAST(ts / ? AS INTEGER) * ? AS b, MIN(number), MAX(number), AVG(number), COUNT(number)
+                      FROM history WHERE source_label=? AND source_feed=? AND ts>=? AND ts<? AND number IS NOT NULL
+                      GROUP BY b ORDER BY b''', (size, size, source, topic, since, until))
+    print('bucket\tmin\tmax\tavg\tcount')
+    for b, low, high, avg, count in db:
+        print('%s\t%g\t%g\t%g\t%d' % (timestamp(b), low, high, avg, count))
 
-source=sys.argv[1]
-topic=sys.argv[2]
-db.execute('SELECT value FROM states WHERE source_label=? and source_feed=?', (source, topic))
-print db.fetchall()[0][0]  # Needed to unpack tuple
+def main():
+    parser = argparse.ArgumentParser(description='Query values saved by a sqlite destination of mqtt_repeater.py.  '
+                                     'With no options, prints the last value.')
+    parser.add_argument('source', help='Source LABEL, as in the cfgfile (eg. MQTT_1)')
+    parser.add_argument('topic', help='Source topic/feed (eg. /home/sensor/temp)')
+    parser.add_argument('--db', help='Only read this DB file.  (The DB read when the repeater can\'t answer is %s)' % SQLDB)
+    parser.add_argument('--url', help='HTTP address of the running repeater, asked for the last value '
+                        'first (default: %s)' % URL)
+    parser.add_argument('--since', type=parse_time, help='Start of the time range.  Time ago (6h) or date/time')
+    parser.add_argument('--until', type=parse_time, help='End of the time range (default: now)')
+    parser.add_argument('--bucket', type=parse_duration, help='Print min/max/avg/count per bucket of this size (eg. 1h)')
+    args = parser.parse_args()
 
-conn.close()
+    if args.db and args.url:
+        parser.error("--db and --url can't be used together")
+    last = args.since is None and args.until is None and args.bucket is None
+    if args.url and not last:
+        parser.error('--url only gives the last value.  Time ranges come from the DB')
+    if last and not args.db:  # The repeater first
+        try:
+            print(http_value(args.url or URL, args.source, args.topic))
+            return
+        except Exception:  # Connection refused, timeout, 404...  Try the DB
+            if args.url:
+                sys.stderr.write('No value from %s: %s.  Reading %s\n' % (args.url, sys.exc_info()[1], SQLDB))
+    args.db = args.db or SQLDB
+    if not os.path.exists(args.db):  # Don't let sqlite3 create an empty one
+        sys.stderr.write('No DB at %s\n' % args.db)
+        sys.exit(1)
+    conn = sqlite3.connect(args.db)
+    db = conn.cursor()
+    try:
+        if last:
+            last_value(db, args.source, args.topic)
+            return
+        since = args.since if args.since is not None else 0
+        until = args.until if args.until is not None else time.time()
+        if args.bucket:
+            buckets(db, args.source, args.topic, since, until, args.bucket)
+        else:
+            values(db, args.source, args.topic, since, until)
+    except sqlite3.OperationalError:
+        sys.stderr.write('%s: %s  (Time ranges need HISTORY 1 set for this DB in the cfgfile)\n' % (args.db, sys.exc_info()[1]))
+        sys.exit(1)
+    finally:
+        conn.close()
 
+if __name__ == '__main__':
+    main()